@@ -10,6 +10,9 @@ DATABASES = {
         'NAME': '{{app_name}}',              
         'USER' : '{{app_name}}',
         'PASSWORD' : '{{app_db_password}}',
+        # Keep connections open between requests instead of reconnecting
+        # to MySQL on every request.
+        'CONN_MAX_AGE': 300,
     }
 }
 
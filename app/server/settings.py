@@ -46,11 +46,15 @@ INSTALLED_APPS = (
 ACCOUNT_ACTIVATION_DAYS = 7
 
 MIDDLEWARE_CLASSES = (
+    'webclient.db_health.ConnectionHealthMiddleware',
+    'webclient.metrics.QueryMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'webclient.profiling.ProfilingMiddleware',
+    'webclient.rate_limit.ThrottledMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -70,6 +74,162 @@ DATABASES = {
     }
 }
 
+# Persistent connections (CONN_MAX_AGE, see local_settings.py) idle for more
+# than this many seconds are pinged before use, see webclient/db_health.py.
+WORKSTATION_DB_HEALTH_CHECK_SECS = 30
+
+# Per-view query counts and latencies at /internal/metrics, see
+# webclient/metrics.py.
+WORKSTATION_METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+# Fraction of requests run under cProfile, see webclient/profiling.py.  Internal
+# clients can also request profiling with an "X-Profile: 1" header.  If a dump
+# directory is set, the pstats of the slowest profiled requests are kept there.
+WORKSTATION_PROFILING_SAMPLE_RATE = 0.0
+WORKSTATION_PROFILING_DUMP_DIR = None
+WORKSTATION_PROFILING_KEEP_SLOWEST = 20
+
+# Caches
+# https://docs.djangoproject.com/en/1.7/topics/cache/
+#
+# Each worker process gets private locmem caches by default.  Set
+# DJANGO_SHARED_CACHE_LOCATION (e.g. "127.0.0.1:11211", comma separated for
+# several servers) to share them between processes through
+# DJANGO_SHARED_CACHE_BACKEND, memcached unless given.  The caches hold IAM
+# secrets and NX keys, so the backend must be private to the app.  With
+# several worker processes a shared cache is required for the per-instance
+# locks of webclient/single_flight.py and the EC2 rate limit of
+# webclient/rate_limit.py to hold across them; the ansible deployment runs
+# the workers against a local memcached.
+
+SHARED_CACHE_BACKEND = os.environ.get(
+    'DJANGO_SHARED_CACHE_BACKEND',
+    'django.core.cache.backends.memcached.MemcachedCache')
+SHARED_CACHE_LOCATION = os.environ.get('DJANGO_SHARED_CACHE_LOCATION', '')
+
+
+def _Cache(name, max_entries=300):
+    if SHARED_CACHE_LOCATION:
+        return {
+            'BACKEND': SHARED_CACHE_BACKEND,
+            'LOCATION': SHARED_CACHE_LOCATION.split(','),
+            'KEY_PREFIX': name,
+        }
+    return {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': name,
+        'OPTIONS': {
+            'MAX_ENTRIES': max_entries,
+        },
+    }
+
+CACHES = {
+    'default': _Cache('default', max_entries=5000),
+    # Per-user snapshots of ListInstances() and their change logs, see
+    # webclient/inventory.py.
+    'inventory': _Cache('inventory', max_entries=2000),
+    # Read-through cache in front of the session table.
+    'sessions': _Cache('sessions', max_entries=10000),
+}
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
+
+WORKSTATION_INVENTORY_CACHE = 'inventory'
+WORKSTATION_INVENTORY_TTL = 30  # seconds
+
+# Refresh the inventory incrementally: only ask EC2 for instances in flux,
+# listing everything at least every WORKSTATION_INVENTORY_FULL_SYNC_SECS.
+# Changes are logged for /api/workstations?since=..., see
+# webclient/inventory.py.
+WORKSTATION_INVENTORY_INCREMENTAL = True
+WORKSTATION_INVENTORY_FULL_SYNC_SECS = 300
+WORKSTATION_INVENTORY_CHANGE_LOG_SIZE = 500
+
+# Workstations shown per page of the workstations table, by default and at
+# most (per_page parameter), see webclient/workstation_list.py.
+WORKSTATION_PAGE_SIZE = 50
+WORKSTATION_MAX_PAGE_SIZE = 200
+
+# Regions whose workstations are listed; they are listed concurrently on
+# WORKSTATION_REGION_WORKERS threads, and a region that takes longer than
+# WORKSTATION_REGION_TIMEOUT_SECS is shown as unavailable.
+WORKSTATION_REGIONS = ['us-east-1']
+WORKSTATION_REGION_TIMEOUT_SECS = 10
+WORKSTATION_REGION_WORKERS = 8
+
+# Idle workstation.Manager instances kept per process, see
+# webclient/manager_pool.py.
+WORKSTATION_MANAGER_POOL_SIZE = 50
+WORKSTATION_MANAGER_POOL_IDLE_SECS = 300
+
+# Executor for long-running workstation operations, see webclient/jobs.py.
+# 'local' runs them on WORKSTATION_JOB_WORKERS in-process threads, 'inline'
+# runs them synchronously in the request.
+WORKSTATION_JOB_EXECUTOR = 'local'
+WORKSTATION_JOB_WORKERS = 4
+# Running jobs not updated for this long are marked failed at startup.
+WORKSTATION_JOB_STALE_SECS = 3600
+
+# Mutating operations on one workstation are serialized by a lock in this
+# cache and identical ones are coalesced, see webclient/single_flight.py.
+# Views give up waiting for the lock after WORKSTATION_INSTANCE_LOCK_WAIT_SECS,
+# jobs after WORKSTATION_JOB_LOCK_WAIT_SECS; locks expire after
+# WORKSTATION_INSTANCE_LOCK_SECS.
+WORKSTATION_INSTANCE_LOCK_CACHE = 'default'
+WORKSTATION_INSTANCE_LOCK_WAIT_SECS = 20
+WORKSTATION_JOB_LOCK_WAIT_SECS = 900
+WORKSTATION_INSTANCE_LOCK_SECS = 900
+
+# EC2 API calls per second and burst per account and region, shared through
+# WORKSTATION_EC2_RATE_CACHE, see webclient/rate_limit.py.  Read calls leave
+# WORKSTATION_EC2_READ_RESERVE tokens to mutating ones.  Calls wait for a
+# token for up to MAX_WAIT_SECS; throttled calls are retried MAX_RETRIES
+# times after a jittered backoff of up to BACKOFF_BASE_SECS * 2^attempt.
+WORKSTATION_EC2_RATE_CACHE = 'default'
+WORKSTATION_EC2_RATE = 5
+WORKSTATION_EC2_BURST = 20
+WORKSTATION_EC2_READ_RESERVE = 5
+WORKSTATION_EC2_MAX_WAIT_SECS = 10
+WORKSTATION_EC2_MAX_RETRIES = 5
+WORKSTATION_EC2_BACKOFF_BASE_SECS = 0.5
+WORKSTATION_EC2_BACKOFF_MAX_SECS = 20
+
+# Shared per-account instance pollers behind /api/workstations/events, see
+# webclient/instance_events.py.  Polls every FAST_SECS while an instance is in
+# flux, backing off to SLOW_SECS while nothing changes.
+WORKSTATION_POLL_FAST_SECS = 5
+WORKSTATION_POLL_SLOW_SECS = 60
+WORKSTATION_EVENTS_MAX_STREAM_SECS = 300
+# Event streams a worker process keeps open at once; each holds one of its
+# uwsgi --threads (see ansible/templates/supervisor.ini), so keep this below
+# that to leave threads for ordinary requests.
+WORKSTATION_EVENTS_MAX_STREAMS = 4
+
+# Cached NX session configs served by Connect, see
+# webclient/session_configs.py.  The configs contain the workstation's NX key,
+# keep this cache private to the app.
+WORKSTATION_SESSION_CONFIG_CACHE = 'default'
+WORKSTATION_SESSION_CONFIG_TTL = 24 * 60 * 60  # seconds
+WORKSTATION_SESSION_CONFIG_WORKERS = 2
+
+# Cached AWS credential checks, see webclient/credential_checks.py.  Failed
+# checks are remembered for INVALID_TTL seconds.
+WORKSTATION_CREDENTIALS_CACHE = 'default'
+WORKSTATION_CREDENTIALS_VALID_TTL = 300
+WORKSTATION_CREDENTIALS_INVALID_TTL = 60
+WORKSTATION_CREDENTIALS_WORKERS = 4
+WORKSTATION_PROVISIONING_TIMEOUT_SECS = 300
+# Per-user IamCredentials rows, cached in WORKSTATION_CREDENTIALS_CACHE and
+# invalidated when they are saved or deleted.
+WORKSTATION_IAM_CREDENTIALS_TTL = 300
+
+# Bulk start/stop/destroy at /api/workstations/<action>, see
+# webclient/bulk_power.py.  PARALLELISM bounds the concurrent EC2 calls made
+# when a request can't be batched.
+WORKSTATION_BULK_MAX_INSTANCES = 100
+WORKSTATION_BULK_PARALLELISM = 8
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
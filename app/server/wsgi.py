@@ -27,6 +27,15 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Pick up the jobs of worker processes that exited.  This runs in every
+# worker, so the app has to be loaded after forking (uwsgi --lazy-apps).
+import logging
+try:
+    from webclient import jobs
+    jobs.RecoverJobs()
+except Exception:
+    logging.exception('Recovering jobs failed')
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
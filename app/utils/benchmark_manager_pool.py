@@ -0,0 +1,120 @@
+#!/usr/bin/python
+""" Compares Start/Stop/Connect view latency with and without Manager pooling.
+
+Drives the views directly through a RequestFactory against a stub Manager
+whose constructor sleeps for --setup_ms to stand in for the boto connection
+setup and credential checks done by workstation.Manager.
+
+  ./utils/benchmark_manager_pool.py --requests 200 --setup_ms 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
+
+import django
+django.setup()
+
+from django.test.client import RequestFactory
+from webclient import manager_pool
+from webclient import views
+
+
+class StubInstanceInfo(object):
+  def __init__(self, name, id, state, hostname):
+    self.name = name
+    self.id = id
+    self.state = state
+    self.hostname = hostname
+    return
+
+
+class StubManager(object):
+  setup_secs = 0.05
+  call_secs = 0.001
+
+  def __init__(self, region_name, iam_aws_id, iam_aws_secret):
+    time.sleep(self.setup_secs)
+    return
+
+  def StartInstance(self, instance_id):
+    time.sleep(self.call_secs)
+    return
+
+  def StopInstance(self, instance_id):
+    time.sleep(self.call_secs)
+    return
+
+  def CreateRemoteSessionConfig(self, instance_id):
+    time.sleep(self.call_secs)
+    return 'nx session config for %s' % (instance_id)
+
+  def GetInstanceInfo(self, instance_id):
+    time.sleep(self.call_secs)
+    return StubInstanceInfo('bench_workstation', instance_id, 'running',
+                            'bench.compute.amazonaws.com')
+
+
+class StubCredentials(object):
+  iam_key_id = 'AKIBENCHMARKKEY00000'
+  iam_key_secret = 'x' * 40
+
+
+class StubUser(object):
+  def is_authenticated(self):
+    return True
+
+
+def RunViews(num_requests):
+  """ Returns per-request latencies in seconds over a Start/Stop/Connect mix. """
+  factory = RequestFactory()
+  user = StubUser()
+  credentials = StubCredentials()
+  instance_id = 'i-0123abcd'
+  mix = [(views.Start, '/start/'), (views.Stop, '/stop/'),
+         (views.Connect, '/connect/')]
+  latencies = []
+  for i in range(num_requests):
+    view, path = mix[i % len(mix)]
+    request = factory.get(path + instance_id)
+    request.user = user
+    request.iam_credentials = credentials  # skip the IamCredentials lookup
+    start = time.time()
+    view(request, instance_id)
+    latencies.append(time.time() - start)
+  return latencies
+
+
+def Report(label, latencies):
+  latencies = sorted(latencies)
+  mean_ms = 1000.0 * sum(latencies) / len(latencies)
+  p95_ms = 1000.0 * latencies[int(0.95 * (len(latencies) - 1))]
+  print '%-10s requests: %d  mean: %.2f ms  p95: %.2f ms' % (
+      label, len(latencies), mean_ms, p95_ms)
+  return mean_ms
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--requests', type=int, default=150)
+  parser.add_argument('--setup_ms', type=float, default=50.0)
+  parser.add_argument('--call_ms', type=float, default=1.0)
+  args = parser.parse_args()
+  StubManager.setup_secs = args.setup_ms / 1000.0
+  StubManager.call_secs = args.call_ms / 1000.0
+
+  results = {}
+  for label, max_size in [('unpooled', 0), ('pooled', 50)]:
+    manager_pool.manager_pool = manager_pool.ManagerPool(max_size=max_size,
+                                                         factory=StubManager)
+    results[label] = Report(label, RunViews(args.requests))
+  print 'speedup: %.1fx' % (results['unpooled'] / results['pooled'])
+  return
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+""" Counts database queries per request of the Workstations view.
+
+Compares the previous configuration (database sessions, IamCredentials
+loaded from the database on every request) with cached_db sessions and the
+cached IamCredentials lookup.  Runs against a throwaway test database and a
+stub Manager, so neither the real database nor EC2 are touched.
+
+  ./utils/benchmark_queries.py --requests 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from webclient import manager_pool
+from webclient import models
+
+
+class StubInstanceInfo(object):
+  def __init__(self, name, id, state, hostname):
+    self.name = name
+    self.id = id
+    self.state = state
+    self.hostname = hostname
+    return
+
+
+class StubManager(object):
+  def __init__(self, region_name, iam_aws_id, iam_aws_secret):
+    return
+
+  def ListInstances(self):
+    return [StubInstanceInfo('bench_workstation_%d' % (i), 'i-%08x' % (i),
+                             'running', 'bench%d.compute.amazonaws.com' % (i))
+            for i in range(5)]
+
+
+configs = [
+  ('before', {'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+              'WORKSTATION_IAM_CREDENTIALS_TTL': 0}),
+  ('after', {}),
+]
+
+
+def Run(num_requests, overrides):
+  """ Returns (queries per request, mean ms per request). """
+  for cache in caches.all():
+    cache.clear()
+  with override_settings(**overrides):
+    client = Client()
+    client.login(username='bench', password='pw')
+    client.get('/workstations/')  # warm the inventory and session caches
+    num_queries = 0
+    start = time.time()
+    for i in range(num_requests):
+      with CaptureQueriesContext(connection) as queries:
+        response = client.get('/workstations/')
+      assert response.status_code == 200, response.status_code
+      num_queries += len(queries)
+    elapsed = time.time() - start
+  return float(num_queries) / num_requests, 1000.0 * elapsed / num_requests
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--requests', type=int, default=50)
+  args = parser.parse_args()
+
+  setup_test_environment()
+  old_name = connection.creation.create_test_db(verbosity=0)
+  try:
+    user = User.objects.create_user('bench', 'bench@example.com', 'pw')
+    models.IamCredentials.objects.create(user=user,
+                                         iam_key_id='AKIBENCHMARKKEY00000',
+                                         iam_key_secret='x' * 40)
+    manager_pool.manager_pool = manager_pool.ManagerPool(factory=StubManager)
+    for label, overrides in configs:
+      queries, mean_ms = Run(args.requests, overrides)
+      print '%-7s requests: %d  queries/request: %.1f  mean: %.2f ms' % (
+          label, args.requests, queries, mean_ms)
+  finally:
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+  return
+
+
+if __name__ == '__main__':
+  main()
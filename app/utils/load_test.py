@@ -0,0 +1,400 @@
+#!/usr/bin/python
+""" Load test of the hot webclient views against a fake EC2 backend.
+
+Replays a traffic mix of Workstations page loads, Connect downloads,
+Start/Stop clicks and CreateWorkstation submissions from --users concurrent
+users, each with their own AWS account of --instances workstations in a
+fake_backend.FakeCloud.  Runs against a throwaway test database, so neither
+the real database nor AWS are touched.  Two transports are measured:
+
+  client - the Django test client, in-process, one thread per user
+  wsgi   - HTTP against the Django app served by a threaded WSGI server
+
+Reports throughput, p50/p95/p99 latency and queries per request per view.
+--save writes the results as a JSON baseline under utils/load_test_baselines,
+--compare checks a run against one and exits non-zero on regressions:
+
+  ./utils/load_test.py --save before
+  ./utils/load_test.py --compare before --tolerance 0.2
+
+A baseline records the settings module and database vendor it ran with;
+compare against baselines recorded with the same ones.  The checked in
+baseline.json was recorded with the defaults, the webclient migrations and
+server/settings.py without the deployment's local_settings (sqlite, locmem
+caches).
+"""
+
+import argparse
+import cookielib
+import json
+import os
+import random
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+from wsgiref import simple_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
+
+import django
+django.setup()
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from webclient import fake_backend
+from webclient import metrics
+from webclient import models
+
+baseline_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'load_test_baselines')
+region = 'us-east-1'
+
+# (scenario, weight)
+traffic_mix = [
+  ('workstations', 50),
+  ('connect', 25),
+  ('start', 10),
+  ('stop', 10),
+  ('create', 5),
+]
+
+# Names of the views behind each scenario, for the query counts.
+scenario_views = {
+  'workstations': 'webclient.views.Workstations',
+  'connect': 'webclient.views.Connect',
+  'start': 'webclient.views.Start',
+  'stop': 'webclient.views.Stop',
+  'create': 'webclient.views.CreateWorkstation',
+}
+
+csrf_token = 'loadtest' * 4
+
+
+class ClientTransport(object):
+  """ Issues requests through the Django test client. """
+
+  def __init__(self, username):
+    self.client = Client()
+    self.client.login(username=username, password='pw')
+    return
+
+  def Get(self, path):
+    return self.client.get(path).status_code
+
+  def Post(self, path, data):
+    return self.client.post(path, data).status_code
+
+
+class NoRedirects(urllib2.HTTPRedirectHandler):
+  def redirect_request(self, *args):
+    return None
+
+
+class WsgiTransport(object):
+  """ Issues HTTP requests to the app served by a ThreadedWsgiServer. """
+
+  def __init__(self, username, base_url):
+    self.base_url = base_url
+    client = Client()
+    client.login(username=username, password='pw')
+    cookies = cookielib.CookieJar()
+    self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookies),
+                                       NoRedirects())
+    self.opener.addheaders = [
+        ('Cookie', '%s=%s; csrftoken=%s' % (
+            settings.SESSION_COOKIE_NAME,
+            client.cookies[settings.SESSION_COOKIE_NAME].value, csrf_token)),
+        ('X-CSRFToken', csrf_token)]
+    return
+
+  def __Open(self, path, data=None):
+    try:
+      response = self.opener.open(self.base_url + path, data)
+      response.read()
+      return response.getcode()
+    except urllib2.HTTPError as e:
+      e.read()
+      return e.code
+
+  def Get(self, path):
+    return self.__Open(path)
+
+  def Post(self, path, data):
+    return self.__Open(path, urllib.urlencode(data))
+
+
+def CloseConnections():
+  for conn in connections.all():
+    conn.close()
+  return
+
+
+class ThreadedWsgiServer(SocketServer.ThreadingMixIn,
+                         simple_server.WSGIServer):
+  daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+  def log_message(self, *args):
+    return
+
+
+class ClosingApplication(object):
+  """ Closes the DB connections of each short-lived server thread. """
+
+  def __init__(self, application):
+    self.application = application
+    return
+
+  def __call__(self, environ, start_response):
+    try:
+      return self.application(environ, start_response)
+    finally:
+      CloseConnections()
+
+
+def StartServer():
+  """ Returns (server, base url) of a WSGI server on a free local port. """
+  server = simple_server.make_server(
+      '127.0.0.1', 0, ClosingApplication(get_wsgi_application()),
+      server_class=ThreadedWsgiServer, handler_class=QuietHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, 'http://127.0.0.1:%d' % (server.server_port)
+
+
+def PickScenario(rng):
+  total = sum(weight for _, weight in traffic_mix)
+  x = rng.uniform(0, total)
+  for scenario, weight in traffic_mix:
+    x -= weight
+    if x <= 0:
+      return scenario
+  return traffic_mix[-1][0]
+
+
+def RunUser(transport, instance_ids, num_requests, seed, latencies, errors):
+  rng = random.Random(seed)
+  try:
+    for i in range(num_requests):
+      scenario = PickScenario(rng)
+      instance_id = rng.choice(instance_ids)
+      start = time.time()
+      if scenario == 'workstations':
+        status = transport.Get('/workstations/')
+      elif scenario == 'create':
+        status = transport.Post('/create/',
+                                {'name': 'load_test_%d_%d' % (seed, i),
+                                 'instance_type': 'c1.xlarge',
+                                 'region': region})
+      else:
+        status = transport.Get('/%s/%s?region=%s' % (scenario, instance_id,
+                                                      region))
+      latencies.setdefault(scenario, []).append(time.time() - start)
+      if status not in (200, 302):
+        errors.append((scenario, status))
+  finally:
+    # The client transport opened DB connections in this thread.
+    CloseConnections()
+  return
+
+
+def Percentile(sorted_secs, p):
+  return 1000.0 * sorted_secs[int(p * (len(sorted_secs) - 1))]
+
+
+def Summarize(latencies, wall_secs, view_metrics):
+  results = {}
+  for scenario, secs in sorted(latencies.items()):
+    secs = sorted(secs)
+    counters = view_metrics.get(scenario_views[scenario], {})
+    results[scenario] = {
+        'requests': len(secs),
+        'p50_ms': Percentile(secs, 0.5),
+        'p95_ms': Percentile(secs, 0.95),
+        'p99_ms': Percentile(secs, 0.99),
+        'queries_per_request': counters.get('queries_per_request', 0.0)}
+  num_requests = sum(len(secs) for secs in latencies.values())
+  all_secs = sorted(s for secs in latencies.values() for s in secs)
+  results['all'] = {
+      'requests': num_requests,
+      'throughput_rps': num_requests / wall_secs,
+      'p50_ms': Percentile(all_secs, 0.5),
+      'p95_ms': Percentile(all_secs, 0.95),
+      'p99_ms': Percentile(all_secs, 0.99)}
+  return results
+
+
+def Run(mode, users, args):
+  """ Replays the traffic mix from all users at once; returns the summary. """
+  for cache in caches.all():
+    cache.clear()
+  metrics.Reset()
+  server = None
+  if mode == 'wsgi':
+    server, base_url = StartServer()
+  transports = []
+  for username, _ in users:
+    if mode == 'wsgi':
+      transports.append(WsgiTransport(username, base_url))
+    else:
+      transports.append(ClientTransport(username))
+  latencies = [{} for _ in users]
+  errors = []
+  threads = [threading.Thread(target=RunUser,
+                              args=(transports[i], users[i][1],
+                                    args.requests, args.seed + i,
+                                    latencies[i], errors))
+             for i in range(len(users))]
+  start = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall_secs = time.time() - start
+  if server:
+    server.shutdown()
+    server.server_close()
+  merged = {}
+  for user_latencies in latencies:
+    for scenario, secs in user_latencies.items():
+      merged.setdefault(scenario, []).extend(secs)
+  results = Summarize(merged, wall_secs, metrics.Snapshot())
+  results['all']['errors'] = len(errors)
+  return results
+
+
+def Report(mode, results):
+  print '%s: %d requests, %.1f requests/s, %d errors' % (
+      mode, results['all']['requests'], results['all']['throughput_rps'],
+      results['all']['errors'])
+  print '  %-13s %8s %9s %9s %9s %9s' % ('scenario', 'requests', 'p50 ms',
+                                         'p95 ms', 'p99 ms', 'queries')
+  for scenario, r in sorted(results.items()):
+    print '  %-13s %8d %9.1f %9.1f %9.1f %9s' % (
+        scenario, r['requests'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+        '%.1f' % r['queries_per_request'] if 'queries_per_request' in r
+        else '')
+  return
+
+
+def Compare(results, baseline, tolerance):
+  """ Prints changes against baseline; returns the number of regressions. """
+  num_regressions = 0
+  for mode, by_scenario in sorted(results.items()):
+    for scenario, r in sorted(by_scenario.items()):
+      base = baseline.get(mode, {}).get(scenario)
+      if not base:
+        continue
+      for key in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request',
+                  'throughput_rps'):
+        if key not in r or not base.get(key):
+          continue
+        change = (r[key] - base[key]) / base[key]
+        # Lower is better, except for throughput.
+        worse = -change if key == 'throughput_rps' else change
+        flag = ''
+        if worse > tolerance:
+          flag = '  REGRESSION'
+          num_regressions += 1
+        print '%-5s %-13s %-20s %9.1f -> %9.1f (%+.0f%%)%s' % (
+            mode, scenario, key, base[key], r[key], 100 * change, flag)
+  return num_regressions
+
+
+def CreateUsers(cloud, num_users, num_instances):
+  """ Returns [(username, instance ids)], each user with its own account. """
+  users = []
+  for i in range(num_users):
+    username = 'load%d' % (i)
+    user = User.objects.create_user(username, '%s@example.com' % (username),
+                                    'pw')
+    iam_key_id = 'AKILOADTEST%09d' % (i)
+    models.IamCredentials.objects.create(user=user, iam_key_id=iam_key_id,
+                                         iam_key_secret='x' * 40)
+    users.append((username, cloud.AddInstances(region, iam_key_id,
+                                               num_instances)))
+  return users
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--mode', choices=['client', 'wsgi', 'both'],
+                      default='both')
+  parser.add_argument('--users', type=int, default=4)
+  parser.add_argument('--requests', type=int, default=100,
+                      help='requests per user')
+  parser.add_argument('--instances', type=int, default=50,
+                      help='workstations per user')
+  parser.add_argument('--setup_ms', type=float, default=200.0,
+                      help='latency of creating a Manager')
+  parser.add_argument('--call_ms', type=float, default=50.0,
+                      help='latency of an EC2 call')
+  parser.add_argument('--list_ms_per_instance', type=float, default=0.5)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--save', metavar='NAME')
+  parser.add_argument('--compare', metavar='NAME')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='allowed relative regression for --compare')
+  args = parser.parse_args()
+
+  setup_test_environment()
+  # A file rather than an in-memory sqlite database, so the WSGI server
+  # threads all see the same data.
+  db_file = None
+  if connection.vendor == 'sqlite':
+    db_file = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+    connection.settings_dict['TEST']['NAME'] = db_file.name
+  old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+  cloud = fake_backend.FakeCloud(
+      setup_secs=args.setup_ms / 1000.0, call_secs=args.call_ms / 1000.0,
+      list_secs_per_instance=args.list_ms_per_instance / 1000.0)
+  results = {}
+  try:
+    users = CreateUsers(cloud, args.users, args.instances)
+    modes = ['client', 'wsgi'] if args.mode == 'both' else [args.mode]
+    with fake_backend.Installed(cloud):
+      with override_settings(ALLOWED_HOSTS=['*']):
+        for mode in modes:
+          results[mode] = Run(mode, users, args)
+          Report(mode, results[mode])
+  finally:
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+    if db_file and os.path.exists(db_file.name):
+      os.remove(db_file.name)
+  print 'fake EC2 calls: %s' % (', '.join(
+      '%s %d' % (method, n) for method, n in sorted(cloud.num_calls.items())))
+
+  if args.save:
+    if not os.path.isdir(baseline_dir):
+      os.makedirs(baseline_dir)
+    path = os.path.join(baseline_dir, args.save + '.json')
+    with open(path, 'w') as f:
+      json.dump({'args': vars(args), 'results': results,
+                 'settings': settings.SETTINGS_MODULE,
+                 'database': connection.vendor}, f, indent=2, sort_keys=True)
+    print 'saved baseline %s' % (path)
+  if args.compare:
+    with open(os.path.join(baseline_dir, args.compare + '.json')) as f:
+      baseline = json.load(f)
+    if Compare(results, baseline['results'], args.tolerance):
+      sys.exit(1)
+  return
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,145 @@
+""" Start, stop or destroy many workstations with few EC2 round trips.
+
+Manager.StartInstance() and friends list every instance in the account to
+find the one they act on, so powering down 20 workstations one at a time
+costs 40 EC2 calls.  Run() instead looks all the requested instances up in a
+single DescribeInstances call, skips those already in the target state and
+acts on the rest with one batched StartInstances / StopInstances /
+TerminateInstances call.  EC2 fails a whole batch if any instance in it
+can't make the transition; the batch is then retried one instance at a time,
+at most WORKSTATION_BULK_PARALLELISM calls at once, so each instance gets
+its own result.  Per-instance calls that EC2 can't batch (clearing the
+termination protection before destroy) are made the same bounded-parallel
+way.
+"""
+
+from multiprocessing import pool as mp_pool
+
+from boto import exception
+from django.conf import settings
+
+import rate_limit
+
+
+actions = ('start', 'stop', 'destroy')
+
+# State each action leaves a workstation in right away, and states in which
+# there is nothing left for it to do.
+new_states = {'start': 'pending', 'stop': 'stopping',
+              'destroy': 'shutting-down'}
+done_states = {'start': ('pending', 'running'),
+               'stop': ('stopping', 'stopped'),
+               'destroy': ('shutting-down', 'terminated')}
+
+
+def GetParallelism():
+  return getattr(settings, 'WORKSTATION_BULK_PARALLELISM', 8)
+
+
+def Result(state=None, error=None):
+  """ Outcome for one instance: its state afterwards, or an error. """
+  return {'ok': error is None, 'state': state, 'error': error}
+
+
+def ErrorMessage(e):
+  if isinstance(e, exception.BotoServerError):
+    return e.error_message or e.reason or str(e)
+  return str(e) or e.__class__.__name__
+
+
+def ParallelMap(fn, items):
+  """ Returns [fn(item)] computing at most GetParallelism() items at once. """
+  if len(items) <= 1:
+    return [fn(item) for item in items]
+  pool = mp_pool.ThreadPool(processes=min(GetParallelism(), len(items)))
+  try:
+    return pool.map(fn, items)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def LookupWorkstations(manager, instance_ids):
+  """ Returns {id: boto instance} for those of the ids that are workstations
+  of this account, in one DescribeInstances call. """
+  reservations = manager.ec2.get_all_instances(
+      filters={'tag-key': manager.workstation_tag})
+  wanted = set(instance_ids)
+  found = {}
+  for reservation in reservations:
+    for instance in reservation.instances:
+      if instance.id in wanted and instance.state != 'terminated':
+        found[instance.id] = instance
+  return found
+
+
+def BatchCall(action, manager):
+  """ Returns the boto call for action taking a list of instance ids. """
+  return {'start': manager.ec2.start_instances,
+          'stop': manager.ec2.stop_instances,
+          'destroy': manager.ec2.terminate_instances}[action]
+
+
+def CallBatched(call, instance_ids, new_state):
+  """ Calls call(instance_ids) once, or once per id if EC2 rejects the batch,
+  and returns {id: Result}. """
+  try:
+    call(instance_ids)
+    return dict((i, Result(new_state)) for i in instance_ids)
+  except exception.BotoServerError as e:
+    # Retrying a throttled batch one by one would only make things worse.
+    if len(instance_ids) == 1 or e.error_code in rate_limit.THROTTLING_CODES:
+      raise
+
+  def CallOne(instance_id):
+    try:
+      call([instance_id])
+      return Result(new_state)
+    except exception.BotoServerError as e:
+      return Result(error=ErrorMessage(e))
+  return dict(zip(instance_ids, ParallelMap(CallOne, instance_ids)))
+
+
+def ClearTerminationProtection(instances):
+  """ Returns {id: error message} for the instances it failed on. """
+  def Clear(instance):
+    try:
+      instance.modify_attribute('disableApiTermination', False)
+      return None
+    except exception.BotoServerError as e:
+      return ErrorMessage(e)
+  errors = ParallelMap(Clear, instances)
+  return dict((i.id, e) for i, e in zip(instances, errors) if e)
+
+
+def Run(manager, action, instance_ids):
+  """ Applies action to the instances and returns {id: Result}.
+
+  Raises the BotoServerError if EC2 throttled the batch.
+  """
+  assert action in actions
+  results = {}
+  instances = LookupWorkstations(manager, instance_ids)
+  todo = []
+  for instance_id in instance_ids:
+    instance = instances.get(instance_id)
+    if instance is None:
+      results[instance_id] = Result(error='No such workstation.')
+    elif instance.state in done_states[action]:
+      results[instance_id] = Result(instance.state)
+    else:
+      todo.append(instance)
+  if action == 'destroy':
+    for instance_id, error in ClearTerminationProtection(todo).items():
+      results[instance_id] = Result(error=error)
+    todo = [i for i in todo if i.id not in results]
+  if todo:
+    try:
+      results.update(CallBatched(BatchCall(action, manager),
+                                 [i.id for i in todo], new_states[action]))
+    except exception.BotoServerError as e:
+      if e.error_code in rate_limit.THROTTLING_CODES:
+        raise  # ThrottledMiddleware answers with a 503
+      for instance in todo:
+        results[instance.id] = Result(error=ErrorMessage(e))
+  return results
@@ -0,0 +1,82 @@
+""" Cached AWS credential validation for the credentials setup flow.
+
+core.CredentialsValid() and the IAM user provisioning behind
+workstation.GetCirrusIamUserCredentials() are slow IAM/EC2 round trips, and
+users tend to resubmit the setup form or get bounced back to it repeatedly.
+Validation results are cached for a short time, failures included, under an
+HMAC of the key id and secret so the cache never holds the secret itself.
+
+Provisioning the IAM user, which may delete and recreate it, runs in a
+thread pool once the root credentials passed validation, so the view can
+give up on it after WORKSTATION_PROVISIONING_TIMEOUT_SECS.
+"""
+
+import hashlib
+import hmac
+import threading
+from multiprocessing import pool as mp_pool
+
+from cirruscluster import core
+from cirruscluster import workstation
+from django.conf import settings
+from django.core.cache import caches
+
+
+def GetCache():
+  return caches[getattr(settings, 'WORKSTATION_CREDENTIALS_CACHE', 'default')]
+
+
+def CacheKey(key_id, key_secret):
+  message = (u'%s:%s' % (key_id, key_secret)).encode('utf-8')
+  digest = hmac.new(settings.SECRET_KEY.encode('utf-8'), message,
+                    hashlib.sha256).hexdigest()
+  return 'awscred:%s' % (digest)
+
+
+def RecordResult(key_id, key_secret, valid):
+  if valid:
+    ttl = getattr(settings, 'WORKSTATION_CREDENTIALS_VALID_TTL', 300)
+  else:
+    ttl = getattr(settings, 'WORKSTATION_CREDENTIALS_INVALID_TTL', 60)
+  GetCache().set(CacheKey(key_id, key_secret), valid, ttl)
+  return
+
+
+def KnownInvalid(key_id, key_secret):
+  """ True if the credentials recently failed validation. """
+  return GetCache().get(CacheKey(key_id, key_secret)) is False
+
+
+def CredentialsValid(key_id, key_secret):
+  """ core.CredentialsValid() with its result cached. """
+  valid = GetCache().get(CacheKey(key_id, key_secret))
+  if valid is None:
+    valid = core.CredentialsValid(key_id, key_secret)
+    RecordResult(key_id, key_secret, valid)
+  return valid
+
+
+pool = None
+pool_lock = threading.Lock()
+
+def GetPool():
+  global pool
+  with pool_lock:
+    if pool is None:
+      pool = mp_pool.ThreadPool(
+          processes=getattr(settings, 'WORKSTATION_CREDENTIALS_WORKERS', 4))
+  return pool
+
+
+def ProvisionIamUser(root_key_id, root_key_secret):
+  """ Returns (iam key id, iam key secret), creating the IAM user if needed. """
+  iam_key_id, iam_key_secret = workstation.GetCirrusIamUserCredentials(
+      root_key_id, root_key_secret)
+  RecordResult(iam_key_id, iam_key_secret, True)
+  return iam_key_id, iam_key_secret
+
+
+def StartProvisioning(root_key_id, root_key_secret):
+  """ Runs ProvisionIamUser in the background; call .get() on the result. """
+  return GetPool().apply_async(ProvisionIamUser,
+                               (root_key_id, root_key_secret))
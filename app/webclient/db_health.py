@@ -0,0 +1,39 @@
+""" Health checks for persistent database connections.
+
+With CONN_MAX_AGE set, a worker keeps its MySQL connection between requests.
+Django only checks such a connection after an error, so one that the server
+dropped while it sat idle (wait_timeout, a failover) fails the next request
+with "MySQL server has gone away".  ConnectionHealthMiddleware pings
+connections that have been idle longer than WORKSTATION_DB_HEALTH_CHECK_SECS
+before the view runs and closes the dead ones, so Django reconnects
+transparently.  Connections in active use are never pinged.
+"""
+
+import time
+
+from django.conf import settings
+from django.db import connections
+
+
+def CheckConnections(max_idle_secs):
+  """ Closes connections idle for more than max_idle_secs that fail a ping. """
+  now = time.time()
+  for connection in connections.all():
+    if connection.connection is None:
+      continue
+    last_used = getattr(connection, 'last_request_end', now)
+    if now - last_used > max_idle_secs and not connection.is_usable():
+      connection.close()
+  return
+
+
+class ConnectionHealthMiddleware(object):
+  def process_request(self, request):
+    CheckConnections(getattr(settings, 'WORKSTATION_DB_HEALTH_CHECK_SECS', 30))
+    return None
+
+  def process_response(self, request, response):
+    now = time.time()
+    for connection in connections.all():
+      connection.last_request_end = now
+    return response
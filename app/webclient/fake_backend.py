@@ -0,0 +1,189 @@
+""" In-memory stand-in for workstation.Manager and the AWS credential checks.
+
+Lets the webclient run, and be load tested, without an AWS account.  A
+FakeCloud holds the instances of every (region, iam key id) and FakeManagers
+created against it operate on those, sleeping to simulate EC2 round trips:
+
+  cloud = fake_backend.FakeCloud(setup_secs=0.2, call_secs=0.05)
+  cloud.AddInstances('us-east-1', key_id, 100)
+  with fake_backend.Installed(cloud):
+    ...  # views now use FakeManagers from a fresh manager pool
+
+Latencies are drawn uniformly from [secs * (1 - jitter), secs * (1 + jitter)].
+"""
+
+import contextlib
+import random
+import threading
+import time
+
+from cirruscluster import core
+from cirruscluster import workstation
+
+import manager_pool
+import profiling
+
+
+class FakeInstanceInfo(object):
+  def __init__(self, id, name, state, hostname, instance_type, root_size_gb):
+    self.id = id
+    self.name = name
+    self.state = state
+    self.hostname = hostname
+    self.instance_type = instance_type
+    self.root_size_gb = root_size_gb
+    return
+
+
+class FakeCloud(object):
+  """ Instances of all accounts and the simulated EC2 latencies. """
+
+  def __init__(self, setup_secs=0.0, call_secs=0.0, list_secs_per_instance=0.0,
+               jitter=0.25):
+    self.setup_secs = setup_secs
+    self.call_secs = call_secs
+    self.list_secs_per_instance = list_secs_per_instance
+    self.jitter = jitter
+    self.lock = threading.Lock()
+    self.instances = {}  # (region, iam key id) -> {instance id: info}
+    self.num_calls = {}  # Manager method name -> number of calls
+    self.next_id = 0x1000
+    return
+
+  def AddInstance(self, region, iam_key_id, name, state='running',
+                  instance_type='c1.xlarge'):
+    with self.lock:
+      instance_id = 'i-%08x' % (self.next_id)
+      self.next_id += 1
+      hostname = ''
+      if state == 'running':
+        hostname = 'ec2-%s.compute-1.amazonaws.com' % (instance_id[2:])
+      info = FakeInstanceInfo(instance_id, name, state, hostname,
+                              instance_type, 30)
+      self.instances.setdefault((region, iam_key_id), {})[instance_id] = info
+    return instance_id
+
+  def AddInstances(self, region, iam_key_id, count, stopped_fraction=0.3):
+    """ Adds count workstations, about stopped_fraction of them stopped. """
+    rng = random.Random(count)
+    return [self.AddInstance(region, iam_key_id, 'workstation_%d' % (i),
+                             'stopped' if rng.random() < stopped_fraction
+                             else 'running')
+            for i in range(count)]
+
+  def Sleep(self, secs):
+    if secs > 0:
+      time.sleep(secs * random.uniform(1 - self.jitter, 1 + self.jitter))
+    return
+
+  def Count(self, method):
+    with self.lock:
+      self.num_calls[method] = self.num_calls.get(method, 0) + 1
+    return
+
+  def Instances(self, region, iam_key_id):
+    with self.lock:
+      return self.instances.setdefault((region, iam_key_id), {})
+
+  def CredentialsValid(self, key_id, key_secret):
+    self.Count('CredentialsValid')
+    self.Sleep(self.call_secs)
+    return bool(key_id) and bool(key_secret)
+
+  def GetCirrusIamUserCredentials(self, root_key_id, root_key_secret):
+    self.Count('GetCirrusIamUserCredentials')
+    self.Sleep(self.setup_secs)
+    if not self.CredentialsValid(root_key_id, root_key_secret):
+      raise workstation.InvalidAwsCredentials()
+    return 'AKIFAKE%s' % (root_key_id[-13:]), 'fake-secret-' + root_key_id
+
+
+class FakeManager(object):
+  """ The subset of workstation.Manager that the webclient uses. """
+
+  def __init__(self, cloud, region_name, iam_aws_id, iam_aws_secret):
+    self.cloud = cloud
+    self.region_name = region_name
+    self.iam_aws_id = iam_aws_id
+    cloud.Count('__init__')
+    cloud.Sleep(cloud.setup_secs)
+    return
+
+  def __Call(self, method, secs=None):
+    self.cloud.Count(method)
+    self.cloud.Sleep(self.cloud.call_secs if secs is None else secs)
+    return self.cloud.Instances(self.region_name, self.iam_aws_id)
+
+  def __Get(self, instances, instance_id):
+    if instance_id not in instances:
+      raise RuntimeError('no such instance: %s' % (instance_id))
+    return instances[instance_id]
+
+  def ListInstances(self):
+    instances = self.cloud.Instances(self.region_name, self.iam_aws_id)
+    self.__Call('ListInstances', self.cloud.call_secs +
+                len(instances) * self.cloud.list_secs_per_instance)
+    return sorted(instances.values(), key=lambda info: info.id)
+
+  def GetInstanceInfo(self, instance_id):
+    return self.__Get(self.__Call('GetInstanceInfo'), instance_id)
+
+  def StartInstance(self, instance_id):
+    info = self.__Get(self.__Call('StartInstance'), instance_id)
+    info.state = 'running'
+    info.hostname = 'ec2-%s.compute-1.amazonaws.com' % (instance_id[2:])
+    return
+
+  def StopInstance(self, instance_id):
+    info = self.__Get(self.__Call('StopInstance'), instance_id)
+    info.state = 'stopped'
+    info.hostname = ''
+    return
+
+  def TerminateInstance(self, instance_id):
+    instances = self.__Call('TerminateInstance')
+    self.__Get(instances, instance_id)
+    with self.cloud.lock:
+      del instances[instance_id]
+    return
+
+  def CreateInstance(self, name, instance_type, ubuntu_release_name,
+                     mapr_version, ami_release_name, ami_owner_id):
+    self.__Call('CreateInstance', self.cloud.setup_secs)
+    return self.cloud.AddInstance(self.region_name, self.iam_aws_id, name,
+                                  instance_type=instance_type)
+
+  def ResizeRootVolumeOfInstance(self, instance_id, new_size_gb):
+    info = self.__Get(self.__Call('ResizeRootVolumeOfInstance'), instance_id)
+    info.root_size_gb = new_size_gb
+    return
+
+  def CreateRemoteSessionConfig(self, instance_id):
+    info = self.__Get(self.__Call('CreateRemoteSessionConfig'), instance_id)
+    return ('<!DOCTYPE NXClientSettings>\n<NXClientSettings>\n'
+            '<option key="Server host" value="%s" />\n'
+            '</NXClientSettings>\n' % (info.hostname))
+
+
+def Factory(cloud):
+  """ A manager_pool factory that creates FakeManagers on cloud. """
+  def Create(region_name, iam_aws_id, iam_aws_secret):
+    return FakeManager(cloud, region_name, iam_aws_id, iam_aws_secret)
+  return Create
+
+
+@contextlib.contextmanager
+def Installed(cloud, pool_size=50):
+  """ Routes Managers and credential checks to cloud within the block. """
+  saved = (manager_pool.manager_pool, core.CredentialsValid,
+           workstation.GetCirrusIamUserCredentials)
+  manager_pool.manager_pool = manager_pool.ManagerPool(
+      max_size=pool_size,
+      factory=profiling.TimedManagerFactory(Factory(cloud)))
+  core.CredentialsValid = cloud.CredentialsValid
+  workstation.GetCirrusIamUserCredentials = cloud.GetCirrusIamUserCredentials
+  try:
+    yield cloud
+  finally:
+    (manager_pool.manager_pool, core.CredentialsValid,
+     workstation.GetCirrusIamUserCredentials) = saved
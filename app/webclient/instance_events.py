@@ -0,0 +1,233 @@
+""" Shared per-account pollers that push instance state transitions.
+
+Every viewer of the workstations page used to poll EC2 on its own, so N open
+tabs on one account meant N ListInstances calls per period.  Instead, one
+AccountPoller thread per (region, iam_key_id) lists the instances, diffs
+successive snapshots and fans out only the transitions (e.g. pending ->
+running) to its subscribers.  It polls quickly while some instance is in flux
+and backs off towards a slow period while nothing changes, so EC2 calls per
+account are bounded regardless of the number of viewers.
+
+Each poll is an inventory.Refresh(), incremental where possible, and also
+refreshes the inventory cache, so plain page loads and the JSON api benefit
+from it too.  A poller exits once its last subscriber leaves.
+"""
+
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+
+import inventory
+import manager_pool
+import session_configs
+
+transitional_states = inventory.transitional_states
+
+
+def DiffSnapshots(old, new):
+  """ Returns the transitions between two inventory snapshots.
+
+  Each transition is a dict with the instance id, name, hostname and its
+  'from' and 'to' states. Added instances come from None, removed ones go to
+  'terminated'.
+  """
+  old_by_id = dict((i['id'], i) for i in old)
+  transitions = []
+  for instance in new:
+    previous = old_by_id.pop(instance['id'], None)
+    from_state = previous['state'] if previous else None
+    if previous == instance:
+      continue
+    transitions.append({'id': instance['id'],
+                        'name': instance['name'],
+                        'hostname': instance['hostname'],
+                        'from': from_state,
+                        'to': instance['state']})
+  for instance in old_by_id.values():
+    transitions.append({'id': instance['id'],
+                        'name': instance['name'],
+                        'hostname': '',
+                        'from': instance['state'],
+                        'to': 'terminated'})
+  return transitions
+
+
+def InFlux(snapshot):
+  return any(i['state'] in transitional_states for i in snapshot)
+
+
+class AccountPoller(threading.Thread):
+  """ Polls ListInstances for one account and fans out the transitions.
+
+  Subscribers receive ('snapshot', instances) once on subscribing and
+  ('transition', transition) for every later change.
+  """
+
+  def __init__(self, region, iam_key_id, iam_key_secret, fast_secs, slow_secs,
+               max_queue_size=100):
+    super(AccountPoller, self).__init__(name='poller-%s-%s' % (region,
+                                                               iam_key_id))
+    self.daemon = True
+    self.region = region
+    self.iam_key_id = iam_key_id
+    self.iam_key_secret = iam_key_secret
+    self.fast_secs = fast_secs
+    self.slow_secs = slow_secs
+    self.max_queue_size = max_queue_size
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.subscribers = set()
+    self.snapshot = None
+    self.num_polls = 0
+    self.stopped = False
+    return
+
+  def Subscribe(self):
+    """ Returns a Queue of events. Returns None if the poller has exited. """
+    queue = Queue.Queue(maxsize=self.max_queue_size)
+    with self.lock:
+      if self.stopped:
+        return None
+      self.subscribers.add(queue)
+      if self.snapshot is not None:
+        queue.put(('snapshot', self.snapshot))
+    return queue
+
+  def Unsubscribe(self, queue):
+    with self.lock:
+      self.subscribers.discard(queue)
+    self.wake.set()
+    return
+
+  def Poke(self):
+    """ Polls again right away, e.g. after the user changed an instance. """
+    self.wake.set()
+    return
+
+  def run(self):
+    interval = self.fast_secs
+    while True:
+      with self.lock:
+        if not self.subscribers:
+          self.stopped = True
+          return
+      try:
+        self.__Poll()
+        if InFlux(self.snapshot):
+          interval = self.fast_secs
+        else:
+          interval = min(interval * 2, self.slow_secs)
+      except Exception:
+        logging.exception('Polling instances of %s failed', self.iam_key_id)
+        interval = self.slow_secs
+      self.wake.wait(interval)
+      if self.wake.is_set():
+        interval = self.fast_secs
+        self.wake.clear()
+
+  def __Poll(self):
+    pool = manager_pool.GetManagerPool()
+    with pool.Checkout(self.region, self.iam_key_id,
+                       self.iam_key_secret) as manager:
+      snapshot = inventory.Refresh(self.iam_key_id, self.region, manager)
+    self.num_polls += 1
+    with self.lock:
+      if self.snapshot is None:
+        events = [('snapshot', snapshot)]
+      else:
+        events = [('transition', t)
+                  for t in DiffSnapshots(self.snapshot, snapshot)]
+      self.snapshot = snapshot
+      for queue in self.subscribers:
+        for event in events:
+          try:
+            queue.put_nowait(event)
+          except Queue.Full:
+            pass  # a stalled subscriber resyncs from the next snapshot
+    self.__UpdateSessionConfigs(events)
+    return
+
+  def __UpdateSessionConfigs(self, events):
+    """ Prefetches configs of newly running instances, evicts stopped ones. """
+    for event_type, data in events:
+      if event_type == 'snapshot':
+        instances = data
+      else:
+        instances = [{'id': data['id'], 'name': data['name'],
+                      'state': data['to'], 'hostname': data['hostname']}]
+      for instance in instances:
+        if instance['state'] == 'running' and instance['hostname']:
+          session_configs.Prefetch(self.region, self.iam_key_id,
+                                   self.iam_key_secret, instance)
+        elif instance['state'] != 'running':
+          session_configs.Evict(instance['id'])
+    return
+
+
+pollers = {}
+pollers_lock = threading.Lock()
+
+def Subscribe(region, iam_key_id, iam_key_secret):
+  """ Subscribes to the shared poller of an account, starting it if needed.
+
+  Returns (poller, queue); pass both to Unsubscribe when done.
+  """
+  key = (region, iam_key_id)
+  with pollers_lock:
+    while True:
+      poller = pollers.get(key)
+      if not poller or poller.stopped:
+        poller = AccountPoller(
+            region, iam_key_id, iam_key_secret,
+            getattr(settings, 'WORKSTATION_POLL_FAST_SECS', 5),
+            getattr(settings, 'WORKSTATION_POLL_SLOW_SECS', 60))
+        pollers[key] = poller
+      poller.iam_key_secret = iam_key_secret
+      queue = poller.Subscribe()
+      if queue is not None:
+        break
+    if not poller.is_alive():
+      poller.start()
+  return poller, queue
+
+
+def Unsubscribe(poller, queue):
+  poller.Unsubscribe(queue)
+  return
+
+
+num_streams = 0  # event streams open in this process
+streams_lock = threading.Lock()
+
+def OpenStream():
+  """ Takes one of the WORKSTATION_EVENTS_MAX_STREAMS event stream slots of
+  this process, returns False if they are all taken.
+
+  Every open stream holds a worker thread for its whole length, the cap
+  leaves the other threads to ordinary requests.  Pass to CloseStream once
+  the stream ends.
+  """
+  global num_streams
+  with streams_lock:
+    if num_streams >= getattr(settings, 'WORKSTATION_EVENTS_MAX_STREAMS', 4):
+      return False
+    num_streams += 1
+  return True
+
+
+def CloseStream():
+  global num_streams
+  with streams_lock:
+    num_streams -= 1
+  return
+
+
+def Poke(region, iam_key_id):
+  """ Makes the account's poller, if any, poll again right away. """
+  with pollers_lock:
+    poller = pollers.get((region, iam_key_id))
+  if poller:
+    poller.Poke()
+  return
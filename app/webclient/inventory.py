@@ -0,0 +1,411 @@
+""" Per-user cache of the workstation inventory.
+
+Manager.ListInstances() is a full EC2 describe call and the workstations page
+is reloaded every few seconds by every open browser tab.  The listing only
+needs to be recent, so a snapshot of it is kept in a Django cache keyed by IAM
+key id and region.  Views that change an instance patch or invalidate the
+cached entry so the listing stays correct between refreshes.
+
+The cache alias, entry TTL and eviction bound come from settings
+(WORKSTATION_INVENTORY_CACHE, WORKSTATION_INVENTORY_TTL and the MAX_ENTRIES
+option of that cache), so locmem can be used for tests and a shared backend
+like memcached across worker processes.
+
+ListAllInstances() lists several regions at once on a shared thread pool, so
+a page covering all of WORKSTATION_REGIONS takes as long as the slowest
+region rather than the sum of all of them.  A region that fails or takes
+longer than WORKSTATION_REGION_TIMEOUT_SECS is reported instead of failing
+the whole listing.
+
+With WORKSTATION_INVENTORY_INCREMENTAL, a refresh does not list every
+instance again.  The last snapshot of each account and region is kept (for
+up to WORKSTATION_INVENTORY_FULL_SYNC_SECS) and EC2 is only asked, by
+filters, for the instances that are in a transitional state or were in one
+at the last refresh; their changes are merged into the snapshot.  This
+covers launches (pending), the actions of the webclient and most changes
+made elsewhere, the periodic full listing catches the rest, as does
+Invalidate().  ListChanged() queries EC2 directly, relying on the internals
+manager.ec2 (the boto connection) and manager.workstation_tag of
+cirruscluster's workstation.Manager; Managers without an ec2 connection are
+always listed in full.
+
+Every stored snapshot is diffed against the previous one into a versioned
+change log, so clients can ask for what changed since the version they have
+(Changes()) instead of fetching the whole inventory again.  The log is
+updated under a short cache lock, so concurrent refreshes and patches of one
+account and region do not lose each other's changes.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from multiprocessing import pool as mp_pool
+
+from cirruscluster import workstation
+from django.conf import settings
+from django.core.cache import caches
+
+
+def GetCache():
+  return caches[getattr(settings, 'WORKSTATION_INVENTORY_CACHE', 'default')]
+
+
+def GetTtl():
+  return getattr(settings, 'WORKSTATION_INVENTORY_TTL', 30)
+
+
+def GetRegionTimeout():
+  return getattr(settings, 'WORKSTATION_REGION_TIMEOUT_SECS', 10)
+
+
+pool = None
+pool_lock = threading.Lock()
+
+def GetPool():
+  global pool
+  with pool_lock:
+    if pool is None:
+      pool = mp_pool.ThreadPool(
+          processes=getattr(settings, 'WORKSTATION_REGION_WORKERS', 8))
+  return pool
+
+
+def CacheKey(iam_key_id, region):
+  return 'inventory:%s:%s' % (region, iam_key_id)
+
+
+def StateKey(iam_key_id, region):
+  return 'inventory_state:%s:%s' % (region, iam_key_id)
+
+
+# EC2 states an instance only passes through on its way to a stable state.
+transitional_states = frozenset(['pending', 'stopping', 'shutting-down',
+                                 'rebooting'])
+
+
+def Snapshot(instance_infos):
+  """ Converts workstation.InstanceInfo objects to plain picklable dicts. """
+  snapshot = []
+  for info in instance_infos:
+    snapshot.append({'id': info.id,
+                     'name': info.name,
+                     'state': info.state,
+                     'hostname': info.hostname})
+  return snapshot
+
+
+def SnapshotOfEc2Instance(instance):
+  return {'id': instance.id,
+          'name': instance.tags['Name'],
+          'state': instance.state,
+          'hostname': instance.public_dns_name}
+
+
+def Etag(instances):
+  """ Returns a fingerprint of a snapshot, for conditional GETs. """
+  return hashlib.md5(json.dumps(instances, sort_keys=True)).hexdigest()
+
+
+def ListInstances(iam_key_id, region, checkout_manager):
+  """ Returns the cached instance snapshot, listing it from EC2 on a miss.
+
+  checkout_manager returns a context manager yielding a Manager and is only
+  called on a miss.
+  """
+  instances = GetCache().get(CacheKey(iam_key_id, region))
+  if instances is None:
+    with checkout_manager() as manager:
+      instances = Refresh(iam_key_id, region, manager)
+  return instances
+
+
+def Refresh(iam_key_id, region, manager):
+  """ Lists the instances from EC2, incrementally if possible, and stores
+  and returns the new snapshot. """
+  state = GetCache().get(StateKey(iam_key_id, region))
+  full_sync_secs = getattr(settings, 'WORKSTATION_INVENTORY_FULL_SYNC_SECS',
+                           300)
+  if (getattr(settings, 'WORKSTATION_INVENTORY_INCREMENTAL', True) and
+      state and time.time() - state['full_synced'] < full_sync_secs and
+      getattr(manager, 'ec2', None) is not None):
+    changed = ListChanged(manager, state['instances'])
+    # Merged into the state as of storing, which may have changed meanwhile.
+    instances = StoreUpdate(
+        iam_key_id, region,
+        lambda current: MergeChanges((current or state)['instances'], changed),
+        full=False)
+  else:
+    instances = Snapshot(manager.ListInstances())
+    Store(iam_key_id, region, instances, full=True)
+  return instances
+
+
+def ListChanged(manager, instances):
+  """ Returns {id: instance snapshot, or None if gone} for the workstations
+  in a transitional state now or in instances. """
+  tag = manager.workstation_tag
+  queries = [{'tag-key': tag, 'instance-state-name': list(transitional_states)}]
+  in_flux = [i['id'] for i in instances if i['state'] in transitional_states]
+  if in_flux:
+    queries.append({'tag-key': tag, 'instance-id': in_flux})
+  changed = dict((instance_id, None) for instance_id in in_flux)
+  for filters in queries:
+    for reservation in manager.ec2.get_all_instances(filters=filters):
+      for instance in reservation.instances:
+        if instance.state == 'terminated' or 'Name' not in instance.tags:
+          continue
+        changed[instance.id] = SnapshotOfEc2Instance(instance)
+  return changed
+
+
+def MergeChanges(instances, changed):
+  """ Applies ListChanged() results to a snapshot. """
+  changed = dict(changed)
+  merged = []
+  for instance in instances:
+    if instance['id'] not in changed:
+      merged.append(instance)
+      continue
+    update = changed.pop(instance['id'])
+    if update is not None:
+      merged.append(update)
+  merged.extend(i for _, i in sorted(changed.items()) if i is not None)
+  return merged
+
+
+def UpdateState(iam_key_id, region, update):
+  """ Replaces the cached state with update(state), under a cache lock.
+
+  update() gets None if there is no state and may return None to leave it
+  alone.  Like rate_limit.TokenBucket, the update goes ahead without the
+  lock if that cannot be had quickly, e.g. after its holder died.
+  """
+  cache = GetCache()
+  state_key = StateKey(iam_key_id, region)
+  lock_key = state_key + ':lock'
+  token = uuid.uuid4().hex
+  locked = False
+  for _ in range(100):
+    locked = cache.add(lock_key, token, 5)
+    if locked:
+      break
+    time.sleep(0.01)
+  try:
+    state = update(cache.get(state_key))
+    if state is not None:
+      cache.set(state_key, state, 3600)
+  finally:
+    if locked and cache.get(lock_key) == token:
+      cache.delete(lock_key)
+  return
+
+
+def Store(iam_key_id, region, instances, full):
+  """ Caches a new snapshot and logs its changes against the previous one. """
+  StoreUpdate(iam_key_id, region, lambda state: instances, full)
+  return
+
+
+def StoreUpdate(iam_key_id, region, update, full):
+  """ Like Store, of the snapshot update(state) returns under the state lock.
+
+  update() gets the current state, or None, so that it can build on the
+  snapshot without losing concurrent changes to it, and may return None to
+  store nothing.  Returns the stored snapshot, or None.
+  """
+  stored = []
+  def Update(state):
+    instances = update(state)
+    if instances is None:
+      return None
+    state = state or {'epoch': uuid.uuid4().hex[:8], 'version': 0,
+                      'full_synced': 0, 'instances': [], 'log': []}
+    old_by_id = dict((i['id'], i) for i in state['instances'])
+    changed_ids = []
+    for instance in instances:
+      if old_by_id.pop(instance['id'], None) != instance:
+        changed_ids.append(instance['id'])
+    changed_ids.extend(sorted(old_by_id))  # removed
+    if changed_ids:
+      state['version'] += 1
+      state['log'].extend((state['version'], i) for i in changed_ids)
+      max_log = getattr(settings, 'WORKSTATION_INVENTORY_CHANGE_LOG_SIZE', 500)
+      del state['log'][:-max_log]
+    if full:
+      state['full_synced'] = time.time()
+    state['instances'] = instances
+    GetCache().set(CacheKey(iam_key_id, region), instances, GetTtl())
+    stored.append(instances)
+    return state
+  UpdateState(iam_key_id, region, Update)
+  return stored[0] if stored else None
+
+
+def Cursor(iam_key_id, region):
+  """ Identifies the current snapshot version, for Changes(). """
+  state = GetCache().get(StateKey(iam_key_id, region))
+  if not state:
+    return ''
+  return '%s.%d' % (state['epoch'], state['version'])
+
+
+def Changes(iam_key_id, region, cursor):
+  """ Returns (cursor, changed instances, removed ids) since cursor, or None
+  if that is no longer covered by the change log.
+
+  The epoch in a cursor changes when the state is lost from the cache, so
+  versions of an earlier state are never mistaken for current ones.
+  """
+  state = GetCache().get(StateKey(iam_key_id, region))
+  try:
+    epoch, since = cursor.split('.')
+    since = int(since)
+  except ValueError:
+    return None
+  if not state or epoch != state['epoch'] or since > state['version']:
+    return None
+  if since < state['version'] and (not state['log'] or
+                                   state['log'][0][0] > since + 1):
+    return None
+  ids = set(i for version, i in state['log'] if version > since)
+  by_id = dict((i['id'], i) for i in state['instances'])
+  changed = [by_id[i] for i in sorted(ids) if i in by_id]
+  removed = sorted(i for i in ids if i not in by_id)
+  return '%s.%d' % (state['epoch'], state['version']), changed, removed
+
+
+class RegionListing(object):
+  """ ListInstances() of one region as a pool task, noting when it started. """
+
+  def __init__(self, iam_key_id, region, checkout_manager):
+    self.iam_key_id = iam_key_id
+    self.region = region
+    self.checkout_manager = checkout_manager
+    self.started = threading.Event()
+    self.start_time = None
+    return
+
+  def __call__(self):
+    self.start_time = time.time()
+    self.started.set()
+    return ListInstances(self.iam_key_id, self.region,
+                         lambda: self.checkout_manager(self.region))
+
+
+def ListAllInstances(iam_key_id, regions, checkout_manager, timeout=None):
+  """ Lists the instances of several regions concurrently.
+
+  checkout_manager(region) returns a context manager yielding a Manager for 
+  that region.  Returns (instances, errors): the instances of all regions 
+  that answered within timeout seconds, each with its 'region' added, and 
+  {region: error message} for the others.  A region that times out keeps 
+  listing in the background and fills the cache for the next request.  
+  workstation.InvalidAwsCredentials is raised rather than reported.
+
+  The timeout of a region counts from when its listing gets a pool thread,
+  so regions queued behind busy threads are not failed for the wait; a
+  region that gets no thread within timeout seconds fails too.
+  """
+  if timeout is None:
+    timeout = GetRegionTimeout()
+  pending = []
+  for region in regions:
+    listing = RegionListing(iam_key_id, region, checkout_manager)
+    pending.append((region, listing, GetPool().apply_async(listing)))
+  submitted = time.time()
+  instances = []
+  errors = {}
+  for region, listing, result in pending:
+    try:
+      if not listing.started.wait(max(submitted + timeout - time.time(), 0)):
+        raise mp_pool.TimeoutError()
+      region_instances = result.get(
+          max(listing.start_time + timeout - time.time(), 0))
+    except mp_pool.TimeoutError:
+      errors[region] = 'Timed out listing workstations.'
+      continue
+    except workstation.InvalidAwsCredentials:
+      raise
+    except Exception as e:
+      logging.exception('Listing workstations in %s failed', region)
+      errors[region] = 'Failed to list workstations: %s' % (e)
+      continue
+    for instance in region_instances:
+      instance = dict(instance)
+      instance['region'] = region
+      instances.append(instance)
+  return instances, errors
+
+
+def AllCursor(iam_key_id, regions):
+  """ Cursor() of several regions, for AllChanges(). """
+  return ','.join('%s:%s' % (region, Cursor(iam_key_id, region))
+                  for region in sorted(regions))
+
+
+def AllChanges(iam_key_id, regions, cursor):
+  """ Changes() of several regions since an AllCursor().
+
+  Returns (cursor, changed instances, removed [{'id', 'region'}]), instances
+  with their 'region' added, or None if any region is not covered.
+  """
+  try:
+    cursors = dict(part.split(':', 1) for part in cursor.split(',') if part)
+  except ValueError:
+    return None
+  if set(cursors) != set(regions):
+    return None
+  new_cursors = []
+  changed = []
+  removed = []
+  for region in sorted(regions):
+    changes = Changes(iam_key_id, region, cursors[region])
+    if changes is None:
+      return None
+    region_cursor, region_changed, region_removed = changes
+    new_cursors.append('%s:%s' % (region, region_cursor))
+    changed.extend(dict(instance, region=region) for instance in region_changed)
+    removed.extend({'id': i, 'region': region} for i in region_removed)
+  return ','.join(new_cursors), changed, removed
+
+
+def FindInstance(iam_key_id, region, instance_id):
+  """ Returns an instance from the cached snapshot without listing on a miss. """
+  for instance in GetCache().get(CacheKey(iam_key_id, region)) or []:
+    if instance['id'] == instance_id:
+      return instance
+  return None
+
+
+def Invalidate(iam_key_id, region):
+  """ Drops the cached snapshot; the next refresh lists everything. """
+  GetCache().delete(CacheKey(iam_key_id, region))
+  def Update(state):
+    if state:
+      state['full_synced'] = 0
+    return state
+  UpdateState(iam_key_id, region, Update)
+  return
+
+
+def SetInstanceState(iam_key_id, region, instance_id, state):
+  """ Patches the state of one instance in the cached snapshot, if present. """
+  def Patch(current):
+    # Read under the state lock, so no concurrent Store is lost.
+    instances = GetCache().get(CacheKey(iam_key_id, region))
+    if instances is None:
+      return None
+    patched = []
+    for instance in instances:
+      if instance['id'] == instance_id:
+        instance = dict(instance, state=state)
+        # A hostname is only assigned while running.
+        if state != 'running':
+          instance['hostname'] = ''
+      patched.append(instance)
+    return patched
+  StoreUpdate(iam_key_id, region, Patch, full=False)
+  return
@@ -0,0 +1,220 @@
+""" Background jobs for long-running workstation operations.
+
+Creating a workstation, resizing its root volume or terminating it can take
+minutes of EC2 calls.  Instead of tying up a WSGI worker, views persist a
+models.Job and hand its id to an executor; a runner then does the work with a
+pooled Manager and records the outcome on the Job row.
+
+The executor is picked by settings.WORKSTATION_JOB_EXECUTOR:
+  'local'  - a bounded in-process thread pool (default)
+  'inline' - runs jobs synchronously in the caller, for tests
+
+Jobs of the local executor die with their worker process, so the workers
+running them must not be recycled (see the uwsgi options in
+ansible/templates/supervisor.ini).  RecoverJobs(), run at startup, requeues
+the queued jobs a process left behind and fails the ones stuck running.
+"""
+
+import datetime
+import json
+import logging
+import threading
+import traceback
+from multiprocessing import pool as mp_pool
+
+from django import db
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+import inventory
+import manager_pool
+import models
+import single_flight
+
+
+class CreateWorkstationRunner():
+  def __init__(self, manager, name, instance_type, ubuntu_release_name,
+               mapr_version, ami_release_name, ami_owner_id):
+    self.manager = manager
+    self.name = name
+    self.instance_type = instance_type
+    self.ubuntu_release_name = ubuntu_release_name
+    self.mapr_version = mapr_version
+    self.ami_release_name = ami_release_name
+    self.ami_owner_id = ami_owner_id
+    return
+
+  def __call__(self):
+    self.manager.CreateInstance(self.name, self.instance_type,
+                                self.ubuntu_release_name,
+                                self.mapr_version, self.ami_release_name,
+                                self.ami_owner_id)
+    return
+
+
+class ResizeRootVolumeRunner():
+  def __init__(self, manager, instance_id, new_size_gb):
+    self.manager = manager
+    self.instance_id = instance_id
+    self.new_size_gb = new_size_gb
+    return
+
+  def __call__(self):
+    self.manager.ResizeRootVolumeOfInstance(self.instance_id, self.new_size_gb)
+    return
+
+
+class TerminateInstanceRunner():
+  def __init__(self, manager, instance_id):
+    self.manager = manager
+    self.instance_id = instance_id
+    return
+
+  def __call__(self):
+    self.manager.TerminateInstance(self.instance_id)
+    return
+
+
+runners = {
+  'create_workstation': CreateWorkstationRunner,
+  'resize_root_volume': ResizeRootVolumeRunner,
+  'terminate_instance': TerminateInstanceRunner,
+}
+
+
+class InlineExecutor(object):
+  """ Runs each job synchronously in the submitting thread. """
+
+  def Submit(self, job_id):
+    RunJob(job_id)
+    return
+
+
+class LocalExecutor(object):
+  """ Runs jobs on a fixed number of in-process worker threads. """
+
+  def __init__(self, num_workers):
+    self.pool = mp_pool.ThreadPool(processes=num_workers)
+    return
+
+  def Submit(self, job_id):
+    self.pool.apply_async(_RunJobInWorker, (job_id,))
+    return
+
+
+def _RunJobInWorker(job_id):
+  try:
+    RunJob(job_id)
+  except Exception:
+    # apply_async would keep the error to itself.
+    logging.exception('Running job %s failed', job_id)
+  finally:
+    # Worker threads each hold their own DB connection, don't leak it.
+    db.connection.close()
+  return
+
+
+executor = None
+executor_lock = threading.Lock()
+
+def GetExecutor():
+  global executor
+  if not executor:
+    with executor_lock:
+      if not executor:
+        kind = getattr(settings, 'WORKSTATION_JOB_EXECUTOR', 'local')
+        if kind == 'inline':
+          executor = InlineExecutor()
+        elif kind == 'local':
+          executor = LocalExecutor(
+              getattr(settings, 'WORKSTATION_JOB_WORKERS', 4))
+        else:
+          raise ValueError('Unknown WORKSTATION_JOB_EXECUTOR: %s' % (kind))
+  return executor
+
+
+def Submit(user, kind, region, instance_id='', **params):
+  """ Persists a new job and queues it. Returns the models.Job. """
+  if kind not in runners:
+    raise ValueError('Unknown job kind: %s' % (kind))
+  job = models.Job.objects.create(user=user, kind=kind, region=region,
+                                  instance_id=instance_id,
+                                  params=json.dumps(params))
+  GetExecutor().Submit(job.id)
+  return job
+
+
+def RunJob(job_id):
+  """ Runs a queued job to completion, unless it was cancelled meanwhile. """
+  claimed = models.Job.objects.filter(pk=job_id, state=models.Job.QUEUED).update(
+      state=models.Job.RUNNING, attempts=F('attempts') + 1,
+      updated=timezone.now())
+  if not claimed:
+    return
+  job = models.Job.objects.get(pk=job_id)
+  iam_credentials = None
+  try:
+    iam_credentials = models.IamCredentials.objects.get(user_id=job.user_id)
+    params = json.loads(job.params)
+    if job.instance_id:
+      params['instance_id'] = job.instance_id
+    with manager_pool.GetManagerPool().Checkout(
+        job.region, iam_credentials.iam_key_id,
+        iam_credentials.iam_key_secret) as manager:
+      runner = runners[job.kind](manager, **params)
+      if job.instance_id:
+        # Identical jobs on one instance coalesce, conflicting ones queue up.
+        single_flight.Do(job.region, job.instance_id,
+                         '%s:%s' % (job.kind, job.params), runner,
+                         wait_secs=getattr(settings,
+                                           'WORKSTATION_JOB_LOCK_WAIT_SECS',
+                                           900))
+      else:
+        runner()
+    job.state = models.Job.SUCCEEDED
+    job.error = ''
+  except Exception:
+    job.state = models.Job.FAILED
+    job.error = traceback.format_exc()
+  job.save(update_fields=['state', 'error', 'updated'])
+  if iam_credentials:
+    inventory.Invalidate(iam_credentials.iam_key_id, job.region)
+  return
+
+
+def RecoverJobs():
+  """ Picks up the jobs of worker processes that exited.
+
+  Jobs still queued are submitted again; RunJob() claims each only once.
+  Jobs running for longer than WORKSTATION_JOB_STALE_SECS are marked failed,
+  they can be retried.  Returns the number of jobs requeued and failed.
+  """
+  stale = timezone.now() - datetime.timedelta(
+      seconds=getattr(settings, 'WORKSTATION_JOB_STALE_SECS', 3600))
+  failed = models.Job.objects.filter(
+      state=models.Job.RUNNING, updated__lt=stale).update(
+          state=models.Job.FAILED, updated=timezone.now(),
+          error='The worker running this job exited before it finished.')
+  queued = list(models.Job.objects.filter(
+      state=models.Job.QUEUED).values_list('pk', flat=True))
+  for job_id in queued:
+    GetExecutor().Submit(job_id)
+  return len(queued), failed
+
+
+def Cancel(job):
+  """ Cancels a job that has not started yet. Returns True on success. """
+  cancelled = models.Job.objects.filter(pk=job.pk, state=models.Job.QUEUED).update(
+      state=models.Job.CANCELLED, updated=timezone.now())
+  return bool(cancelled)
+
+
+def Retry(job):
+  """ Requeues a failed or cancelled job. Returns True on success. """
+  retryable = [models.Job.FAILED, models.Job.CANCELLED]
+  requeued = models.Job.objects.filter(pk=job.pk, state__in=retryable).update(
+      state=models.Job.QUEUED, error='', updated=timezone.now())
+  if requeued:
+    GetExecutor().Submit(job.pk)
+  return bool(requeued)
@@ -0,0 +1,128 @@
+""" Process-wide pool of workstation.Manager instances.
+
+Constructing a workstation.Manager is expensive: it verifies the IAM user,
+opens tested EC2 and S3 connections and syncs the workstation keypair, which
+is several AWS round trips before any real work happens.  The pool keeps idle
+Managers keyed by (region, iam_key_id) so later requests from the same user
+can reuse them.
+
+A Manager wraps boto connections that are not safe to share between threads,
+so callers check one out for the duration of a request and it is returned to
+the pool afterwards:
+
+  with GetManagerPool().Checkout(region, key_id, key_secret) as manager:
+    manager.StartInstance(instance_id)
+"""
+
+import contextlib
+import threading
+import time
+
+from cirruscluster import workstation
+from django.conf import settings
+
+import profiling
+import rate_limit
+
+
+class _PoolEntry(object):
+  def __init__(self, key, iam_key_secret, manager, generation):
+    self.key = key
+    self.iam_key_secret = iam_key_secret
+    self.manager = manager
+    self.generation = generation
+    self.last_used = time.time()
+    return
+
+
+class ManagerPool(object):
+  """ Thread-safe pool of idle Managers with idle expiry and a size bound.
+
+  max_size bounds the number of idle Managers retained; a pool with max_size 0
+  never retains anything and behaves like constructing a Manager per request.
+  """
+
+  def __init__(self, max_size=50, max_idle_secs=300,
+               factory=workstation.Manager):
+    self.max_size = max_size
+    self.max_idle_secs = max_idle_secs
+    self.factory = factory
+    self.lock = threading.Lock()
+    self.idle = []  # _PoolEntry objects, least recently used first
+    self.generations = {}  # iam_key_id -> invalidation count
+    self.num_created = 0
+    self.num_reused = 0
+    return
+
+  @contextlib.contextmanager
+  def Checkout(self, region, iam_key_id, iam_key_secret):
+    entry = self.__Acquire(region, iam_key_id, iam_key_secret)
+    yield entry.manager
+    # Not reached if the caller raised: a manager that failed part way through
+    # an operation may hold broken connections, so it is dropped instead.
+    self.__Release(entry)
+
+  def Invalidate(self, iam_key_id):
+    """ Drops all Managers of an IAM user, including checked out ones. """
+    with self.lock:
+      self.generations[iam_key_id] = self.generations.get(iam_key_id, 0) + 1
+      self.idle = [e for e in self.idle if e.key[1] != iam_key_id]
+    return
+
+  def Clear(self):
+    with self.lock:
+      self.idle = []
+    return
+
+  def NumIdle(self):
+    with self.lock:
+      return len(self.idle)
+
+  def __Acquire(self, region, iam_key_id, iam_key_secret):
+    key = (region, iam_key_id)
+    with self.lock:
+      self.__ExpireIdle()
+      generation = self.generations.get(iam_key_id, 0)
+      # Prefer the most recently used entry, its connections are warmest.
+      for i in reversed(range(len(self.idle))):
+        entry = self.idle[i]
+        if entry.key == key and entry.iam_key_secret == iam_key_secret:
+          del self.idle[i]
+          self.num_reused += 1
+          return entry
+      self.num_created += 1
+    # Build outside the lock, construction makes several AWS calls.
+    manager = self.factory(region, iam_key_id, iam_key_secret)
+    return _PoolEntry(key, iam_key_secret, manager, generation)
+
+  def __Release(self, entry):
+    with self.lock:
+      if self.generations.get(entry.key[1], 0) != entry.generation:
+        return
+      entry.last_used = time.time()
+      self.idle.append(entry)
+      while len(self.idle) > self.max_size:
+        self.idle.pop(0)
+    return
+
+  def __ExpireIdle(self):
+    oldest_allowed = time.time() - self.max_idle_secs
+    self.idle = [e for e in self.idle if e.last_used >= oldest_allowed]
+    return
+
+
+manager_pool = None
+manager_pool_lock = threading.Lock()
+
+def GetManagerPool():
+  global manager_pool
+  if not manager_pool:
+    with manager_pool_lock:
+      if not manager_pool:
+        manager_pool = ManagerPool(
+            max_size=getattr(settings, 'WORKSTATION_MANAGER_POOL_SIZE', 50),
+            max_idle_secs=getattr(settings,
+                                  'WORKSTATION_MANAGER_POOL_IDLE_SECS', 300),
+            factory=profiling.TimedManagerFactory(
+                rate_limit.RateLimitedManagerFactory(workstation.Manager)))
+  return manager_pool
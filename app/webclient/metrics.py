@@ -0,0 +1,196 @@
+""" Per-view request metrics: query count, database time and latency.
+
+QueryMetricsMiddleware counts and times the queries of each request, through
+a thin wrapper of the connections' cursors that keeps no SQL (unlike Django's
+query logging, which is only on with DEBUG), and records, per view, the
+number of requests, queries and the time spent in the database and overall.
+With DEBUG on, each response also carries the numbers of its own request in
+X-Query-Count, X-DB-Time-Ms and X-Response-Time-Ms headers, which makes N+1
+query patterns easy to spot.
+
+The aggregated counters of the worker process are served as JSON at
+/internal/metrics to staff users and to WORKSTATION_METRICS_ALLOWED_IPS.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404
+from django.http import JsonResponse
+
+
+class ViewCounters(object):
+  def __init__(self):
+    self.requests = 0
+    self.queries = 0
+    self.max_queries = 0
+    self.db_secs = 0.0
+    self.total_secs = 0.0
+    self.max_secs = 0.0
+
+  def Add(self, num_queries, db_secs, total_secs):
+    self.requests += 1
+    self.queries += num_queries
+    self.max_queries = max(self.max_queries, num_queries)
+    self.db_secs += db_secs
+    self.total_secs += total_secs
+    self.max_secs = max(self.max_secs, total_secs)
+
+  def AsDict(self):
+    requests = self.requests or 1
+    return {'requests': self.requests,
+            'queries': self.queries,
+            'queries_per_request': float(self.queries) / requests,
+            'max_queries': self.max_queries,
+            'db_ms': 1000.0 * self.db_secs,
+            'mean_ms': 1000.0 * self.total_secs / requests,
+            'max_ms': 1000.0 * self.max_secs}
+
+
+class QueryCounts(object):
+  """ Queries run on one connection, and the seconds they took. """
+
+  def __init__(self):
+    self.queries = 0
+    self.secs = 0.0
+
+  def Add(self, secs):
+    self.queries += 1
+    self.secs += secs
+
+
+class CountingCursor(object):
+  """ Wraps a connection's cursor, counting its queries in counts. """
+
+  def __init__(self, cursor, counts):
+    self.cursor = cursor
+    self.counts = counts
+
+  def __getattr__(self, attr):
+    return getattr(self.cursor, attr)
+
+  def __iter__(self):
+    return iter(self.cursor)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+  def execute(self, sql, params=None):
+    start = time.time()
+    try:
+      return self.cursor.execute(sql, params)
+    finally:
+      self.counts.Add(time.time() - start)
+
+  def executemany(self, sql, param_list):
+    start = time.time()
+    try:
+      return self.cursor.executemany(sql, param_list)
+    finally:
+      self.counts.Add(time.time() - start)
+
+
+def CountQueries(connection):
+  """ Makes connection count its queries in connection.metrics_queries, a
+  QueryCounts.  Connections are per thread, and so are their counts. """
+  if hasattr(connection, 'metrics_queries'):
+    return
+  counts = connection.metrics_queries = QueryCounts()
+  cursor = connection.cursor
+  connection.cursor = lambda: CountingCursor(cursor(), counts)
+  return
+
+
+counters = {}
+counters_lock = threading.Lock()
+
+
+def Record(view_name, num_queries, db_secs, total_secs):
+  with counters_lock:
+    if view_name not in counters:
+      counters[view_name] = ViewCounters()
+    counters[view_name].Add(num_queries, db_secs, total_secs)
+  return
+
+
+def Snapshot():
+  """ Returns {view name: counters as a dict}. """
+  with counters_lock:
+    return dict((name, c.AsDict()) for name, c in counters.items())
+
+
+def Reset():
+  with counters_lock:
+    counters.clear()
+  return
+
+
+def ViewName(view_func):
+  name = getattr(view_func, '__name__', view_func.__class__.__name__)
+  return '%s.%s' % (view_func.__module__, name)
+
+
+class QueryMetricsMiddleware(object):
+  def process_request(self, request):
+    request.metrics_start = time.time()
+    # (queries, seconds) of each connection before this request.
+    request.metrics_connections = {}
+    for connection in connections.all():
+      CountQueries(connection)
+      request.metrics_connections[connection.alias] = (
+          connection.metrics_queries.queries, connection.metrics_queries.secs)
+    return None
+
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    request.metrics_view = ViewName(view_func)
+    return None
+
+  def process_response(self, request, response):
+    start = getattr(request, 'metrics_start', None)
+    if start is None:
+      return response
+    num_queries = 0
+    db_secs = 0.0
+    for connection in connections.all():
+      CountQueries(connection)
+      queries, secs = request.metrics_connections.get(connection.alias,
+                                                      (0, 0.0))
+      num_queries += connection.metrics_queries.queries - queries
+      db_secs += connection.metrics_queries.secs - secs
+    total_secs = time.time() - start
+    # A stream's latency is that of the view, not of the response.
+    if not response.streaming:
+      Record(getattr(request, 'metrics_view', 'unresolved'), num_queries,
+             db_secs, total_secs)
+    if settings.DEBUG:
+      response['X-Query-Count'] = str(num_queries)
+      response['X-DB-Time-Ms'] = '%.1f' % (1000.0 * db_secs)
+      response['X-Response-Time-Ms'] = '%.1f' % (1000.0 * total_secs)
+    return response
+
+
+def IsInternal(request):
+  """ True for staff users and WORKSTATION_METRICS_ALLOWED_IPS. """
+  allowed_ips = getattr(settings, 'WORKSTATION_METRICS_ALLOWED_IPS',
+                        ['127.0.0.1'])
+  if request.META.get('REMOTE_ADDR') in allowed_ips:
+    return True
+  user = getattr(request, 'user', None)
+  return user is not None and user.is_authenticated() and user.is_staff
+
+
+def MetricsView(request):
+  if not IsInternal(request):
+    raise Http404
+  import profiling  # imports this module
+  import rate_limit
+  import single_flight
+  return JsonResponse({'views': Snapshot(),
+                       'profile': profiling.Snapshot(),
+                       'single_flight': single_flight.Snapshot(),
+                       'ec2_rate_limit': rate_limit.Snapshot()})
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('webclient', '0002_iamcredentials'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=40)),
+                ('region', models.CharField(max_length=20)),
+                ('instance_id', models.CharField(max_length=20, blank=True)),
+                ('params', models.TextField(default=b'{}')),
+                ('state', models.CharField(default=b'queued', max_length=10, choices=[(b'queued', b'Queued'), (b'running', b'Running'), (b'succeeded', b'Succeeded'), (b'failed', b'Failed'), (b'cancelled', b'Cancelled')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -1,7 +1,103 @@
+from django.conf import settings
+from django.core.cache import caches
 from django.db import models
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 
+import manager_pool
+
 class IamCredentials(models.Model):
     user = models.OneToOneField(User)
     iam_key_id = models.CharField(max_length=20)
-    iam_key_secret = models.CharField(max_length=40)
\ No newline at end of file
+    iam_key_secret = models.CharField(max_length=40)
+
+
+def IamCredentialsCache():
+    return caches[getattr(settings, 'WORKSTATION_CREDENTIALS_CACHE', 'default')]
+
+
+def IamCredentialsCacheKey(user_id):
+    return 'iamcredentials:%s' % (user_id)
+
+
+def GetIamCredentials(user):
+    """ Returns the user's IamCredentials from the cache, loading them from the
+    database on a miss, or raises IamCredentials.DoesNotExist.  Saving or
+    deleting the row invalidates the entry; note it holds the IAM secret,
+    like the session config cache.
+
+    A missing row is not cached: the save that creates it only invalidates
+    the cache of the process it happens in, and with per-process caches
+    other processes would keep sending the user back to the setup page.
+    """
+    cache = IamCredentialsCache()
+    key = IamCredentialsCacheKey(user.pk)
+    credentials = cache.get(key)
+    if credentials is None:
+        credentials = IamCredentials.objects.get(user=user)
+        cache.set(key, credentials,
+                  getattr(settings, 'WORKSTATION_IAM_CREDENTIALS_TTL', 300))
+    return credentials
+
+
+class Job(models.Model):
+    """ A long-running workstation operation, run by webclient.jobs. """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATE_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+
+    user = models.ForeignKey(User)
+    kind = models.CharField(max_length=40)
+    region = models.CharField(max_length=20)
+    instance_id = models.CharField(max_length=20, blank=True)
+    params = models.TextField(default='{}')  # JSON encoded runner arguments
+    state = models.CharField(max_length=10, choices=STATE_CHOICES,
+                             default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def AsDict(self):
+        return {'id': self.id,
+                'kind': self.kind,
+                'region': self.region,
+                'instance_id': self.instance_id,
+                'state': self.state,
+                'attempts': self.attempts,
+                'error': self.error,
+                'created': self.created.isoformat(),
+                'updated': self.updated.isoformat()}
+
+
+@receiver(pre_save, sender=IamCredentials)
+def InvalidatePooledManagersOnSave(sender, instance, **kwargs):
+    """ Pooled Managers of the old and new key id are stale after a change. """
+    pool = manager_pool.GetManagerPool()
+    if instance.pk:
+        old = IamCredentials.objects.filter(pk=instance.pk).first()
+        if old and old.iam_key_id:
+            pool.Invalidate(old.iam_key_id)
+    if instance.iam_key_id:
+        pool.Invalidate(instance.iam_key_id)
+
+
+@receiver(post_delete, sender=IamCredentials)
+def InvalidatePooledManagersOnDelete(sender, instance, **kwargs):
+    manager_pool.GetManagerPool().Invalidate(instance.iam_key_id)
+
+
+@receiver(post_save, sender=IamCredentials)
+@receiver(post_delete, sender=IamCredentials)
+def InvalidateCachedIamCredentials(sender, instance, **kwargs):
+    IamCredentialsCache().delete(IamCredentialsCacheKey(instance.user_id))
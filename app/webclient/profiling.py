@@ -0,0 +1,223 @@
+""" Sampling request profiler and EC2 timers.
+
+ProfilingMiddleware profiles a random WORKSTATION_PROFILING_SAMPLE_RATE
+fraction of requests, plus any request from an internal client (see
+metrics.IsInternal) that sends an "X-Profile: 1" header.  A profiled view
+runs under cProfile and its latency is added to a per-view histogram.  If
+WORKSTATION_PROFILING_DUMP_DIR is set, the pstats of the
+WORKSTATION_PROFILING_KEEP_SLOWEST slowest profiled requests are kept there,
+named <ms>-<view>-<time>.pstats, for e.g.
+
+  import pstats
+  pstats.Stats(path).sort_stats('cumulative').print_stats(30)
+
+Requests that are not sampled cost one random() call.
+
+Managers handed out by manager_pool are wrapped in TimedManager, which
+times every Manager method and every EC2 API action the Manager's boto
+connection makes, in all threads including jobs and pollers.  The cost is
+small next to the EC2 round trip.  Histograms keep the most recent
+HISTOGRAM_SIZE samples per key; their percentiles are served with the
+other metrics at /internal/metrics.
+"""
+
+import cProfile
+import heapq
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+import metrics
+
+HISTOGRAM_SIZE = 1000
+
+
+class Histogram(object):
+  """ Recent samples of a duration, summarized as percentiles. """
+
+  def __init__(self, size=HISTOGRAM_SIZE):
+    self.samples = deque(maxlen=size)
+    self.count = 0
+
+  def Add(self, secs):
+    self.samples.append(secs)
+    self.count += 1
+
+  def AsDict(self):
+    samples = sorted(self.samples)
+    def Percentile(p):
+      return 1000.0 * samples[int(p * (len(samples) - 1))]
+    return {'count': self.count,
+            'p50_ms': Percentile(0.5),
+            'p90_ms': Percentile(0.9),
+            'p99_ms': Percentile(0.99),
+            'max_ms': 1000.0 * samples[-1]}
+
+
+histograms = {'views': {}, 'manager': {}, 'ec2': {}}
+histograms_lock = threading.Lock()
+
+
+def Record(kind, name, secs):
+  with histograms_lock:
+    if name not in histograms[kind]:
+      histograms[kind][name] = Histogram()
+    histograms[kind][name].Add(secs)
+  return
+
+
+def Snapshot():
+  """ Returns {kind: {name: percentiles}} for views, manager and ec2. """
+  with histograms_lock:
+    return dict((kind, dict((name, h.AsDict()) for name, h in by_name.items()))
+                for kind, by_name in histograms.items())
+
+
+def Reset():
+  with histograms_lock:
+    for by_name in histograms.values():
+      by_name.clear()
+  return
+
+
+class TimedEc2Request(object):
+  """ Wraps a boto connection's make_request to time each API action. """
+
+  def __init__(self, make_request):
+    self.make_request = make_request
+
+  def __call__(self, action, *args, **kwargs):
+    start = time.time()
+    try:
+      return self.make_request(action, *args, **kwargs)
+    finally:
+      Record('ec2', action, time.time() - start)
+
+
+class TimedManager(object):
+  """ Proxy for a workstation.Manager that times its method calls. """
+
+  def __init__(self, manager):
+    self.__dict__['manager'] = manager
+    ec2 = getattr(manager, 'ec2', None)
+    if ec2 is not None and hasattr(ec2, 'make_request'):
+      ec2.make_request = TimedEc2Request(ec2.make_request)
+
+  def __getattr__(self, name):
+    attr = getattr(self.manager, name)
+    if name.startswith('_') or not callable(attr):
+      return attr
+    def Timed(*args, **kwargs):
+      start = time.time()
+      try:
+        return attr(*args, **kwargs)
+      finally:
+        Record('manager', name, time.time() - start)
+    return Timed
+
+  def __setattr__(self, name, value):
+    setattr(self.manager, name, value)
+
+
+def TimedManagerFactory(factory):
+  """ Wraps a Manager factory so it returns TimedManagers. """
+  def Create(*args):
+    return TimedManager(factory(*args))
+  return Create
+
+
+class SlowestDumps(object):
+  """ Keeps the pstats files of the N slowest profiled requests. """
+
+  def __init__(self, directory, keep):
+    self.directory = directory
+    self.keep = keep
+    self.heap = []  # (secs, path) of the kept dumps, fastest first
+    self.lock = threading.Lock()
+
+  def Offer(self, profiler, view_name, secs):
+    with self.lock:
+      if len(self.heap) >= self.keep and secs <= self.heap[0][0]:
+        return None
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      filename = '%d-%s-%d.pstats' % (1000 * secs,
+                                      re.sub(r'[^\w.]', '_', view_name),
+                                      1000 * time.time())
+      path = os.path.join(self.directory, filename)
+      profiler.dump_stats(path)
+      heapq.heappush(self.heap, (secs, path))
+      if len(self.heap) > self.keep:
+        _, evicted = heapq.heappop(self.heap)
+        if os.path.exists(evicted):
+          os.remove(evicted)
+      return path
+
+
+dumps = None
+dumps_lock = threading.Lock()
+
+def GetDumps():
+  global dumps
+  directory = getattr(settings, 'WORKSTATION_PROFILING_DUMP_DIR', None)
+  if not directory:
+    return None
+  with dumps_lock:
+    if dumps is None or dumps.directory != directory:
+      dumps = SlowestDumps(
+          directory, getattr(settings, 'WORKSTATION_PROFILING_KEEP_SLOWEST', 20))
+  return dumps
+
+
+def ShouldProfile(request):
+  rate = getattr(settings, 'WORKSTATION_PROFILING_SAMPLE_RATE', 0.0)
+  if rate and random.random() < rate:
+    return True
+  return (request.META.get('HTTP_X_PROFILE') == '1' and
+          metrics.IsInternal(request))
+
+
+class ProfilingMiddleware(object):
+  """ Profiles sampled requests from their view to their response.
+
+  The profiler is only enabled here, Django still calls the view and the
+  other middleware, so e.g. ThrottledMiddleware sees the view's exceptions.
+  """
+
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    if not ShouldProfile(request):
+      return None
+    profiler = cProfile.Profile()
+    request.profiling = (profiler, metrics.ViewName(view_func), time.time())
+    profiler.enable()
+    return None
+
+  def process_exception(self, request, exception):
+    self.Stop(request)
+    return None
+
+  def process_response(self, request, response):
+    path = self.Stop(request)
+    if path and settings.DEBUG:
+      response['X-Profile-Dump'] = os.path.basename(path)
+    return response
+
+  def Stop(self, request):
+    """ Records the request's profile once; returns its dump path, if kept. """
+    profiling = getattr(request, 'profiling', None)
+    if profiling:
+      del request.profiling
+      profiler, view_name, start = profiling
+      profiler.disable()
+      # Views that raise (Http404, errors) are profiled too.
+      secs = time.time() - start
+      Record('views', view_name, secs)
+      slowest = GetDumps()
+      request.profile_dump = slowest and slowest.Offer(profiler, view_name,
+                                                       secs)
+    return getattr(request, 'profile_dump', None)
@@ -0,0 +1,247 @@
+""" Client side rate limiting of EC2 API calls per account and region.
+
+EC2 throttles API calls per account and region.  With many users behind one
+account the webclient used to run into RequestLimitExceeded errors that
+surfaced as uncaught boto exceptions.  Managers created by manager_pool now
+route every EC2 API request through a token bucket per (region, IAM key id),
+refilled at WORKSTATION_EC2_RATE tokens per second up to
+WORKSTATION_EC2_BURST.  The bucket lives in the WORKSTATION_EC2_RATE_CACHE
+cache so all worker processes sharing that cache share the budget.
+
+Read calls (Describe*, Get*, List*), e.g. the inventory refreshes behind
+ListInstances, may not use the last WORKSTATION_EC2_READ_RESERVE tokens,
+which are kept for user initiated mutating calls such as StartInstances.
+
+A call that is throttled by EC2 anyway is retried up to
+WORKSTATION_EC2_MAX_RETRIES times after a jittered exponential backoff, and
+empties the bucket so that other callers slow down too.  Other 5xx errors
+and connection errors (e.g. a reset of a pooled Manager's idle keep-alive
+connection) are retried the same way, in place of boto's own retries.  If it
+still fails, ThrottledMiddleware answers the request with a 503 instead of a
+stack trace.
+"""
+
+import random
+import re
+import threading
+import time
+import uuid
+
+from boto import exception
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.http import JsonResponse
+
+THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling')
+READ_ACTION_PREFIXES = ('Describe', 'Get', 'List')
+
+error_code_re = re.compile(r'<Code>([^<]+)</Code>')
+
+
+def GetCache():
+  return caches[getattr(settings, 'WORKSTATION_EC2_RATE_CACHE', 'default')]
+
+
+# calls: EC2 requests made
+# waited: requests delayed by the bucket, wait_secs: total delay
+# throttled: throttling responses from EC2
+# retried: requests retried after throttling, another 5xx or connection error
+# gave_up: requests still throttled after all retries
+counters = {'calls': 0, 'waited': 0, 'wait_secs': 0.0, 'throttled': 0,
+            'retried': 0, 'gave_up': 0}
+counters_lock = threading.Lock()
+
+
+def Count(name, amount=1):
+  with counters_lock:
+    counters[name] += amount
+  return
+
+
+def Snapshot():
+  with counters_lock:
+    return dict(counters)
+
+
+class TokenBucket(object):
+  """ Token bucket whose state is kept in the cache.
+
+  Updates are made under a short cache lock; if that cannot be had quickly
+  the update goes ahead without it, which at worst lets a few calls more
+  through than the rate allows.
+  """
+
+  def __init__(self, key, rate, capacity, read_reserve):
+    self.key = key
+    self.rate = float(rate)
+    self.capacity = capacity
+    self.read_reserve = read_reserve
+    return
+
+  def __Update(self, update):
+    cache = GetCache()
+    lock_key = self.key + ':lock'
+    token = uuid.uuid4().hex
+    locked = False
+    for _ in range(20):
+      locked = cache.add(lock_key, token, 5)
+      if locked:
+        break
+      time.sleep(0.005)
+    try:
+      now = time.time()
+      tokens, stamp = cache.get(self.key) or (self.capacity, now)
+      tokens = min(self.capacity, tokens + max(0, now - stamp) * self.rate)
+      tokens, result = update(tokens)
+      cache.set(self.key, (tokens, now), 3600)
+    finally:
+      if locked and cache.get(lock_key) == token:
+        cache.delete(lock_key)
+    return result
+
+  def TryTake(self, read):
+    """ Takes a token; returns 0, or the seconds until one will be available. """
+    floor = self.read_reserve if read else 0
+    def Take(tokens):
+      if tokens - 1 >= floor:
+        return tokens - 1, 0
+      return tokens, (floor + 1 - tokens) / self.rate
+    return self.__Update(Take)
+
+  def Take(self, read, max_wait_secs):
+    """ Waits for a token for up to max_wait_secs; returns the time waited.
+
+    Goes ahead without one after max_wait_secs, EC2 has the final say.
+    """
+    waited = 0.0
+    while waited < max_wait_secs:
+      wait = self.TryTake(read)
+      if not wait:
+        break
+      wait = min(wait, max_wait_secs - waited)
+      time.sleep(wait)
+      waited += wait
+    return waited
+
+  def Drain(self):
+    self.__Update(lambda tokens: (0, None))
+    return
+
+
+def GetBucket(region, iam_key_id):
+  return TokenBucket('ec2_bucket:%s:%s' % (region, iam_key_id),
+                     getattr(settings, 'WORKSTATION_EC2_RATE', 5),
+                     getattr(settings, 'WORKSTATION_EC2_BURST', 20),
+                     getattr(settings, 'WORKSTATION_EC2_READ_RESERVE', 5))
+
+
+def Backoff(attempt):
+  """ Full jitter exponential backoff, in seconds. """
+  base = getattr(settings, 'WORKSTATION_EC2_BACKOFF_BASE_SECS', 0.5)
+  cap = getattr(settings, 'WORKSTATION_EC2_BACKOFF_MAX_SECS', 20)
+  return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def ThrottlingCode(response):
+  """ The throttling error code of a boto response, or None. """
+  if response.status < 400:
+    return None
+  # boto's HTTPResponse caches the body, so the caller can still read it.
+  match = error_code_re.search(response.read())
+  if match and match.group(1) in THROTTLING_CODES:
+    return match.group(1)
+  return None
+
+
+class RateLimitedEc2Request(object):
+  """ Wraps a boto EC2 connection's make_request with the bucket.
+
+  http_exceptions are the connection errors to retry, but for those in
+  unretryable_exceptions; boto has already reconnected when it raises one.
+  """
+
+  def __init__(self, make_request, bucket, http_exceptions=(),
+               unretryable_exceptions=()):
+    self.make_request = make_request
+    self.bucket = bucket
+    self.http_exceptions = http_exceptions
+    self.unretryable_exceptions = unretryable_exceptions
+
+  def __call__(self, action, *args, **kwargs):
+    read = action.startswith(READ_ACTION_PREFIXES)
+    max_retries = getattr(settings, 'WORKSTATION_EC2_MAX_RETRIES', 5)
+    max_wait_secs = getattr(settings, 'WORKSTATION_EC2_MAX_WAIT_SECS', 10)
+    attempt = 0
+    while True:
+      waited = self.bucket.Take(read, max_wait_secs)
+      if waited:
+        Count('waited')
+        Count('wait_secs', waited)
+      Count('calls')
+      error = None
+      try:
+        response = self.make_request(action, *args, **kwargs)
+        code = ThrottlingCode(response)
+        if not code:
+          return response
+      except exception.BotoServerError as e:
+        # boto raises for 5xx responses (throttling included) and returns
+        # the others, which its callers then raise for.
+        error = e
+        code = e.error_code if e.error_code in THROTTLING_CODES else None
+        if not code and e.status < 500:
+          raise
+      except self.http_exceptions as e:
+        if isinstance(e, self.unretryable_exceptions):
+          raise
+        error = e
+        code = None
+      if code:
+        Count('throttled')
+        self.bucket.Drain()
+      if attempt >= max_retries:
+        if code:
+          Count('gave_up')
+        if error:
+          raise error
+        return response  # boto raises the EC2ResponseError
+      Count('retried')
+      time.sleep(Backoff(attempt))
+      attempt += 1
+
+
+def RateLimitedManagerFactory(factory):
+  """ Wraps a Manager factory so its Managers' EC2 calls are rate limited.
+
+  The calls made while constructing a Manager are not limited.  boto's own
+  retries of 5xx responses and connection errors are turned off, so that
+  every retry goes through the bucket and the backoff here.
+  """
+  def Create(region, iam_key_id, iam_key_secret):
+    manager = factory(region, iam_key_id, iam_key_secret)
+    ec2 = getattr(manager, 'ec2', None)
+    if ec2 is not None and hasattr(ec2, 'make_request'):
+      ec2.num_retries = 0
+      ec2.make_request = RateLimitedEc2Request(
+          ec2.make_request, GetBucket(region, iam_key_id),
+          tuple(ec2.http_exceptions), tuple(ec2.http_unretryable_exceptions))
+    return manager
+  return Create
+
+
+class ThrottledMiddleware(object):
+  """ Answers requests that EC2 kept throttling with a 503. """
+
+  def process_exception(self, request, e):
+    if not (isinstance(e, exception.BotoServerError) and
+            e.error_code in THROTTLING_CODES):
+      return None
+    message = ('AWS is rate limiting requests for this account, please try '
+               'again in a minute.')
+    if request.path.startswith('/api/'):
+      response = JsonResponse({'error': message}, status=503)
+    else:
+      response = HttpResponse(message, status=503)
+    response['Retry-After'] = '60'
+    return response
@@ -0,0 +1,101 @@
+""" Cache of NX session configs (.nxs files) for running workstations.
+
+Manager.CreateRemoteSessionConfig() looks the instance up, reads the NX key
+over ssh and renders the session template, which makes Connect slow.  The
+config only changes when the instance gets a new public hostname, i.e. when
+it is stopped and started again, so it is cached per instance id together
+with the hostname it was made for and a content hash used as ETag.
+
+Configs are built eagerly in the background when the account poller sees an
+instance become running, and evicted when it stops or terminates.  Note the
+config embeds the instance's NX key, so the cache backend must not be shared
+with untrusted parties.
+"""
+
+import hashlib
+import logging
+import threading
+from multiprocessing import pool as mp_pool
+
+from django.conf import settings
+from django.core.cache import caches
+
+import manager_pool
+
+
+def GetCache():
+  return caches[getattr(settings, 'WORKSTATION_SESSION_CONFIG_CACHE',
+                        'default')]
+
+
+def GetTtl():
+  return getattr(settings, 'WORKSTATION_SESSION_CONFIG_TTL', 24 * 60 * 60)
+
+
+def CacheKey(instance_id):
+  return 'nxs:%s' % (instance_id)
+
+
+def Get(instance_id, hostname):
+  """ Returns the cached entry for the instance at hostname, or None.
+
+  An entry is a dict with the instance 'name', its 'hostname', the 'config'
+  data and the 'md5' of the config.
+  """
+  if not hostname:
+    return None
+  entry = GetCache().get(CacheKey(instance_id))
+  if entry is None or entry['hostname'] != hostname:
+    return None
+  return entry
+
+
+def Put(instance_id, hostname, name, config):
+  entry = {'name': name,
+           'hostname': hostname,
+           'config': config,
+           'md5': hashlib.md5(config).hexdigest()}
+  if hostname:
+    GetCache().set(CacheKey(instance_id), entry, GetTtl())
+  return entry
+
+
+def Evict(instance_id):
+  GetCache().delete(CacheKey(instance_id))
+  return
+
+
+prefetch_pool = None
+prefetch_lock = threading.Lock()
+prefetches_in_flight = set()
+
+def Prefetch(region, iam_key_id, iam_key_secret, instance):
+  """ Builds and caches the config of a running instance in the background. """
+  global prefetch_pool
+  key = (instance['id'], instance['hostname'])
+  with prefetch_lock:
+    if key in prefetches_in_flight or Get(*key):
+      return
+    prefetches_in_flight.add(key)
+    if not prefetch_pool:
+      prefetch_pool = mp_pool.ThreadPool(
+          processes=getattr(settings, 'WORKSTATION_SESSION_CONFIG_WORKERS', 2))
+  prefetch_pool.apply_async(_Prefetch, (region, iam_key_id, iam_key_secret,
+                                        instance))
+  return
+
+
+def _Prefetch(region, iam_key_id, iam_key_secret, instance):
+  try:
+    pool = manager_pool.GetManagerPool()
+    with pool.Checkout(region, iam_key_id, iam_key_secret) as manager:
+      config = manager.CreateRemoteSessionConfig(instance['id'])
+    Put(instance['id'], instance['hostname'], instance['name'], config)
+  except Exception:
+    # Not fatal, Connect builds the config itself on a miss.
+    logging.exception('Prefetching session config of %s failed',
+                      instance['id'])
+  finally:
+    with prefetch_lock:
+      prefetches_in_flight.discard((instance['id'], instance['hostname']))
+  return
@@ -0,0 +1,209 @@
+""" Per-instance single-flight for mutating workstation operations.
+
+A double click on "Turn On", two tabs stopping the same workstation or a
+Destroy racing an AddStorage all used to reach EC2 as separate calls.  Do()
+runs an operation on an instance such that:
+
+ - identical operations in flight in this process are coalesced: only the
+   first runs, the others wait for and share its result (or exception);
+ - operations on one instance are serialized across worker processes by a
+   lock in the WORKSTATION_INSTANCE_LOCK_CACHE cache, which needs to be a
+   cache shared by the workers (see _Cache in settings.py) for this to hold
+   across processes;
+ - an operation that waited for the lock is skipped if the holder just ran
+   the identical operation, so duplicates coalesce across processes too.
+
+  def StopIt():
+    with CheckoutManager(request, region) as manager:
+      manager.StopInstance(instance_id)
+  single_flight.Do(region, instance_id, 'stop', StopIt)
+
+An operation on several instances at once, like the batched calls of
+bulk_power, holds all their locks through InstanceLocks instead; it does not
+coalesce.
+
+Operations should be identified including their arguments, e.g.
+'resize_root_volume:{"new_size_gb": 50}'.  A lock held longer than
+WORKSTATION_INSTANCE_LOCK_SECS, e.g. by a process that died, expires.
+"""
+
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class InstanceBusy(Exception):
+  """ Another operation held the instance's lock for longer than we waited. """
+
+  def __init__(self, instance_id, holder):
+    Exception.__init__(self, 'Workstation %s is busy with another operation '
+                       '(%s), please try again later.' % (instance_id, holder))
+    self.instance_id = instance_id
+    self.holder = holder
+
+
+def GetCache():
+  return caches[getattr(settings, 'WORKSTATION_INSTANCE_LOCK_CACHE', 'default')]
+
+
+# runs: operations run
+# coalesced: shared the result of an identical in-flight operation
+# skipped: the lock holder had just run the identical operation
+# waits: waited for the lock of another operation
+counters = {'runs': 0, 'coalesced': 0, 'skipped': 0, 'waits': 0}
+counters_lock = threading.Lock()
+
+
+def Count(name):
+  with counters_lock:
+    counters[name] += 1
+  return
+
+
+def Snapshot():
+  with counters_lock:
+    return dict(counters)
+
+
+class InstanceLock(object):
+  """ Cache based lock on one instance, usable across processes. """
+
+  def __init__(self, region, instance_id, operation, wait_secs):
+    self.instance_id = instance_id
+    self.key = 'instance_lock:%s:%s' % (region, instance_id)
+    self.token = '%s pid %d %s' % (operation, os.getpid(), uuid.uuid4().hex)
+    self.wait_secs = wait_secs
+    self.waited = False
+    return
+
+  def __enter__(self):
+    cache = GetCache()
+    ttl = getattr(settings, 'WORKSTATION_INSTANCE_LOCK_SECS', 900)
+    deadline = time.time() + self.wait_secs
+    poll_secs = 0.05
+    # add() only stores the key if it is not set, atomically.
+    while not cache.add(self.key, self.token, ttl):
+      self.waited = True
+      if time.time() > deadline:
+        raise InstanceBusy(self.instance_id,
+                           (cache.get(self.key) or '').split(' pid ')[0])
+      time.sleep(poll_secs)
+      poll_secs = min(2 * poll_secs, 0.5)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    cache = GetCache()
+    if cache.get(self.key) == self.token:
+      cache.delete(self.key)
+    return False
+
+
+class InstanceLocks(object):
+  """ The InstanceLocks of several instances, taken in instance id order so
+  that operations on overlapping sets of instances can't deadlock.
+
+  Raises InstanceBusy if they could not all be had within wait_secs (default
+  WORKSTATION_INSTANCE_LOCK_WAIT_SECS).
+  """
+
+  def __init__(self, region, instance_ids, operation, wait_secs=None):
+    if wait_secs is None:
+      wait_secs = getattr(settings, 'WORKSTATION_INSTANCE_LOCK_WAIT_SECS', 20)
+    self.region = region
+    self.instance_ids = sorted(set(instance_ids))
+    self.operation = operation
+    self.wait_secs = wait_secs
+    self.locks = []
+    return
+
+  def __enter__(self):
+    deadline = time.time() + self.wait_secs
+    try:
+      for instance_id in self.instance_ids:
+        lock = InstanceLock(self.region, instance_id, self.operation,
+                            max(0, deadline - time.time()))
+        lock.__enter__()
+        self.locks.append(lock)
+    except Exception:
+      self.__exit__(None, None, None)
+      raise
+    if any(lock.waited for lock in self.locks):
+      Count('waits')
+    Count('runs')
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    while self.locks:
+      self.locks.pop().__exit__(None, None, None)
+    return False
+
+
+class Flight(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+    return
+
+
+flights = {}  # (region, instance_id, operation) -> Flight
+flights_lock = threading.Lock()
+
+
+def Do(region, instance_id, operation, function, wait_secs=None):
+  """ Runs function() as operation on the instance, see the module doc.
+
+  Raises InstanceBusy if the instance stayed locked by another operation for
+  wait_secs (default WORKSTATION_INSTANCE_LOCK_WAIT_SECS).
+  """
+  key = (region, instance_id, operation)
+  with flights_lock:
+    flight = flights.get(key)
+    leader = flight is None
+    if leader:
+      flight = flights[key] = Flight()
+  if not leader:
+    Count('coalesced')
+    flight.done.wait()
+    if flight.error:
+      raise flight.error
+    return flight.result
+  try:
+    flight.result = RunLocked(region, instance_id, operation, function,
+                              wait_secs)
+  except Exception as e:
+    flight.error = e
+    raise
+  finally:
+    with flights_lock:
+      del flights[key]
+    flight.done.set()
+  return flight.result
+
+
+def RunLocked(region, instance_id, operation, function, wait_secs=None):
+  if wait_secs is None:
+    wait_secs = getattr(settings, 'WORKSTATION_INSTANCE_LOCK_WAIT_SECS', 20)
+  cache = GetCache()
+  last_key = 'instance_last_op:%s:%s' % (region, instance_id)
+  requested = time.time()
+  with InstanceLock(region, instance_id, operation, wait_secs) as lock:
+    if lock.waited:
+      Count('waits')
+      # The operation that held the lock may have been this very one.
+      last = cache.get(last_key)
+      if last and last[0] == operation and last[1] >= requested:
+        Count('skipped')
+        return last[2]
+    Count('runs')
+    result = function()
+    try:
+      cache.set(last_key, (operation, time.time(), result), 60)
+    except Exception:
+      # A result that does not pickle is not shared across processes.
+      cache.delete(last_key)
+  return result
@@ -5,7 +5,45 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import pool as mp_pool
+
+from boto import exception
+from boto.ec2 import connection as ec2_connection
+from boto.ec2 import instance as ec2_instance
+from cirruscluster import core
+from cirruscluster import workstation
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from webclient import credential_checks
+from webclient import db_health
+from webclient import fake_backend
+from webclient import instance_events
+from webclient import inventory
+from webclient import jobs
+from webclient import manager_pool
+from webclient import metrics
+from webclient import models
+from webclient import profiling
+from webclient import rate_limit
+from webclient import session_configs
+from webclient import single_flight
+from webclient import views
 
 
 class SimpleTest(TestCase):
@@ -14,3 +52,1168 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def CreateUser(client, username, iam_key_id='KEY', iam_key_secret='SECRET'):
+    """ Creates a user, with IamCredentials unless iam_key_id is None, and
+    logs client in as them. """
+    user = User.objects.create_user(username, '%s@example.com' % (username),
+                                    'pw')
+    if iam_key_id:
+        models.IamCredentials.objects.create(user=user, iam_key_id=iam_key_id,
+                                             iam_key_secret=iam_key_secret)
+    client.login(username=username, password='pw')
+    return user
+
+
+class FakeInstanceInfo(object):
+    def __init__(self, name, id, state, hostname=''):
+        self.name = name
+        self.id = id
+        self.state = state
+        self.hostname = hostname
+
+
+class CountingManager(object):
+    """ Stands in for workstation.Manager and counts EC2 listings. """
+
+    def __init__(self, instance_infos):
+        self.instance_infos = instance_infos
+        self.num_list_calls = 0
+        self.num_info_calls = 0
+        self.num_config_calls = 0
+
+    def ListInstances(self):
+        self.num_list_calls += 1
+        return self.instance_infos
+
+    def GetInstanceInfo(self, instance_id):
+        self.num_info_calls += 1
+        return [i for i in self.instance_infos if i.id == instance_id][0]
+
+    def CreateRemoteSessionConfig(self, instance_id):
+        self.num_config_calls += 1
+        return 'nx config for %s' % (instance_id)
+
+
+class FakeManagerTestCase(TestCase):
+    """ Serves the views a CountingManager of instance_infos, self.manager,
+    from an empty inventory cache. """
+    instance_infos = []
+
+    def setUp(self):
+        inventory.GetCache().clear()
+        self.manager = CountingManager(list(self.instance_infos))
+        manager_pool.manager_pool = manager_pool.ManagerPool(
+            factory=lambda region, key_id, secret: self.manager)
+
+    def tearDown(self):
+        manager_pool.manager_pool = None
+
+
+class InventoryTest(TestCase):
+    def setUp(self):
+        inventory.GetCache().clear()
+        self.manager = CountingManager([
+            FakeInstanceInfo('alpha', 'i-0001', 'running', 'alpha.aws.com'),
+            FakeInstanceInfo('beta', 'i-0002', 'stopped')])
+
+    @contextlib.contextmanager
+    def checkout(self):
+        yield self.manager
+
+    def list(self):
+        return inventory.ListInstances('KEY', 'us-east-1', self.checkout)
+
+    def test_hit_skips_ec2(self):
+        first = self.list()
+        second = self.list()
+        self.assertEqual(first, second)
+        self.assertEqual(self.manager.num_list_calls, 1)
+        self.assertEqual(first[0]['hostname'], 'alpha.aws.com')
+
+    def test_keyed_by_iam_key_id(self):
+        self.list()
+        inventory.ListInstances('OTHER', 'us-east-1', self.checkout)
+        self.assertEqual(self.manager.num_list_calls, 2)
+
+    def test_set_instance_state_patches_entry(self):
+        self.list()
+        inventory.SetInstanceState('KEY', 'us-east-1', 'i-0001',
+                                   'stopping')
+        instances = self.list()
+        self.assertEqual(instances[0]['state'], 'stopping')
+        self.assertEqual(instances[0]['hostname'], '')
+        self.assertEqual(self.manager.num_list_calls, 1)
+
+    def test_invalidate_forces_relist(self):
+        self.list()
+        inventory.Invalidate('KEY', 'us-east-1')
+        self.list()
+        self.assertEqual(self.manager.num_list_calls, 2)
+
+
+class StubManager(object):
+    def __init__(self, region, iam_key_id, iam_key_secret):
+        self.region = region
+        self.iam_key_id = iam_key_id
+        self.iam_key_secret = iam_key_secret
+
+
+class ManagerPoolTest(TestCase):
+    def setUp(self):
+        self.pool = manager_pool.ManagerPool(max_size=2, max_idle_secs=60,
+                                             factory=StubManager)
+
+    def tearDown(self):
+        manager_pool.manager_pool = None
+
+    def checkout(self, key_id='KEY', secret='SECRET', region='us-east-1'):
+        with self.pool.Checkout(region, key_id, secret) as manager:
+            return manager
+
+    def test_reuses_returned_manager(self):
+        first = self.checkout()
+        second = self.checkout()
+        self.assertTrue(first is second)
+        self.assertEqual(self.pool.num_created, 1)
+        self.assertEqual(self.pool.num_reused, 1)
+
+    def test_concurrent_checkouts_get_distinct_managers(self):
+        with self.pool.Checkout('us-east-1', 'KEY', 'SECRET') as first:
+            with self.pool.Checkout('us-east-1', 'KEY', 'SECRET') as second:
+                self.assertFalse(first is second)
+        self.assertEqual(self.pool.NumIdle(), 2)
+
+    def test_keyed_by_region_and_secret(self):
+        first = self.checkout()
+        self.assertFalse(first is self.checkout(region='us-west-1'))
+        self.assertFalse(first is self.checkout(secret='NEW'))
+
+    def test_max_size_evicts_least_recently_used(self):
+        self.checkout(key_id='A')
+        self.checkout(key_id='B')
+        self.checkout(key_id='C')
+        self.assertEqual(self.pool.NumIdle(), 2)
+        self.checkout(key_id='A')
+        self.assertEqual(self.pool.num_created, 4)
+
+    def test_idle_expiry(self):
+        self.pool.max_idle_secs = 0
+        first = self.checkout()
+        self.pool.max_idle_secs = -1
+        self.assertFalse(first is self.checkout())
+
+    def test_invalidate_drops_checked_out_manager(self):
+        with self.pool.Checkout('us-east-1', 'KEY', 'SECRET'):
+            self.pool.Invalidate('KEY')
+        self.assertEqual(self.pool.NumIdle(), 0)
+
+    def test_failed_operation_drops_manager(self):
+        try:
+            with self.pool.Checkout('us-east-1', 'KEY', 'SECRET'):
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.pool.NumIdle(), 0)
+
+    def test_saving_credentials_invalidates_pool(self):
+        pool = manager_pool.ManagerPool(factory=StubManager)
+        manager_pool.manager_pool = pool
+        credentials = CreateUser(self.client, 'alice',
+                                 iam_key_id='OLD').iamcredentials
+        with pool.Checkout('us-east-1', 'OLD', 'SECRET'):
+            pass
+        self.assertEqual(pool.NumIdle(), 1)
+        credentials.iam_key_id = 'NEW'
+        credentials.save()
+        self.assertEqual(pool.NumIdle(), 0)
+
+
+class IamCredentialsCacheTest(TestCase):
+    def setUp(self):
+        models.IamCredentialsCache().clear()
+        self.user = CreateUser(self.client, 'gina', iam_key_id=None)
+
+    def test_lookup_is_cached_and_invalidated_on_save(self):
+        self.assertRaises(models.IamCredentials.DoesNotExist,
+                          models.GetIamCredentials, self.user)
+        credentials = models.IamCredentials.objects.create(
+            user=self.user, iam_key_id='KEY', iam_key_secret='SECRET')
+        with self.assertNumQueries(1):
+            models.GetIamCredentials(self.user)
+            models.GetIamCredentials(self.user)
+        credentials.iam_key_id = 'NEWKEY'
+        credentials.save()
+        self.assertEqual(models.GetIamCredentials(self.user).iam_key_id,
+                         'NEWKEY')
+        credentials.delete()
+        self.assertRaises(models.IamCredentials.DoesNotExist,
+                          models.GetIamCredentials, self.user)
+
+    def test_missing_row_is_not_cached(self):
+        self.assertRaises(models.IamCredentials.DoesNotExist,
+                          models.GetIamCredentials, self.user)
+        # As if saved by another process: no signal reaches this cache.
+        models.IamCredentials.objects.bulk_create([
+            models.IamCredentials(user=self.user, iam_key_id='KEY',
+                                  iam_key_secret='SECRET')])
+        self.assertEqual(models.GetIamCredentials(self.user).iam_key_id,
+                         'KEY')
+
+
+class RecordingManager(StubManager):
+    """ Records the operations run against it; fails any in fail_on. """
+    calls = []
+    fail_on = set()
+
+    def __getattr__(self, name):
+        def Operation(*args):
+            if name in RecordingManager.fail_on:
+                raise RuntimeError('%s failed' % (name))
+            RecordingManager.calls.append((name,) + args)
+        return Operation
+
+
+class JobsTest(TestCase):
+    def setUp(self):
+        self.user = CreateUser(self.client, 'bob')
+        manager_pool.manager_pool = manager_pool.ManagerPool(
+            factory=RecordingManager)
+        jobs.executor = jobs.InlineExecutor()
+        RecordingManager.calls = []
+        RecordingManager.fail_on = set()
+
+    def tearDown(self):
+        jobs.executor = None
+        manager_pool.manager_pool = None
+
+    def reload(self, job):
+        return models.Job.objects.get(pk=job.pk)
+
+    def test_runs_job(self):
+        job = jobs.Submit(self.user, 'resize_root_volume', 'us-east-1',
+                          instance_id='i-0001', new_size_gb=20)
+        job = self.reload(job)
+        self.assertEqual(job.state, models.Job.SUCCEEDED)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(RecordingManager.calls,
+                         [('ResizeRootVolumeOfInstance', 'i-0001', 20)])
+
+    def test_failure_is_recorded_and_retryable(self):
+        RecordingManager.fail_on = set(['TerminateInstance'])
+        job = jobs.Submit(self.user, 'terminate_instance', 'us-east-1',
+                          instance_id='i-0001')
+        job = self.reload(job)
+        self.assertEqual(job.state, models.Job.FAILED)
+        self.assertTrue('TerminateInstance failed' in job.error)
+        RecordingManager.fail_on = set()
+        self.assertTrue(jobs.Retry(job))
+        job = self.reload(job)
+        self.assertEqual(job.state, models.Job.SUCCEEDED)
+        self.assertEqual(job.attempts, 2)
+        self.assertFalse(jobs.Retry(job))
+
+    def test_cancelled_job_does_not_run(self):
+        job = models.Job.objects.create(user=self.user,
+                                        kind='terminate_instance',
+                                        region='us-east-1',
+                                        instance_id='i-0001')
+        self.assertTrue(jobs.Cancel(job))
+        jobs.RunJob(job.pk)
+        self.assertEqual(self.reload(job).state, models.Job.CANCELLED)
+        self.assertEqual(RecordingManager.calls, [])
+        self.assertFalse(jobs.Cancel(job))
+
+    def test_views_return_job_id(self):
+        response = self.client.post('/destroy/i-0001',
+                                    {'confirm': 'destroy'})
+        self.assertEqual(response.status_code, 302)
+        job = models.Job.objects.get()
+        response = self.client.get('/jobs/%d' % (job.pk))
+        self.assertEqual(json.loads(response.content)['state'], 'succeeded')
+        response = self.client.post('/jobs/%d/cancel' % (job.pk))
+        self.assertEqual(response.status_code, 409)
+
+    def test_setup_failure_fails_job(self):
+        models.IamCredentials.objects.all().delete()
+        job = jobs.Submit(self.user, 'terminate_instance', 'us-east-1',
+                          instance_id='i-0001')
+        job = self.reload(job)
+        self.assertEqual(job.state, models.Job.FAILED)
+        self.assertTrue('DoesNotExist' in job.error)
+
+    def test_recovers_jobs_of_exited_workers(self):
+        queued = models.Job.objects.create(
+            user=self.user, kind='terminate_instance', region='us-east-1',
+            instance_id='i-0001')
+        running = models.Job.objects.create(
+            user=self.user, kind='terminate_instance', region='us-east-1',
+            instance_id='i-0002', state=models.Job.RUNNING)
+        models.Job.objects.filter(pk=running.pk).update(
+            updated=timezone.now() - datetime.timedelta(hours=2))
+        self.assertEqual(jobs.RecoverJobs(), (1, 1))
+        self.assertEqual(self.reload(queued).state,
+                         models.Job.SUCCEEDED)
+        self.assertEqual(self.reload(running).state, models.Job.FAILED)
+        self.assertEqual(RecordingManager.calls,
+                         [('TerminateInstance', 'i-0001')])
+
+    def test_local_executor_runs_in_worker_threads(self):
+        ran = threading.Event()
+        executor = jobs.LocalExecutor(2)
+        executor.pool.apply_async(ran.set)
+        self.assertTrue(ran.wait(5))
+
+
+class WorkstationsApiTest(FakeManagerTestCase):
+    instance_infos = [FakeInstanceInfo('alpha', 'i-0001', 'pending')]
+
+    def setUp(self):
+        FakeManagerTestCase.setUp(self)
+        CreateUser(self.client, 'carol')
+
+    def test_returns_instances_with_etag(self):
+        response = self.client.get('/api/workstations')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['instances'],
+                         [{'id': 'i-0001', 'name': 'alpha',
+                           'state': 'pending', 'hostname': '',
+                           'region': 'us-east-1'}])
+        self.assertTrue(response['ETag'])
+
+    def test_conditional_get(self):
+        etag = self.client.get('/api/workstations')['ETag']
+        response = self.client.get('/api/workstations',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        inventory.SetInstanceState('KEY', 'us-east-1', 'i-0001',
+                                   'running')
+        response = self.client.get('/api/workstations',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.manager.num_list_calls, 1)
+
+    def test_page_links_carry_region(self):
+        response = self.client.get('/workstations/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'data-region="us-east-1"')
+        self.assertContains(response, '/start/i-0001?region=us-east-1')
+
+
+class MultiRegionTest(TestCase):
+    def setUp(self):
+        inventory.GetCache().clear()
+        self.managers = {
+            'us-east-1': CountingManager([
+                FakeInstanceInfo('alpha', 'i-0001', 'running')]),
+            'eu-west-1': CountingManager([
+                FakeInstanceInfo('beta', 'i-0002', 'stopped')])}
+
+    @contextlib.contextmanager
+    def checkout(self, region):
+        if region == 'ap-south-1':
+            raise RuntimeError('region unreachable')
+        if region in ('sa-east-1', 'ap-northeast-1'):
+            time.sleep(0.5)
+        yield self.managers.get(region, CountingManager([]))
+
+    def test_lists_regions_concurrently(self):
+        instances, errors = inventory.ListAllInstances(
+            'KEY', ['us-east-1', 'eu-west-1'], self.checkout)
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted((i['id'], i['region']) for i in instances),
+                         [('i-0001', 'us-east-1'), ('i-0002', 'eu-west-1')])
+
+    def test_partial_results_with_error_markers(self):
+        instances, errors = inventory.ListAllInstances(
+            'KEY', ['us-east-1', 'ap-south-1', 'sa-east-1'], self.checkout,
+            timeout=0.1)
+        self.assertEqual([i['id'] for i in instances], ['i-0001'])
+        self.assertEqual(sorted(errors), ['ap-south-1', 'sa-east-1'])
+        self.assertTrue('Timed out' in errors['sa-east-1'])
+
+    def test_timeout_counts_from_task_start(self):
+        saved = inventory.pool
+        inventory.pool = mp_pool.ThreadPool(processes=1)
+        try:
+            # Each region takes 0.5s and waits for the other one's thread.
+            instances, errors = inventory.ListAllInstances(
+                'KEY', ['sa-east-1', 'ap-northeast-1'], self.checkout,
+                timeout=0.8)
+        finally:
+            inventory.pool.close()
+            inventory.pool = saved
+        self.assertEqual(errors, {})
+
+
+class InstanceEventsTest(FakeManagerTestCase):
+    instance_infos = [FakeInstanceInfo('alpha', 'i-0001', 'pending')]
+
+    def test_diff_snapshots(self):
+        old = [{'id': 'i-1', 'name': 'a', 'state': 'pending', 'hostname': ''},
+               {'id': 'i-2', 'name': 'b', 'state': 'running', 'hostname': 'h'}]
+        new = [{'id': 'i-1', 'name': 'a', 'state': 'running', 'hostname': 'x'},
+               {'id': 'i-3', 'name': 'c', 'state': 'pending', 'hostname': ''}]
+        transitions = instance_events.DiffSnapshots(old, new)
+        self.assertEqual(
+            [(t['id'], t['from'], t['to']) for t in transitions],
+            [('i-1', 'pending', 'running'), ('i-3', None, 'pending'),
+             ('i-2', 'running', 'terminated')])
+        self.assertEqual(instance_events.DiffSnapshots(new, new), [])
+
+    def test_poller_fans_out_transitions(self):
+        poller = instance_events.AccountPoller(
+            'us-east-1', 'KEY', 'SECRET', fast_secs=0.01, slow_secs=0.05)
+        first = poller.Subscribe()
+        second = poller.Subscribe()
+        poller.start()
+        for queue in [first, second]:
+            event_type, snapshot = queue.get(timeout=5)
+            self.assertEqual(event_type, 'snapshot')
+            self.assertEqual(snapshot[0]['state'], 'pending')
+        self.manager.instance_infos = [
+            FakeInstanceInfo('alpha', 'i-0001', 'running', 'alpha.aws.com')]
+        for queue in [first, second]:
+            event_type, transition = queue.get(timeout=5)
+            self.assertEqual(event_type, 'transition')
+            self.assertEqual((transition['from'], transition['to']),
+                             ('pending', 'running'))
+        cached = inventory.GetCache().get(
+            inventory.CacheKey('KEY', 'us-east-1'))
+        self.assertEqual(cached[0]['state'], 'running')
+        poller.Unsubscribe(first)
+        poller.Unsubscribe(second)
+        poller.join(5)
+        self.assertFalse(poller.is_alive())
+        self.assertTrue(poller.stopped)
+        self.assertTrue(poller.Subscribe() is None)
+
+    @override_settings(WORKSTATION_EVENTS_MAX_STREAMS=1)
+    def test_streams_per_process_are_capped(self):
+        CreateUser(self.client, 'mia')
+        first = self.client.get('/api/workstations/events')
+        self.assertEqual(next(first.streaming_content), 'retry: 5000\n\n')
+        second = self.client.get('/api/workstations/events')
+        self.assertEqual(second.status_code, 503)
+        first.close()
+        third = self.client.get('/api/workstations/events')
+        self.assertEqual(third.status_code, 200)
+        next(third.streaming_content)
+        third.close()
+        self.assertEqual(instance_events.num_streams, 0)
+
+    def test_one_poller_per_account(self):
+        instance_events.pollers.clear()
+        poller, first = instance_events.Subscribe('us-east-1', 'KEY', 'S')
+        same, second = instance_events.Subscribe('us-east-1', 'KEY', 'S')
+        self.assertTrue(poller is same)
+        instance_events.Unsubscribe(poller, first)
+        instance_events.Unsubscribe(poller, second)
+        poller.join(5)
+        self.assertFalse(poller.is_alive())
+
+
+class ConnectTest(FakeManagerTestCase):
+    instance_infos = [
+        FakeInstanceInfo('my_box', 'i-0001', 'running', 'box.aws.com')]
+
+    def setUp(self):
+        FakeManagerTestCase.setUp(self)
+        session_configs.GetCache().clear()
+        CreateUser(self.client, 'dave')
+
+    def test_miss_then_hit(self):
+        response = self.client.get('/connect/i-0001')
+        self.assertEqual(response.content, 'nx config for i-0001')
+        self.assertTrue('my-box.nxs' in response['Content-Disposition'])
+        self.assertEqual(self.manager.num_info_calls, 1)
+        self.assertEqual(self.manager.num_config_calls, 1)
+        # Once the inventory is cached, the config is served from cache.
+        self.client.get('/workstations/')
+        second = self.client.get('/connect/i-0001')
+        self.assertEqual(second.content, response.content)
+        self.assertEqual(second['ETag'], response['ETag'])
+        self.assertEqual(self.manager.num_config_calls, 1)
+        self.assertEqual(self.manager.num_info_calls, 1)
+
+    def test_new_hostname_misses(self):
+        session_configs.Put('i-0001', 'old.aws.com', 'my_box', 'stale')
+        self.client.get('/workstations/')
+        response = self.client.get('/connect/i-0001')
+        self.assertEqual(response.content, 'nx config for i-0001')
+
+    def test_stop_evicts(self):
+        self.client.get('/workstations/')
+        self.client.get('/connect/i-0001')
+        self.manager.StopInstance = lambda instance_id: None
+        self.client.get('/stop/i-0001')
+        self.assertEqual(session_configs.Get('i-0001', 'box.aws.com'),
+                         None)
+
+
+class FakeEc2Instance(object):
+    def __init__(self, ec2, id, state):
+        self.ec2 = ec2
+        self.id = id
+        self.state = state
+
+    def modify_attribute(self, attribute, value):
+        self.ec2.calls.append(('modify_attribute', self.id))
+
+
+class FakeEc2(object):
+    """ Stands in for a boto EC2 connection and records its calls. """
+
+    def __init__(self, states, fail_ids=()):
+        self.instances = [FakeEc2Instance(self, i, s) for i, s in states]
+        self.fail_ids = fail_ids
+        self.throttled = False
+        self.calls = []
+
+    def get_all_instances(self, filters=None):
+        self.calls.append(('get_all_instances',))
+        reservation = ec2_instance.Reservation()
+        reservation.instances = self.instances
+        return [reservation]
+
+    def Call(self, name, instance_ids):
+        self.calls.append((name, tuple(instance_ids)))
+        if self.throttled:
+            raise exception.EC2ResponseError(
+                503, 'Service Unavailable',
+                '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                '<Message>slow</Message></Error></Errors></Response>')
+        if set(instance_ids) & set(self.fail_ids):
+            raise exception.EC2ResponseError(400, 'Bad Request')
+
+    def start_instances(self, instance_ids):
+        self.Call('start_instances', instance_ids)
+
+    def stop_instances(self, instance_ids):
+        self.Call('stop_instances', instance_ids)
+
+    def terminate_instances(self, instance_ids):
+        self.Call('terminate_instances', instance_ids)
+
+
+class BulkPowerTest(FakeManagerTestCase):
+    def setUp(self):
+        FakeManagerTestCase.setUp(self)
+        CreateUser(self.client, 'erin')
+        self.manager.workstation_tag = 'cirrus_workstation'
+
+    def post(self, action, instance_ids, **params):
+        params['instance_id'] = instance_ids
+        response = self.client.post('/api/workstations/%s' % (action), params)
+        return response.status_code, json.loads(response.content)
+
+    def test_stop_is_one_batched_call(self):
+        self.manager.ec2 = FakeEc2([('i-01', 'running'), ('i-02', 'running'),
+                                    ('i-03', 'stopped')])
+        status, data = self.post('stop', ['i-01', 'i-02', 'i-03', 'i-04'])
+        self.assertEqual(status, 200)
+        self.assertEqual(self.manager.ec2.calls,
+                         [('get_all_instances',),
+                          ('stop_instances', ('i-01', 'i-02'))])
+        results = data['results']
+        self.assertEqual(results['i-01']['state'], 'stopping')
+        self.assertEqual(results['i-03']['state'], 'stopped')
+        self.assertFalse(results['i-04']['ok'])
+
+    def test_rejected_batch_is_retried_per_instance(self):
+        self.manager.ec2 = FakeEc2([('i-01', 'stopped'), ('i-02', 'stopping')],
+                                   fail_ids=['i-02'])
+        status, data = self.post('start', ['i-01', 'i-02'])
+        self.assertEqual(data['results']['i-01'],
+                         {'ok': True, 'state': 'pending', 'error': None})
+        self.assertFalse(data['results']['i-02']['ok'])
+        self.assertEqual(len(self.manager.ec2.calls), 4)
+
+    def test_throttled_batch_is_a_503(self):
+        self.manager.ec2 = FakeEc2([('i-01', 'running'), ('i-02', 'running'),
+                                    ('i-03', 'running')])
+        self.manager.ec2.throttled = True
+        status, data = self.post('stop', ['i-01', 'i-02', 'i-03'])
+        self.assertEqual(status, 503)
+        self.assertTrue('rate limiting' in data['error'])
+        self.assertEqual(self.manager.ec2.calls[1:],
+                         [('stop_instances', ('i-01', 'i-02', 'i-03'))])
+
+    def test_waits_for_instance_locks(self):
+        self.manager.ec2 = FakeEc2([('i-01', 'running'), ('i-02', 'running')])
+        lock = single_flight.InstanceLock('us-east-1', 'i-02',
+                                          'add_storage', 0)
+        lock.__enter__()
+        try:
+            with override_settings(WORKSTATION_INSTANCE_LOCK_WAIT_SECS=0.1):
+                status, data = self.post('stop', ['i-01', 'i-02'])
+        finally:
+            lock.__exit__(None, None, None)
+        self.assertEqual(status, 409)
+        self.assertTrue('add_storage' in data['error'])
+        self.assertEqual(self.manager.ec2.calls, [])
+        # The lock of i-01 was let go along with the others.
+        status, data = self.post('stop', ['i-01', 'i-02'])
+        self.assertEqual(status, 200)
+        self.assertEqual(self.manager.ec2.calls[-1],
+                         ('stop_instances', ('i-01', 'i-02')))
+
+    def test_destroy_requires_confirmation(self):
+        self.manager.ec2 = FakeEc2([('i-01', 'running'), ('i-02', 'stopped')])
+        status, data = self.post('destroy', ['i-01', 'i-02'])
+        self.assertEqual(status, 400)
+        status, data = self.post('destroy', ['i-01', 'i-02'],
+                                 confirm='destroy')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.manager.ec2.calls[-1],
+                         ('terminate_instances', ('i-01', 'i-02')))
+        self.assertEqual(data['results']['i-02']['state'], 'shutting-down')
+
+
+class CredentialChecksTest(TestCase):
+    def setUp(self):
+        credential_checks.GetCache().clear()
+        self.checked = []
+        self.provisioned = []
+        self.saved = (core.CredentialsValid,
+                      workstation.GetCirrusIamUserCredentials)
+        core.CredentialsValid = self.CredentialsValid
+        workstation.GetCirrusIamUserCredentials = self.Provision
+        CreateUser(self.client, 'frank', iam_key_id=None)
+
+    def tearDown(self):
+        (core.CredentialsValid,
+         workstation.GetCirrusIamUserCredentials) = self.saved
+
+    def CredentialsValid(self, key_id, key_secret):
+        self.checked.append(key_id)
+        return key_secret.startswith('good')
+
+    def Provision(self, key_id, key_secret):
+        self.provisioned.append(key_id)
+        if not key_secret.startswith('good'):
+            raise workstation.InvalidAwsCredentials()
+        return 'IAMKEY', 'IAMSECRET'
+
+    def submit(self, secret):
+        return self.client.post('/setup_credentials/', {
+            'aws_key_id': 'A' * 20, 'aws_key_secret': secret.ljust(40, 'x')})
+
+    def test_cache_never_holds_secret(self):
+        key = credential_checks.CacheKey('A' * 20, 'supersecret')
+        self.assertFalse('supersecret' in key)
+        self.assertNotEqual(key, credential_checks.CacheKey('A' * 20,
+                                                            'other'))
+
+    def test_failures_are_cached(self):
+        for _ in range(3):
+            form = views.SetupAwsCredentialsForm({
+                'aws_key_id': 'A' * 20, 'aws_key_secret': 'bad'.ljust(40, 'x')})
+            self.assertFalse(form.is_valid())
+        self.assertEqual(len(self.checked), 1)
+
+    def test_setup_provisions_iam_user(self):
+        response = self.submit('good')
+        self.assertEqual(response.status_code, 302)
+        credentials = models.IamCredentials.objects.get(user__username='frank')
+        self.assertEqual(credentials.iam_key_id, 'IAMKEY')
+        self.assertEqual(self.provisioned, ['A' * 20])
+        self.assertTrue(credential_checks.CredentialsValid('IAMKEY',
+                                                           'IAMSECRET'))
+        self.assertEqual(len(self.checked), 1)
+
+    def test_invalid_credentials_are_not_provisioned(self):
+        form = views.SetupAwsCredentialsForm({
+            'aws_key_id': 'A' * 20, 'aws_key_secret': 'bad'.ljust(40, 'x')})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(self.provisioned, [])
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.Reset()
+        CreateUser(self.client, 'hank', iam_key_id=None)
+
+    def test_records_queries_per_view(self):
+        with override_settings(DEBUG=True):
+            response = self.client.get('/jobs/12345')
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(int(response['X-Query-Count']) >= 1)
+        self.client.get('/jobs/12345')
+        views = json.loads(self.client.get('/internal/metrics').content)
+        job_status = views['views']['webclient.views.JobStatus']
+        self.assertEqual(job_status['requests'], 2)
+        self.assertTrue(job_status['queries'] >= 2)
+
+    def test_queries_are_counted_without_logging_them(self):
+        self.client.get('/jobs/12345')
+        self.assertEqual(connection.queries, [])
+        job_status = metrics.Snapshot()['webclient.views.JobStatus']
+        self.assertTrue(job_status['queries'] >= 1)
+        with self.assertNumQueries(1):
+            models.Job.objects.count()
+
+    def test_metrics_are_internal(self):
+        response = self.client.get('/internal/metrics',
+                                   REMOTE_ADDR='203.0.113.9')
+        self.assertEqual(response.status_code, 404)
+
+    def test_health_check_closes_dead_connections(self):
+        connection.ensure_connection()
+        connection.last_request_end = time.time() - 60
+        closed = []
+        connection.is_usable = lambda: False
+        connection.close = lambda: closed.append(True)
+        try:
+            db_health.CheckConnections(30)
+        finally:
+            del connection.is_usable
+            del connection.close
+        self.assertEqual(closed, [True])
+
+
+class FakeConnection(object):
+    def make_request(self, action, params=None):
+        return 'response to %s' % (action)
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        profiling.Reset()
+        CreateUser(self.client, 'ida', iam_key_id=None)
+
+    def test_samples_views(self):
+        self.client.get('/jobs/12345')
+        self.assertEqual(profiling.Snapshot()['views'], {})
+        with override_settings(WORKSTATION_PROFILING_SAMPLE_RATE=1.0):
+            self.client.get('/jobs/12345')
+        self.client.get('/jobs/12345', HTTP_X_PROFILE='1')
+        self.client.get('/jobs/12345', HTTP_X_PROFILE='1',
+                        REMOTE_ADDR='203.0.113.9')
+        views = profiling.Snapshot()['views']
+        self.assertEqual(views['webclient.views.JobStatus']['count'], 2)
+
+    def test_profiled_view_errors_reach_other_middleware(self):
+        models.IamCredentials.objects.create(
+            user=User.objects.get(username='ida'),
+            iam_key_id='AKIFAKEPROFILING', iam_key_secret='s' * 40)
+        cloud = fake_backend.FakeCloud()
+        instance_id = cloud.AddInstance('us-east-1', 'AKIFAKEPROFILING', 'w',
+                                        state='stopped')
+        def StartInstance(manager, instance_id):
+            raise exception.EC2ResponseError(
+                503, 'Service Unavailable',
+                '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                '</Error></Errors></Response>')
+        saved = fake_backend.FakeManager.StartInstance
+        fake_backend.FakeManager.StartInstance = StartInstance
+        try:
+            with fake_backend.Installed(cloud):
+                with override_settings(WORKSTATION_PROFILING_SAMPLE_RATE=1.0):
+                    response = self.client.get(
+                        '/start/%s?region=us-east-1' % (instance_id))
+        finally:
+            fake_backend.FakeManager.StartInstance = saved
+        self.assertEqual(response.status_code, 503)
+        views = profiling.Snapshot()['views']
+        self.assertEqual(views['webclient.views.Start']['count'], 1)
+
+    def test_keeps_slowest_dumps(self):
+        directory = tempfile.mkdtemp()
+        try:
+            dumps = profiling.SlowestDumps(directory, 2)
+            for secs in [0.3, 0.1, 0.5, 0.2]:
+                dumps.Offer(cProfile.Profile(), 'v', secs)
+            kept = sorted(int(f.split('-')[0]) for f in os.listdir(directory))
+            self.assertEqual(kept, [300, 500])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_times_manager_and_ec2_calls(self):
+        manager = CountingManager([FakeInstanceInfo('w', 'i-1', 'running')])
+        manager.ec2 = FakeConnection()
+        timed = profiling.TimedManager(manager)
+        self.assertEqual(len(timed.ListInstances()), 1)
+        self.assertEqual(manager.num_list_calls, 1)
+        self.assertEqual(timed.ec2.make_request('DescribeInstances'),
+                         'response to DescribeInstances')
+        profile = profiling.Snapshot()
+        self.assertEqual(profile['manager']['ListInstances']['count'], 1)
+        self.assertEqual(profile['ec2']['DescribeInstances']['count'], 1)
+
+
+class FakeBackendTest(TestCase):
+    def setUp(self):
+        for cache in caches.all():
+            cache.clear()
+        CreateUser(self.client, 'jack', iam_key_id='AKIFAKEBACKEND',
+                   iam_key_secret='s' * 40)
+
+    def test_views_run_against_fake_cloud(self):
+        cloud = fake_backend.FakeCloud()
+        ids = cloud.AddInstances('us-east-1', 'AKIFAKEBACKEND', 3,
+                                 stopped_fraction=0)
+        with fake_backend.Installed(cloud):
+            response = self.client.get('/workstations/')
+            self.assertContains(response, ids[0])
+            response = self.client.get('/stop/%s?region=us-east-1' % (ids[0]))
+            self.assertEqual(response.status_code, 302)
+            response = self.client.get('/connect/%s?region=us-east-1' % (ids[1]))
+            self.assertContains(response, 'NXClientSettings')
+        info = cloud.Instances('us-east-1', 'AKIFAKEBACKEND')[ids[0]]
+        self.assertEqual(info.state, 'stopped')
+        self.assertEqual(cloud.num_calls['ListInstances'], 1)
+
+
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        single_flight.GetCache().clear()
+
+    def test_identical_operations_coalesce(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def StartInstance():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'started'
+        results = []
+        def Click():
+            results.append(single_flight.Do('us-east-1', 'i-1', 'start',
+                                            StartInstance))
+        leader = threading.Thread(target=Click)
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=Click) for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while single_flight.Snapshot()['coalesced'] < 3:
+            release.wait(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['started'] * 4)
+
+    def test_conflicting_operation_waits_for_lock(self):
+        lock = single_flight.InstanceLock('us-east-1', 'i-2', 'stop', 0)
+        with lock:
+            self.assertRaises(single_flight.InstanceBusy,
+                              single_flight.Do, 'us-east-1', 'i-2',
+                              'terminate_instance:{}', lambda: None,
+                              wait_secs=0.1)
+        self.assertEqual(
+            single_flight.Do('us-east-1', 'i-2', 'terminate_instance:{}',
+                             lambda: 'terminated'),
+            'terminated')
+
+    def test_skips_operation_just_run_by_lock_holder(self):
+        calls = []
+        lock = single_flight.InstanceLock('us-east-1', 'i-3', 'stop', 0)
+        lock.__enter__()
+        def OtherProcess():
+            # Stands in for another worker that ran the same stop.
+            time.sleep(0.1)
+            single_flight.GetCache().set(
+                'instance_last_op:us-east-1:i-3', ('stop', time.time(), None))
+            lock.__exit__(None, None, None)
+        thread = threading.Thread(target=OtherProcess)
+        thread.start()
+        single_flight.Do('us-east-1', 'i-3', 'stop',
+                         lambda: calls.append(1))
+        thread.join()
+        self.assertEqual(calls, [])
+
+
+class FakeHttpResponse(object):
+    def __init__(self, status, body=''):
+        self.status = status
+        self.reason = 'Service Unavailable' if status == 503 else 'OK'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+    def getheaders(self):
+        return []
+
+
+class FakeHttpConnection(object):
+    """ Stands in for boto's HTTP connection, answering with responses. """
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def request(self, method, path, body, headers):
+        pass
+
+    def getresponse(self):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+class RateLimitTest(TestCase):
+    def setUp(self):
+        rate_limit.GetCache().clear()
+
+    def test_reads_leave_reserve_to_mutations(self):
+        bucket = rate_limit.TokenBucket('test_bucket', 1, 3, 2)
+        self.assertEqual(bucket.TryTake(read=True), 0)
+        self.assertTrue(bucket.TryTake(read=True) > 0)
+        self.assertEqual(bucket.TryTake(read=False), 0)
+        self.assertEqual(bucket.TryTake(read=False), 0)
+        self.assertTrue(bucket.TryTake(read=False) > 0)
+
+    def test_retries_throttled_calls(self):
+        throttled = FakeHttpResponse(
+            503, '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+            '</Error></Errors></Response>')
+        responses = [throttled, throttled, FakeHttpResponse(200, 'ok')]
+        actions = []
+        def MakeRequest(action, params=None):
+            actions.append(action)
+            return responses.pop(0)
+        bucket = rate_limit.TokenBucket('test_bucket', 1000, 10, 0)
+        call = rate_limit.RateLimitedEc2Request(MakeRequest, bucket)
+        before = rate_limit.Snapshot()
+        with override_settings(WORKSTATION_EC2_BACKOFF_BASE_SECS=0.001):
+            response = call('StartInstances')
+        self.assertEqual(response.read(), 'ok')
+        self.assertEqual(actions, ['StartInstances'] * 3)
+        after = rate_limit.Snapshot()
+        self.assertEqual(after['retried'] - before['retried'], 2)
+
+    def test_retries_throttling_raised_by_boto(self):
+        throttled = ('<Response><Errors><Error><Code>RequestLimitExceeded'
+                     '</Code><Message>Request limit exceeded.</Message>'
+                     '</Error></Errors></Response>')
+        zones = ('<DescribeAvailabilityZonesResponse><availabilityZoneInfo>'
+                 '<item><zoneName>us-east-1a</zoneName></item>'
+                 '</availabilityZoneInfo></DescribeAvailabilityZonesResponse>')
+        http = FakeHttpConnection([FakeHttpResponse(503, throttled),
+                                   FakeHttpResponse(503, throttled),
+                                   FakeHttpResponse(200, zones)])
+        class Manager(object):
+            ec2 = ec2_connection.EC2Connection('AKIAFAKE', 'fake-secret')
+        Manager.ec2.get_http_connection = lambda *args: http
+        factory = rate_limit.RateLimitedManagerFactory(
+            lambda region, key_id, key_secret: Manager())
+        manager = factory('us-east-1', 'AKIAFAKE', 'fake-secret')
+        before = rate_limit.Snapshot()
+        with override_settings(WORKSTATION_EC2_BACKOFF_BASE_SECS=0.001):
+            self.assertEqual([z.name for z in manager.ec2.get_all_zones()],
+                             ['us-east-1a'])
+            after = rate_limit.Snapshot()
+            self.assertEqual(after['throttled'] - before['throttled'], 2)
+            self.assertEqual(after['retried'] - before['retried'], 2)
+
+            # Once the retries run out the error reaches the middleware.
+            http.responses = [FakeHttpResponse(503, throttled)
+                              for _ in range(3)]
+            with override_settings(WORKSTATION_EC2_MAX_RETRIES=2):
+                with self.assertRaises(exception.BotoServerError) as raised:
+                    manager.ec2.get_all_zones()
+        self.assertEqual(http.responses, [])
+        response = rate_limit.ThrottledMiddleware().process_exception(
+            RequestFactory().get('/workstations/'), raised.exception)
+        self.assertEqual(response.status_code, 503)
+
+        # A pooled Manager's connection was reset while idle.
+        http.responses = [socket.error(104, 'Connection reset by peer'),
+                          FakeHttpResponse(200, zones)]
+        with override_settings(WORKSTATION_EC2_BACKOFF_BASE_SECS=0.001):
+            self.assertEqual([z.name for z in manager.ec2.get_all_zones()],
+                             ['us-east-1a'])
+        self.assertEqual(http.responses, [])
+
+    def test_middleware_answers_throttling_with_503(self):
+        e = exception.EC2ResponseError(
+            503, 'Service Unavailable',
+            '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+            '<Message>Request limit exceeded.</Message></Error></Errors>'
+            '</Response>')
+        request = RequestFactory().get('/api/workstations')
+        response = rate_limit.ThrottledMiddleware().process_exception(
+            request, e)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(rate_limit.ThrottledMiddleware().process_exception(
+            request, ValueError()), None)
+
+
+class TaggedEc2Instance(object):
+    def __init__(self, id, name, state):
+        self.id = id
+        self.tags = {'Name': name, 'workstation': ''}
+        self.state = state
+        self.public_dns_name = ''
+
+
+class FilteringEc2(object):
+    """ Stands in for a boto EC2 connection, applying DescribeInstances
+    filters and recording them. """
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.filters = []
+
+    def get_all_instances(self, filters=None):
+        self.filters.append(filters)
+        filters = filters or {}
+        reservation = ec2_instance.Reservation()
+        reservation.instances = [
+            i for i in self.instances
+            if i.state in filters.get('instance-state-name', [i.state]) and
+            i.id in filters.get('instance-id', [i.id])]
+        return [reservation]
+
+
+class IncrementalInventoryTest(TestCase):
+    def setUp(self):
+        inventory.GetCache().clear()
+        self.ec2_instances = [TaggedEc2Instance('i-1', 'one', 'running'),
+                              TaggedEc2Instance('i-2', 'two', 'stopped')]
+        self.manager = CountingManager([
+            FakeInstanceInfo(i.tags['Name'], i.id, i.state)
+            for i in self.ec2_instances])
+        self.manager.ec2 = FilteringEc2(self.ec2_instances)
+        self.manager.workstation_tag = 'workstation'
+        CreateUser(self.client, 'kim')
+
+    def test_store_waits_for_state_lock(self):
+        cache = inventory.GetCache()
+        lock_key = inventory.StateKey('KEY', 'us-east-1') + ':lock'
+        inventory.Store('KEY', 'us-east-1', [], full=True)
+        cache.add(lock_key, 'other', 5)
+        store = threading.Thread(target=inventory.Store, args=(
+            'KEY', 'us-east-1', [{'id': 'i-1', 'state': 'running'}], False))
+        store.start()
+        time.sleep(0.1)
+        self.assertTrue(inventory.Cursor('KEY', 'us-east-1').endswith('.0'))
+        cache.delete(lock_key)
+        store.join()
+        self.assertTrue(inventory.Cursor('KEY', 'us-east-1').endswith('.1'))
+
+    def test_set_instance_state_keeps_concurrent_store(self):
+        cache = inventory.GetCache()
+        lock_key = inventory.StateKey('KEY', 'us-east-1') + ':lock'
+        one = {'id': 'i-1', 'state': 'running', 'hostname': 'one.aws.com'}
+        two = {'id': 'i-2', 'state': 'stopped', 'hostname': ''}
+        inventory.Store('KEY', 'us-east-1', [one], full=True)
+        cache.add(lock_key, 'other', 5)
+        patch = threading.Thread(target=inventory.SetInstanceState, args=(
+            'KEY', 'us-east-1', 'i-1', 'stopping'))
+        patch.start()
+        time.sleep(0.1)
+        # What the lock holder stores meanwhile.
+        cache.set(inventory.CacheKey('KEY', 'us-east-1'), [one, two])
+        cache.delete(lock_key)
+        patch.join()
+        self.assertEqual(
+            cache.get(inventory.CacheKey('KEY', 'us-east-1')),
+            [dict(one, state='stopping', hostname=''), two])
+
+    def test_refresh_only_asks_for_instances_in_flux(self):
+        inventory.Refresh('KEY', 'us-east-1', self.manager)
+        self.assertEqual(self.manager.num_list_calls, 1)
+        cursor = inventory.Cursor('KEY', 'us-east-1')
+        inventory.SetInstanceState('KEY', 'us-east-1', 'i-2', 'pending')
+        self.ec2_instances[1].state = 'running'
+        self.ec2_instances.append(TaggedEc2Instance('i-3', 'three', 'pending'))
+        instances = inventory.Refresh('KEY', 'us-east-1', self.manager)
+        self.assertEqual(self.manager.num_list_calls, 1)
+        self.assertEqual([(i['id'], i['state']) for i in instances],
+                         [('i-1', 'running'), ('i-2', 'running'),
+                          ('i-3', 'pending')])
+        self.assertEqual(self.manager.ec2.filters[-1]['instance-id'], ['i-2'])
+        _, changed, removed = inventory.Changes('KEY', 'us-east-1', cursor)
+        self.assertEqual([i['id'] for i in changed], ['i-2', 'i-3'])
+        self.assertEqual(removed, [])
+        inventory.Invalidate('KEY', 'us-east-1')
+        inventory.Refresh('KEY', 'us-east-1', self.manager)
+        self.assertEqual(self.manager.num_list_calls, 2)
+
+    def test_api_returns_changes_since_cursor(self):
+        manager = self.manager
+        class ManagerPool(object):
+            @contextlib.contextmanager
+            def Checkout(self, region, iam_key_id, iam_key_secret):
+                yield manager
+        old_pool = manager_pool.manager_pool
+        manager_pool.manager_pool = ManagerPool()
+        try:
+            data = json.loads(self.client.get('/api/workstations').content)
+            self.assertEqual(len(data['instances']), 2)
+            inventory.SetInstanceState('KEY', 'us-east-1', 'i-1', 'stopping')
+            data = json.loads(self.client.get(
+                '/api/workstations', {'since': data['cursor']}).content)
+        finally:
+            manager_pool.manager_pool = old_pool
+        self.assertFalse('instances' in data)
+        self.assertEqual([(i['id'], i['state'], i['region'])
+                          for i in data['changed']],
+                         [('i-1', 'stopping', 'us-east-1')])
+        self.assertEqual(inventory.AllChanges('KEY', ['us-east-1'],
+                                              'us-east-1:stale.1'), None)
+
+
+class WorkstationListTest(TestCase):
+    def setUp(self):
+        inventory.GetCache().clear()
+        CreateUser(self.client, 'lee')
+        instances = [{'id': 'i-%04x' % (i), 'name': 'ws%03d' % (i),
+                      'state': 'running' if i % 3 else 'stopped',
+                      'hostname': ''}
+                     for i in range(120)]
+        inventory.GetCache().set(inventory.CacheKey('KEY', 'us-east-1'),
+                                 instances)
+
+    def names(self, response):
+        return [i['name'] for i in response.context['instances']]
+
+    def test_renders_one_page(self):
+        response = self.client.get('/workstations/')
+        self.assertEqual(len(response.context['instances']), 50)
+        self.assertEqual(response.context['page'].paginator.count, 120)
+        self.assertContains(response, 'id="row-', count=50)
+        response = self.client.get('/workstations/', {'page': 3})
+        self.assertEqual(self.names(response)[-1], 'ws119')
+        response = self.client.get('/workstations/', {'page': 'bogus'})
+        self.assertEqual(self.names(response)[0], 'ws000')
+
+    def test_filters_and_sorts(self):
+        response = self.client.get('/workstations/', {'state': 'stopped',
+                                                      'sort': '-name'})
+        self.assertEqual(response.context['page'].paginator.count, 40)
+        self.assertEqual(self.names(response)[:2], ['ws117', 'ws114'])
+        response = self.client.get('/workstations/', {'q': 'WS11'})
+        self.assertEqual(self.names(response),
+                         ['ws%03d' % (i) for i in range(110, 120)])
+
+    def test_partial_rows(self):
+        response = self.client.get('/workstations/', {'partial': 'rows',
+                                                      'page': 2,
+                                                      'per_page': 100})
+        self.assertEqual(response['X-Has-Next'], 'false')
+        self.assertContains(response, 'id="row-', count=20)
+        self.assertNotContains(response, '<html')
+
+    def test_page_links_keep_page_size(self):
+        response = self.client.get('/workstations/', {'per_page': 30,
+                                                      'page': 2})
+        self.assertEqual(response.context['page'].start_index(), 31)
+        self.assertContains(response, 'per_page=30&amp;sort=name&amp;page=3')
+        self.assertContains(response, 'per_page=30&amp;sort=name&amp;page=1')
+        response = self.client.get('/workstations/')
+        self.assertNotContains(response, 'per_page=')
@@ -3,28 +3,82 @@ from django.contrib import messages
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from django import forms
+from django.conf import settings
 from django.http import HttpResponseRedirect
-#import multiprocessing
+from django.http import Http404
+from django.http import HttpResponseNotModified
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_POST
 from cirruscluster import core
 from cirruscluster import workstation
 
+import bulk_power
+import credential_checks
+import instance_events
+import inventory
+import jobs
+import manager_pool
 import models
+import rate_limit
+import session_configs
+import single_flight
+import workstation_list
 from boto import exception
+import json
+import multiprocessing
+import Queue
+import re
+import time
+
+default_region = 'us-east-1'
+
+def GetIamCredentials(request):
+  """ The user's IamCredentials, via the cache in models.GetIamCredentials.
+  
+  Raises models.IamCredentials.DoesNotExist if there are none.
+  """
+  if not hasattr(request, 'iam_credentials'):
+    request.iam_credentials = models.GetIamCredentials(request.user)
+  return request.iam_credentials
+
+def CheckoutManager(request, region=default_region):
+  """ Checks out a pooled Manager for the user's IAM credentials.
+  
+  Use as: with CheckoutManager(request) as manager: ...
+  """
+  iam_credentials = GetIamCredentials(request)
+  pool = manager_pool.GetManagerPool()
+  return pool.Checkout(region, iam_credentials.iam_key_id,
+                       iam_credentials.iam_key_secret)
+
+def GetRegions():
+  """ Regions whose workstations are listed, from WORKSTATION_REGIONS. """
+  return getattr(settings, 'WORKSTATION_REGIONS', [default_region])
+
+
+def GetRegion(request):
+  """ The configured region named by the region GET/POST parameter. """
+  region = request.GET.get('region') or request.POST.get('region')
+  if not region:
+    return default_region
+  if region not in GetRegions():
+    raise Http404
+  return region
+
+
+def ListAllInstances(request, iam_credentials):
+  """ Lists the user's workstations in all regions, see 
+  inventory.ListAllInstances. """
+  key_id = iam_credentials.iam_key_id
+  key_secret = iam_credentials.iam_key_secret
+  pool = manager_pool.GetManagerPool()
+  return inventory.ListAllInstances(
+      key_id, GetRegions(),
+      lambda region: pool.Checkout(region, key_id, key_secret))
 
-#worker_pool = None
-#
-#def GetWorkerPool():
-#  global worker_pool
-#  if not worker_pool:
-#    worker_pool = multiprocessing.Pool(processes=20)  # start worker processes
-#  return worker_pool
-
-def GetManager(request):
-  iam_credentials = request.user.iamcredentials
-  region = 'us-east-1'
-  manager = workstation.Manager(region, iam_credentials.iam_key_id,
-                                iam_credentials.iam_key_secret)
-  return manager
 
 def Index(request):
   context = {}
@@ -36,48 +90,256 @@ def Workstations(request):
   # check if iam credentials are in DB
   iam_credentials = None
   try: 
-   iam_credentials = request.user.iamcredentials
+   iam_credentials = GetIamCredentials(request)
   except:
     pass
   
   # get IAM credentials, if needed using root AWS credentials
   if not iam_credentials:
     return HttpResponseRedirect('/setup_credentials') # Redirect after POST
+  if credential_checks.KnownInvalid(iam_credentials.iam_key_id,
+                                    iam_credentials.iam_key_secret):
+    return HttpResponseRedirect('/setup_credentials')
 
   try:
-    manager = GetManager(request)
+    instances, region_errors = ListAllInstances(request, iam_credentials)
   except workstation.InvalidAwsCredentials:
+    credential_checks.RecordResult(iam_credentials.iam_key_id,
+                                   iam_credentials.iam_key_secret, False)
     return HttpResponseRedirect('/setup_credentials') # Redirect after POST
-  instances = manager.ListInstances()
-  context = {'instances': instances}
+  params = workstation_list.ListParams(request.GET)
+  page = workstation_list.GetPage(instances, params)
+  context = {'instances': page.object_list,
+             'page': page,
+             'params': params,
+             'base_query': params.Query(),
+             'sort_links': params.SortLinks(),
+             'state_counts': workstation_list.StateCounts(instances),
+             'num_instances': len(instances),
+             'region_errors': sorted(region_errors.items()),
+             'regions_json': json.dumps(GetRegions()),
+             'show_regions': len(GetRegions()) > 1}
+  if request.GET.get('partial') == 'rows':
+    # Rows of a further page, appended to the table by the page's script.
+    response = render(request, 'workstation_rows.html', context)
+    response['X-Has-Next'] = 'true' if page.has_next() else 'false'
+    return response
   return render(request, 'workstations.html', context)
 
 
+@login_required(login_url='/accounts/login/')
+def WorkstationsApi(request):
+  """ JSON instance states for polling clients, with ETag support.
+
+    {"instances": [...], "errors": {region: message}, "cursor": "..."}
+
+  Given the cursor of an earlier response as the since parameter, answers
+  with only what changed since, if the change log still covers it:
+
+    {"changed": [...], "removed": [{"id": ..., "region": ...}],
+     "errors": {...}, "cursor": "..."}
+  """
+  try:
+    iam_credentials = GetIamCredentials(request)
+  except models.IamCredentials.DoesNotExist:
+    return JsonResponse({'error': 'No AWS credentials configured.'}, status=403)
+  if credential_checks.KnownInvalid(iam_credentials.iam_key_id,
+                                    iam_credentials.iam_key_secret):
+    return JsonResponse({'error': 'Invalid AWS credentials.'}, status=403)
+  try:
+    instances, errors = ListAllInstances(request, iam_credentials)
+  except workstation.InvalidAwsCredentials:
+    credential_checks.RecordResult(iam_credentials.iam_key_id,
+                                   iam_credentials.iam_key_secret, False)
+    return JsonResponse({'error': 'Invalid AWS credentials.'}, status=403)
+  key_id = iam_credentials.iam_key_id
+  regions = [r for r in GetRegions() if r not in errors]
+  changes = None
+  if request.GET.get('since'):
+    changes = inventory.AllChanges(key_id, regions, request.GET['since'])
+  if changes:
+    cursor, changed, removed = changes
+    data = {'changed': changed, 'removed': removed, 'errors': errors,
+            'cursor': cursor}
+  else:
+    data = {'instances': instances, 'errors': errors,
+            'cursor': inventory.AllCursor(key_id, regions)}
+  etag = inventory.Etag(data)
+  if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+    response = HttpResponseNotModified()
+  else:
+    response = JsonResponse(data)
+  response['ETag'] = quote_etag(etag)
+  response['Cache-Control'] = 'private, no-cache'
+  return response
+
+
+def StreamInstanceEvents(poller, queue, max_secs, keepalive_secs):
+  """ Yields server-sent events from a poller subscription. """
+  try:
+    yield 'retry: 5000\n\n'
+    deadline = time.time() + max_secs
+    while time.time() < deadline:
+      try:
+        event_type, data = queue.get(timeout=keepalive_secs)
+      except Queue.Empty:
+        yield ': keepalive\n\n'
+        continue
+      yield 'event: %s\ndata: %s\n\n' % (event_type, json.dumps(data))
+  finally:
+    instance_events.Unsubscribe(poller, queue)
+    instance_events.CloseStream()
+  return
+
+
+@login_required(login_url='/accounts/login/')
+def WorkstationEvents(request):
+  """ Server-sent stream of instance state transitions.
+  
+  Streams end after WORKSTATION_EVENTS_MAX_STREAM_SECS so they don't hold a 
+  worker indefinitely; EventSource clients reconnect and get a fresh snapshot.
+  Once a worker has WORKSTATION_EVENTS_MAX_STREAMS streams open it answers 
+  with a 503, and the page polls /api/workstations instead.
+  """
+  try:
+    iam_credentials = GetIamCredentials(request)
+  except models.IamCredentials.DoesNotExist:
+    return JsonResponse({'error': 'No AWS credentials configured.'}, status=403)
+  if not instance_events.OpenStream():
+    response = JsonResponse({'error': 'Too many open event streams.'}, 
+                            status=503)
+    response['Retry-After'] = '60'
+    return response
+  try:
+    poller, queue = instance_events.Subscribe(GetRegion(request),
+                                              iam_credentials.iam_key_id,
+                                              iam_credentials.iam_key_secret)
+  except Exception:
+    instance_events.CloseStream()
+    raise
+  max_secs = getattr(settings, 'WORKSTATION_EVENTS_MAX_STREAM_SECS', 300)
+  response = StreamingHttpResponse(
+      StreamInstanceEvents(poller, queue, max_secs, keepalive_secs=15),
+      content_type='text/event-stream')
+  response['Cache-Control'] = 'no-cache'
+  response['X-Accel-Buffering'] = 'no'  # don't let nginx buffer the stream
+  return response
+
+
 @login_required(login_url='/accounts/login/')
 def Stop(request, instance_id):
   instance_id = instance_id.encode('ascii', 'ignore')
-  GetManager(request).StopInstance(instance_id)  
+  region = GetRegion(request)
+  def StopInstance():
+    with CheckoutManager(request, region) as manager:
+      manager.StopInstance(instance_id)
+  try:
+    single_flight.Do(region, instance_id, 'stop', StopInstance)
+  except single_flight.InstanceBusy as e:
+    messages.error(request, str(e))
+    return HttpResponseRedirect('/workstations')
+  session_configs.Evict(instance_id)
+  inventory.SetInstanceState(GetIamCredentials(request).iam_key_id,
+                             region, instance_id, 'stopping')
+  instance_events.Poke(region, GetIamCredentials(request).iam_key_id)
   return HttpResponseRedirect('/workstations')
 
 @login_required(login_url='/accounts/login/')
 def Start(request, instance_id):
   instance_id = instance_id.encode('ascii', 'ignore')
-  GetManager(request).StartInstance(instance_id)  
+  region = GetRegion(request)
+  def StartInstance():
+    with CheckoutManager(request, region) as manager:
+      manager.StartInstance(instance_id)
+  try:
+    single_flight.Do(region, instance_id, 'start', StartInstance)
+  except single_flight.InstanceBusy as e:
+    messages.error(request, str(e))
+    return HttpResponseRedirect('/workstations')
+  inventory.SetInstanceState(GetIamCredentials(request).iam_key_id,
+                             region, instance_id, 'pending')
+  instance_events.Poke(region, GetIamCredentials(request).iam_key_id)
   return HttpResponseRedirect('/workstations')
 
 
+valid_instance_id = re.compile(r'^i-[0-9a-fA-F]+$')
+
+@require_POST
+@login_required(login_url='/accounts/login/')
+def BulkPower(request, action):
+  """ Starts, stops or destroys the workstations listed in the instance_id 
+  POST parameters and returns JSON per-instance results:
+  
+    {"results": {"i-1234abcd": {"ok": true, "state": "stopping", "error": null},
+                 ...}}
+  
+  Destroying requires confirm=destroy, like the Destroy form.  All instances
+  must be in the region given by the region parameter.  The instances are 
+  locked against other operations on them meanwhile, see single_flight; if 
+  one stays busy the answer is a 409.
+  """
+  instance_ids = [i.encode('ascii', 'ignore') 
+                  for i in request.POST.getlist('instance_id')]
+  instance_ids = sorted(set(instance_ids))
+  max_instances = getattr(settings, 'WORKSTATION_BULK_MAX_INSTANCES', 100)
+  if not instance_ids or len(instance_ids) > max_instances:
+    return JsonResponse({'error': 'Expected 1 to %d instance_id parameters.' % 
+                         (max_instances)}, status=400)
+  if not all(valid_instance_id.match(i) for i in instance_ids):
+    return JsonResponse({'error': 'Invalid instance id.'}, status=400)
+  if action == 'destroy' and request.POST.get('confirm') != 'destroy':
+    return JsonResponse({'error': "You must send confirm=destroy."}, 
+                        status=400)
+  try:
+    iam_key_id = GetIamCredentials(request).iam_key_id
+  except models.IamCredentials.DoesNotExist:
+    return JsonResponse({'error': 'No AWS credentials configured.'}, status=403)
+  region = GetRegion(request)
+  try:
+    with single_flight.InstanceLocks(region, instance_ids, action):
+      with CheckoutManager(request, region) as manager:
+        results = bulk_power.Run(manager, action, instance_ids)
+  except single_flight.InstanceBusy as e:
+    return JsonResponse({'error': str(e)}, status=409)
+  except exception.BotoServerError as e:
+    if e.error_code in rate_limit.THROTTLING_CODES:
+      raise  # ThrottledMiddleware answers with a 503
+    return JsonResponse({'error': bulk_power.ErrorMessage(e)}, status=502)
+  for instance_id, result in results.items():
+    if not result['ok']:
+      continue
+    if action != 'start':
+      session_configs.Evict(instance_id)
+    inventory.SetInstanceState(iam_key_id, region, instance_id, 
+                               result['state'])
+  instance_events.Poke(region, iam_key_id)
+  return JsonResponse({'results': results})
+
+
 @login_required(login_url='/accounts/login/')
 def Connect(request, instance_id):
   instance_id = instance_id.encode('ascii', 'ignore')
-  manager = GetManager(request)
-  conn_config_data = manager.CreateRemoteSessionConfig(instance_id)
-  response = HttpResponse(conn_config_data, content_type='application/nx-session')
-  info = manager.GetInstanceInfo(instance_id)
-  safe_name = info.name
+  iam_key_id = GetIamCredentials(request).iam_key_id
+  region = GetRegion(request)
+  instance = inventory.FindInstance(iam_key_id, region, instance_id)
+  session = None
+  if instance:
+    session = session_configs.Get(instance_id, instance['hostname'])
+  if not session:
+    with CheckoutManager(request, region) as manager:
+      if not instance:
+        info = manager.GetInstanceInfo(instance_id)
+        instance = {'name': info.name, 'hostname': info.hostname}
+      conn_config_data = manager.CreateRemoteSessionConfig(instance_id)
+    session = session_configs.Put(instance_id, instance['hostname'], 
+                                  instance['name'], conn_config_data)
+  response = HttpResponse(session['config'], content_type='application/nx-session')
+  safe_name = session['name']
   safe_name = safe_name.replace('_', '-')
   safe_name = safe_name.replace('=', '-')
   safe_name = safe_name.replace(',', '-')
   response['Content-Disposition'] = 'attachment; filename="%s.nxs"' % (safe_name)
+  response['ETag'] = quote_etag(session['md5'])
   response.set_cookie('fileDownload', 'true')  
   return response
 
@@ -96,14 +358,20 @@ class DestroyConfirmForm(forms.Form):
 def Destroy(request, instance_id):
   form = DestroyConfirmForm() # An unbound form
   instance_id = instance_id.encode('ascii', 'ignore')
+  region = GetRegion(request)
   if request.method == 'POST': # If the form has been submitted...
     form = DestroyConfirmForm(request.POST) # A form bound to the POST data
     if form.is_valid(): # All validation rules pass
-      manager = GetManager(request)
-      manager.TerminateInstance(instance_id)
+      job = jobs.Submit(request.user, 'terminate_instance', region,
+                        instance_id=instance_id)
+      session_configs.Evict(instance_id)
+      messages.info(request, 'Destroying workstation %s (job %d)...' % 
+                    (instance_id, job.id))
+      inventory.SetInstanceState(GetIamCredentials(request).iam_key_id,
+                                 region, instance_id, 'shutting-down')
       return HttpResponseRedirect('/workstations/') # Redirect after POST
   
-  return render(request, 'destroy_workstation.html', {'instance_id': instance_id, 'form': form,})          
+  return render(request, 'destroy_workstation.html', {'instance_id': instance_id, 'region': region, 'form': form,})          
 
 
 
@@ -120,15 +388,20 @@ class AddStorageForm(forms.Form):
 def AddStorage(request, instance_id):
   form = AddStorageForm() # An unbound form
   instance_id = instance_id.encode('ascii', 'ignore')
+  region = GetRegion(request)
   if request.method == 'POST': # If the form has been submitted...
     form = AddStorageForm(request.POST) # A form bound to the POST data
     if form.is_valid(): # All validation rules pass
-      manager = GetManager(request)
       new_size_gb = int(form.cleaned_data['new_size_gb'])
-      manager.ResizeRootVolumeOfInstance(instance_id, new_size_gb)
+      job = jobs.Submit(request.user, 'resize_root_volume', region,
+                        instance_id=instance_id, new_size_gb=new_size_gb)
+      messages.info(request, 'Resizing storage of workstation %s (job %d)...' % 
+                    (instance_id, job.id))
+      inventory.SetInstanceState(GetIamCredentials(request).iam_key_id,
+                                 region, instance_id, 'stopping')
       return HttpResponseRedirect('/workstations/') # Redirect after POST
   
-  return render(request, 'add_storage.html', {'instance_id': instance_id, 'form': form,})          
+  return render(request, 'add_storage.html', {'instance_id': instance_id, 'region': region, 'form': form,})          
 
 
 
@@ -142,7 +415,9 @@ class SetupAwsCredentialsForm(forms.Form):
     aws_key_secret = cleaned_data.get("aws_key_secret")
     
     if aws_key_id and aws_key_secret:
-      if not core.CredentialsValid(aws_key_id, aws_key_secret):
+      if credential_checks.KnownInvalid(aws_key_id, aws_key_secret):
+        raise forms.ValidationError("Invalid AWS Access Key")
+      if not credential_checks.CredentialsValid(aws_key_id, aws_key_secret):
         raise forms.ValidationError("Invalid AWS Access Key")
     # Always return the full collection of cleaned data.
     return cleaned_data
@@ -155,10 +430,20 @@ def SetupAwsCredentials(request):
     form = SetupAwsCredentialsForm(request.POST) # A form bound to the POST data
     if form.is_valid(): # All validation rules pass
       # Process the data in form.cleaned_data
-      root_aws_id = form.cleaned_data['aws_key_id']
-      root_aws_secret = form.cleaned_data['aws_key_secret']
-      key_id, key_secret = workstation.GetCirrusIamUserCredentials(root_aws_id, 
-                                                         root_aws_secret)
+      # Provisioning may delete and recreate the IAM user, so it only starts
+      # once the root credentials passed validation.
+      provisioning = credential_checks.StartProvisioning(
+          form.cleaned_data['aws_key_id'], form.cleaned_data['aws_key_secret'])
+      timeout = getattr(settings, 'WORKSTATION_PROVISIONING_TIMEOUT_SECS', 300)
+      try:
+        key_id, key_secret = provisioning.get(timeout)
+      except workstation.InvalidAwsCredentials:
+        form.add_error(None, 'Invalid AWS Access Key')
+        return render(request, 'setup_credentials.html', {'form': form,})
+      except multiprocessing.TimeoutError:
+        form.add_error(None, 'Setting up your AWS account is taking longer '
+                       'than expected, please try again in a few minutes.')
+        return render(request, 'setup_credentials.html', {'form': form,})
       
       #iam_credentials = models.IamCredentials.objects.get(user=request.user)
       iam_credentials, created = models.IamCredentials.objects.get_or_create(user=request.user)
@@ -180,28 +465,13 @@ class CreateWorkstationForm(forms.Form):
     ('c1.xlarge', 'c1.xlarge'),  
   )
   instance_type = forms.ChoiceField(choices=INSTANCE_TYPE_CHOICES)
+  region = forms.ChoiceField(choices=())
+
+  def __init__(self, *args, **kwargs):
+    super(CreateWorkstationForm, self).__init__(*args, **kwargs)
+    self.fields['region'].choices = [(r, r) for r in GetRegions()]
+    self.fields['region'].initial = default_region
 
-class CreateWorkstationRunner():
-  def __init__(self, manager, name, instance_type, ubuntu_release_name, 
-               mapr_version, ami_release_name, ami_owner_id):
-    self.manager = manager
-    self.name = name
-    self.instance_type = instance_type
-    self.ubuntu_release_name = ubuntu_release_name
-    self.mapr_version = mapr_version
-    self.ami_release_name = ami_release_name
-    self.ami_owner_id = ami_owner_id
-    return
-  
-  def __call__(self):
-    self.manager.CreateInstance(self.name, self.instance_type, 
-                                self.ubuntu_release_name, 
-                                self.mapr_version, self.ami_release_name, 
-                                self.ami_owner_id)
-    return
-    
- 
-  
 def CreateWorkstation(request):
   #form = CreateWorkstationForm(initial={'name': 'my_workstation', 'instance_type': 'c1.xlarge'}) # An unbound form
   form = CreateWorkstationForm() # An unbound form
@@ -212,21 +482,54 @@ def CreateWorkstation(request):
       # Process the data in form.cleaned_data
       name = form.cleaned_data['name']
       instance_type = form.cleaned_data['instance_type']
-      manager = GetManager(request)
+      region = form.cleaned_data['region']
       ubuntu_release_name = 'precise'
       mapr_version = 'v2.1.3'
       
-      messages.success(request, 'Your new workstation "%s" is starting up...' % (name))
-      manager.CreateInstance(name, 
-                             instance_type,
-                             ubuntu_release_name, 
-                             mapr_version,
-                             core.default_ami_release_name, 
-                             core.default_ami_owner_id)
+      job = jobs.Submit(request.user, 'create_workstation', region,
+                        name=name,
+                        instance_type=instance_type,
+                        ubuntu_release_name=ubuntu_release_name,
+                        mapr_version=mapr_version,
+                        ami_release_name=core.default_ami_release_name,
+                        ami_owner_id=core.default_ami_owner_id)
+      messages.success(request, 'Your new workstation "%s" is starting up... (job %d)' % (name, job.id))
       return HttpResponseRedirect('/workstations/') # Redirect after POST
   
   return render(request, 'create_workstation.html', {'form': form,})      
 
+
+def GetJobOr404(request, job_id):
+  try:
+    return models.Job.objects.get(pk=job_id, user=request.user)
+  except models.Job.DoesNotExist:
+    raise Http404
+
+
+@login_required(login_url='/accounts/login/')
+def JobStatus(request, job_id):
+  return JsonResponse(GetJobOr404(request, job_id).AsDict())
+
+
+@require_POST
+@login_required(login_url='/accounts/login/')
+def CancelJob(request, job_id):
+  job = GetJobOr404(request, job_id)
+  if not jobs.Cancel(job):
+    return JsonResponse({'error': 'Only queued jobs can be cancelled.'}, 
+                        status=409)
+  return JsonResponse(GetJobOr404(request, job_id).AsDict())
+
+
+@require_POST
+@login_required(login_url='/accounts/login/')
+def RetryJob(request, job_id):
+  job = GetJobOr404(request, job_id)
+  if not jobs.Retry(job):
+    return JsonResponse({'error': 'Only failed or cancelled jobs can be retried.'}, 
+                        status=409)
+  return JsonResponse(GetJobOr404(request, job_id).AsDict())
+
 #def CreateWorkstation(request):
 #  form = CreateWorkstationForm(initial={'name': 'my_workstation', 'instance_type': 'c1.xlarge'}) # An unbound form
 #  
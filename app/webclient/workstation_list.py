@@ -0,0 +1,94 @@
+""" Filtering, sorting and paging of the workstations table.
+
+Large team accounts have hundreds of workstations and rendering all of them,
+each row with its buttons and menus, made the workstations page slow to
+render and to load.  The page now renders one page of the cached inventory
+at a time, filtered by state and name and sorted server side:
+
+  /workstations/?state=running&q=build&sort=-name&page=2
+
+so its render time depends on the page size, not on the number of
+workstations.  Further pages can be appended without a reload by fetching
+just their rows with partial=rows.
+"""
+
+from django.conf import settings
+from django.core.paginator import EmptyPage
+from django.core.paginator import PageNotAnInteger
+from django.core.paginator import Paginator
+from django.utils.http import urlencode
+
+sort_keys = {
+  'name': lambda i: (i['name'].lower(), i['id']),
+  'state': lambda i: (i['state'], i['name'].lower(), i['id']),
+  'region': lambda i: (i.get('region', ''), i['name'].lower(), i['id']),
+}
+default_sort = 'name'
+
+
+class ListParams(object):
+  """ The table parameters of a request, validated. """
+
+  def __init__(self, query):
+    self.state = query.get('state', '')
+    self.q = query.get('q', '').strip()
+    self.sort = query.get('sort', default_sort)
+    if self.sort.lstrip('-') not in sort_keys:
+      self.sort = default_sort
+    self.page = query.get('page', 1)
+    page_size = getattr(settings, 'WORKSTATION_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'WORKSTATION_MAX_PAGE_SIZE', 200)
+    try:
+      self.per_page = min(max(int(query.get('per_page', page_size)), 1),
+                          max_page_size)
+    except ValueError:
+      self.per_page = page_size
+    self.default_per_page = page_size
+    return
+
+  def Query(self, **overrides):
+    """ Query string of these parameters but the page, with overrides. """
+    params = {'state': self.state, 'q': self.q, 'sort': self.sort}
+    if self.per_page != self.default_per_page:
+      params['per_page'] = self.per_page
+    params.update(overrides)
+    return urlencode(sorted((k, v) for k, v in params.items() if v))
+
+  def SortLinks(self):
+    """ {sort key: query string sorting by it}, reversing the current one. """
+    links = {}
+    for key in sort_keys:
+      links[key] = self.Query(sort='-' + key if self.sort == key else key)
+    return links
+
+
+def Filter(instances, state='', q=''):
+  q = q.lower()
+  return [i for i in instances
+          if (not state or i['state'] == state) and
+             (not q or q in i['name'].lower() or q in i['id'])]
+
+
+def Sort(instances, sort):
+  return sorted(instances, key=sort_keys[sort.lstrip('-')],
+                reverse=sort.startswith('-'))
+
+
+def StateCounts(instances):
+  """ Returns [(state, number of instances)], for the state filter. """
+  counts = {}
+  for instance in instances:
+    counts[instance['state']] = counts.get(instance['state'], 0) + 1
+  return sorted(counts.items())
+
+
+def GetPage(instances, params):
+  """ Returns the requested page of the filtered and sorted instances. """
+  instances = Sort(Filter(instances, params.state, params.q), params.sort)
+  paginator = Paginator(instances, params.per_page)
+  try:
+    return paginator.page(params.page)
+  except PageNotAnInteger:
+    return paginator.page(1)
+  except EmptyPage:
+    return paginator.page(paginator.num_pages)
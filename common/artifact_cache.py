@@ -0,0 +1,169 @@
+""" Content-addressed on-disk cache for downloaded artifacts.
+
+Artifacts are stored under root/<algorithm>/<digest[:2]>/<digest>, keyed by
+the strongest digest the caller expects, so a repeat fetch of the same
+artifact is a stat() rather than a download:
+
+   from common import artifact_cache
+   path = artifact_cache.get_cache().fetch(url, md5='9e107d9d372bb6826bd8...')
+
+Downloads are verified before they are renamed into place, so the cache only
+ever holds complete, matching files.  Processes sharing a cache dir coordinate
+with flock(): one lock per digest while downloading, so concurrent fetches of
+the same artifact download it once, and one cache-wide lock while inserting
+and evicting.  The least recently used artifacts are evicted once the cache
+exceeds max_bytes.
+"""
+
+import fcntl
+import os
+import threading
+
+from common import hash
+from common import net
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+
+class _FileLock(object):
+
+    """ Exclusive flock() on path, held for the duration of a with block. """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+class ArtifactCache(object):
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.num_hits = 0
+        self.num_misses = 0
+        self._counter_lock = threading.Lock()
+        for subdir in ('tmp', 'locks'):
+            path = os.path.join(self.root, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def path(self, algorithm, digest):
+        digest = digest.lower()
+        return os.path.join(self.root, algorithm, digest[:2], digest)
+
+    def get(self, algorithm, digest):
+        """ Returns the cached path of the artifact or None, counting the
+        lookup as a hit or miss. """
+        path = self.path(algorithm, digest)
+        try:
+            os.utime(path, None)  # mtime is the LRU clock
+        except OSError:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return path
+
+    def fetch(self, url, md5=None, sha256=None, blake2b=None):
+        """ Returns the path of the cached artifact, downloading and verifying
+        it first on a miss.  The returned file must not be modified. """
+        algorithm, digest = _cache_key(md5, sha256, blake2b)
+        path = self.get(algorithm, digest)
+        if path:
+            return path
+        lock_path = os.path.join(self.root, 'locks', '%s-%s' % (algorithm,
+                                                                 digest))
+        with _FileLock(lock_path):
+            # Another process may have fetched it while we waited.
+            path = self.path(algorithm, digest)
+            if os.path.exists(path):
+                return path
+            tmp_filename = net.fetch_tarball(
+                url, md5=md5, sha256=sha256, blake2b=blake2b,
+                dir=os.path.join(self.root, 'tmp'))
+            self._insert(tmp_filename, path)
+        return path
+
+    def stats(self):
+        return {'hits': self.num_hits, 'misses': self.num_misses,
+                'bytes': sum(size for _, size, _ in self._entries())}
+
+    def _count(self, hit):
+        with self._counter_lock:
+            if hit:
+                self.num_hits += 1
+            else:
+                self.num_misses += 1
+
+    def _insert(self, tmp_filename, path):
+        with _FileLock(os.path.join(self.root, 'locks', 'cache')):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.chmod(tmp_filename, 0o444)
+            os.rename(tmp_filename, path)
+            self._evict(keep=path)
+
+    def _evict(self, keep):
+        """ Removes least recently used artifacts, other than keep, until the
+        cache fits in max_bytes.  Called with the cache lock held. """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def _entries(self):
+        """ Yields (mtime, size, path) for each cached artifact. """
+        for algorithm in hash.ALGORITHMS:
+            top = os.path.join(self.root, algorithm)
+            for dirpath, _, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield st.st_mtime, st.st_size, path
+
+
+def _cache_key(md5, sha256, blake2b):
+    """ Returns (algorithm, digest) for the strongest digest given. """
+    for algorithm, digest in (('blake2b', blake2b), ('sha256', sha256),
+                              ('md5', md5)):
+        if digest:
+            return algorithm, digest.lower()
+    raise ValueError('An artifact needs an expected digest to be cached')
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """ Returns the process wide cache, rooted at $ARTIFACT_CACHE_DIR or
+    ~/.cache/cirrus/artifacts with a budget of $ARTIFACT_CACHE_MAX_BYTES. """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            root = os.environ.get('ARTIFACT_CACHE_DIR') or os.path.join(
+                os.path.expanduser('~'), '.cache', 'cirrus', 'artifacts')
+            max_bytes = int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES',
+                                           DEFAULT_MAX_BYTES))
+            _cache = ArtifactCache(root, max_bytes)
+    return _cache
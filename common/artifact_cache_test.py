@@ -0,0 +1,64 @@
+""" Tests for common.artifact_cache.
+
+   python -m unittest common.artifact_cache_test
+"""
+
+import hashlib
+import os
+import unittest
+
+from common import artifact_cache
+from common import net
+from common.net_test import NetTestBase
+
+
+class ArtifactCacheTest(NetTestBase):
+
+    def setUp(self):
+        NetTestBase.setUp(self)
+        self.cache = artifact_cache.ArtifactCache(os.path.join(self.dir, 'c'),
+                                                  max_bytes=10000)
+
+    def add_file(self, path, size):
+        data = os.urandom(size)
+        self.server.files[path] = data
+        return hashlib.md5(data).hexdigest(), data
+
+    def test_repeat_fetch_is_a_hit(self):
+        md5, data = self.add_file('/a', 3000)
+        path = self.cache.fetch(self.url('/a'), md5=md5)
+        self.assertEqual(open(path, 'rb').read(), data)
+        self.assertEqual(self.cache.fetch(self.url('/a'), md5=md5), path)
+        self.assertEqual(len([r for r in self.server.requests
+                              if r[0] == 'GET']), 1)
+        self.assertEqual((self.cache.num_hits, self.cache.num_misses), (1, 1))
+
+    def test_keyed_by_strongest_digest(self):
+        _, data = self.add_file('/a', 100)
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.cache.fetch(self.url('/a'),
+                                md5=hashlib.md5(data).hexdigest(),
+                                sha256=sha256)
+        self.assertEqual(path, self.cache.path('sha256', sha256))
+
+    def test_mismatch_is_not_cached(self):
+        self.add_file('/a', 100)
+        self.assertRaises(net.DigestMismatchError, self.cache.fetch,
+                          self.url('/a'), md5='0' * 32)
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+        self.assertEqual(os.listdir(os.path.join(self.cache.root, 'tmp')), [])
+
+    def test_evicts_least_recently_used(self):
+        paths = {}
+        for name in ('a', 'b', 'c'):
+            md5, _ = self.add_file('/' + name, 4000)
+            paths[name] = self.cache.fetch(self.url('/' + name), md5=md5)
+            os.utime(paths[name], (len(paths), len(paths)))
+        self.assertFalse(os.path.exists(paths['a']))
+        self.assertTrue(os.path.exists(paths['b']))
+        self.assertTrue(os.path.exists(paths['c']))
+        self.assertEqual(self.cache.stats()['bytes'], 8000)
+
+
+if __name__ == '__main__':
+    unittest.main()
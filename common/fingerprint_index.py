@@ -0,0 +1,201 @@
+""" Persistent index of file digests, so unchanged files aren't re-hashed.
+
+Digests are stored in a small SQLite database keyed by path and algorithm,
+together with the size, mtime (ns) and inode the file had when it was hashed.
+A lookup stats the file and returns the stored digest if all three still
+match, otherwise it re-hashes the file and updates the entry:
+
+   from common import fingerprint_index
+   index = fingerprint_index.get_index()
+   index.digest('/data/image.tar', 'sha256')
+   index.digest_tree('/data/images')  # {path: md5} for a whole tree
+
+Like git's index, a file modified within the same mtime tick it was hashed
+in would look unchanged, so files modified less than RACY_SECS before they
+were hashed are not stored.  The database holds at most max_entries entries;
+the least recently used are evicted beyond that.  Several processes may share
+one database.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from common import hash
+
+DEFAULT_MAX_ENTRIES = 100000
+RACY_SECS = 2.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+  path TEXT NOT NULL,
+  algorithm TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  inode INTEGER NOT NULL,
+  digest TEXT NOT NULL,
+  last_used REAL NOT NULL,
+  PRIMARY KEY (path, algorithm));
+CREATE INDEX IF NOT EXISTS fingerprints_last_used
+  ON fingerprints (last_used);
+"""
+
+
+def _mtime_ns(st):
+    try:
+        return st.st_mtime_ns
+    except AttributeError:  # python 2
+        return int(st.st_mtime * 1e9)
+
+
+def _signature(st):
+    return st.st_size, _mtime_ns(st), st.st_ino
+
+
+class FingerprintIndex(object):
+
+    def __init__(self, db_path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.num_hits = 0
+        self.num_misses = 0
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self._db = sqlite3.connect(db_path, timeout=30.0,
+                                   check_same_thread=False)
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+
+    def digest(self, filename, algorithm='md5'):
+        """ Returns the hex digest of the file, hashing it only if it changed
+        since it was last hashed. """
+        return self.digests([filename], algorithm)[filename]
+
+    def digests(self, filenames, algorithm='md5',
+                num_threads=hash.NUM_HASH_THREADS):
+        """ Returns {filename: hex digest}, hashing changed or unknown files
+        num_threads at a time. """
+        paths = dict((f, os.path.abspath(f)) for f in filenames)
+        stats = dict((f, os.stat(f)) for f in filenames)
+        stored = self._load(set(paths.values()), algorithm)
+        result = {}
+        for filename, path in paths.items():
+            entry = stored.get(path)
+            if entry and entry[0] == _signature(stats[filename]):
+                result[filename] = entry[1]
+        todo = [f for f in filenames if f not in result]
+        self._count(len(result), len(todo))
+        if todo:
+            hash_start = time.time()
+            computed = hash.hash_files(todo, (algorithm,), num_threads)
+            updates = []
+            for filename in todo:
+                result[filename] = computed[filename][algorithm]
+                st = os.stat(filename)
+                if _signature(st) != _signature(stats[filename]):
+                    continue  # changed while we hashed it
+                if _mtime_ns(st) >= (hash_start - RACY_SECS) * 1e9:
+                    continue
+                updates.append((paths[filename], algorithm) + _signature(st) +
+                               (result[filename],))
+            self._store(updates)
+        self._touch([paths[f] for f in filenames if f not in todo], algorithm)
+        return result
+
+    def digest_tree(self, root, algorithm='md5',
+                    num_threads=hash.NUM_HASH_THREADS):
+        """ Returns {path: hex digest} for every regular file under root. """
+        filenames = []
+        for dirpath, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    filenames.append(path)
+        return self.digests(filenames, algorithm, num_threads)
+
+    def forget(self, filename):
+        with self._lock:
+            self._db.execute('DELETE FROM fingerprints WHERE path = ?',
+                             (os.path.abspath(filename),))
+            self._db.commit()
+
+    def num_entries(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _count(self, num_hits, num_misses):
+        with self._lock:
+            self.num_hits += num_hits
+            self.num_misses += num_misses
+
+    def _load(self, paths, algorithm):
+        """ Returns {path: ((size, mtime_ns, inode), digest)}. """
+        stored = {}
+        paths = list(paths)
+        with self._lock:
+            for i in range(0, len(paths), 500):  # sqlite parameter limit
+                batch = paths[i:i + 500]
+                rows = self._db.execute(
+                    'SELECT path, size, mtime_ns, inode, digest '
+                    'FROM fingerprints WHERE algorithm = ? AND path IN (%s)' %
+                    ','.join('?' * len(batch)), [algorithm] + batch)
+                for path, size, mtime_ns, inode, digest in rows:
+                    stored[path] = ((size, mtime_ns, inode), digest)
+        return stored
+
+    def _touch(self, paths, algorithm):
+        if not paths:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'UPDATE fingerprints SET last_used = ? '
+                'WHERE path = ? AND algorithm = ?',
+                [(now, p, algorithm) for p in paths])
+            self._db.commit()
+
+    def _store(self, updates):
+        if not updates:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO fingerprints '
+                '(path, algorithm, size, mtime_ns, inode, digest, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [u + (now,) for u in updates])
+            count = self._db.execute(
+                'SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+            if count > self.max_entries:
+                # Evict down to 90% so we don't evict on every insert.
+                self._db.execute(
+                    'DELETE FROM fingerprints WHERE rowid IN ('
+                    'SELECT rowid FROM fingerprints ORDER BY last_used '
+                    'LIMIT ?)', (count - int(self.max_entries * 0.9),))
+            self._db.commit()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """ Returns the process wide index, stored at $FINGERPRINT_INDEX_PATH or
+    ~/.cache/cirrus/fingerprints.db. """
+    global _index
+    with _index_lock:
+        if _index is None:
+            db_path = os.environ.get('FINGERPRINT_INDEX_PATH') or \
+                os.path.join(os.path.expanduser('~'), '.cache', 'cirrus',
+                             'fingerprints.db')
+            _index = FingerprintIndex(db_path)
+    return _index
@@ -0,0 +1,81 @@
+""" Tests for common.fingerprint_index.
+
+   python -m unittest common.fingerprint_index_test
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from common import fingerprint_index
+from common import hash
+
+
+class FingerprintIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = fingerprint_index.FingerprintIndex(
+            os.path.join(self.dir, 'index.db'), max_entries=10)
+        self.data_dir = os.path.join(self.dir, 'data')
+        os.mkdir(self.data_dir)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data, age_secs=60):
+        filename = os.path.join(self.data_dir, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        mtime = time.time() - age_secs
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_reuses_digest_of_unchanged_file(self):
+        filename = self.write('a', b'hello')
+        expected = hashlib.md5(b'hello').hexdigest()
+        self.assertEqual(self.index.digest(filename), expected)
+        self.assertEqual(self.index.digest(filename), expected)
+        self.assertEqual((self.index.num_hits, self.index.num_misses), (1, 1))
+
+    def test_rehashes_changed_file(self):
+        filename = self.write('a', b'hello')
+        self.index.digest(filename)
+        self.write('a', b'world', age_secs=30)
+        self.assertEqual(self.index.digest(filename),
+                         hashlib.md5(b'world').hexdigest())
+        self.assertEqual(self.index.num_misses, 2)
+
+    def test_does_not_store_racy_files(self):
+        filename = self.write('a', b'hello', age_secs=0)
+        self.index.digest(filename)
+        self.assertEqual(self.index.num_entries(), 0)
+
+    def test_digest_tree_and_eviction(self):
+        for i in range(15):
+            self.write('f%d' % i, str(i).encode())
+        digests = self.index.digest_tree(self.data_dir, 'sha256')
+        self.assertEqual(len(digests), 15)
+        self.assertEqual(digests[os.path.join(self.data_dir, 'f3')],
+                         hashlib.sha256(b'3').hexdigest())
+        self.assertTrue(self.index.num_entries() <= 10)
+
+    def test_md5sum_uses_index(self):
+        filename = self.write('a', b'hello')
+        old_index = fingerprint_index._index
+        fingerprint_index._index = self.index
+        try:
+            for _ in range(2):
+                self.assertEqual(hash.md5sum(filename),
+                                 hashlib.md5(b'hello').digest())
+        finally:
+            fingerprint_index._index = old_index
+        self.assertEqual(self.index.num_hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
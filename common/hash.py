@@ -1,6 +1,42 @@
-""" Utilities for computing unique fingerprints for data. """
+""" Utilities for computing unique fingerprints for data.
 
+hash_file() computes several digests of a file in a single pass, memory
+mapping large files so the data is fed to hashlib without copies through
+python file objects.  hashlib releases the GIL while it hashes, so
+hash_files() fingerprints many files concurrently on a thread pool and
+tree_hash() splits a single huge file into chunks hashed in parallel.
+
+   from common import hash
+   hash.hash_file('/data/image.tar', ('md5', 'sha256'))
+   hash.hash_files(filenames, ('sha256',), num_threads=8)
+"""
+
+import binascii
 import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+from multiprocessing import pool as mp_pool
+
+# Digest algorithms accepted where a caller names one, strongest last.
+ALGORITHMS = ('md5', 'sha256', 'blake2b')
+
+BLOCK_SIZE = 1024 * 1024  # bytes per hashlib update; hashlib drops the GIL
+MMAP_THRESHOLD = 4 * 1024 * 1024  # smaller files are read() instead
+TREE_CHUNK_SIZE = 64 * 1024 * 1024
+NUM_HASH_THREADS = 4
+
+
+def new_hasher(algorithm):
+    """ Returns a fresh hashlib object for one of ALGORITHMS. """
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unsupported digest algorithm: %s' % (algorithm))
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise ValueError('%s needs a newer python/hashlib' % (algorithm))
+
 
 def _hashfile(afile, hasher, blocksize=65536):
     buf = afile.read(blocksize)
@@ -9,9 +45,117 @@ def _hashfile(afile, hasher, blocksize=65536):
         buf = afile.read(blocksize)
     return hasher.digest()
 
-def md5sum(filename):
-    result = _hashfile(open(filename, 'rb'), hashlib.md5())
-    return result
+
+def _view(mm, offset, length):
+    """ A zero-copy slice of an mmap that hashlib accepts. """
+    try:
+        return buffer(mm, offset, length)
+    except NameError:  # python 3
+        return memoryview(mm)[offset:offset + length]
+
+
+def _update_range(hashers, f, offset, length):
+    """ Feeds length bytes of open file f starting at offset to hashers. """
+    if length >= MMAP_THRESHOLD:
+        page_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        mm = mmap.mmap(f.fileno(), length + offset - page_offset,
+                       access=mmap.ACCESS_READ, offset=page_offset)
+        try:
+            end = length + offset - page_offset
+            pos = offset - page_offset
+            while pos < end:
+                block = _view(mm, pos, min(BLOCK_SIZE, end - pos))
+                for hasher in hashers:
+                    hasher.update(block)
+                pos += BLOCK_SIZE
+                del block  # python 3 can't close an mmap with live views
+        finally:
+            mm.close()
+        return
+    f.seek(offset)
+    while length > 0:
+        buf = f.read(min(BLOCK_SIZE, length))
+        if not buf:
+            break
+        for hasher in hashers:
+            hasher.update(buf)
+        length -= len(buf)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(num_threads):
+    """ Returns a shared thread pool of num_threads, so small batches don't
+    pay for starting threads. """
+    with _pools_lock:
+        if num_threads not in _pools:
+            _pools[num_threads] = mp_pool.ThreadPool(processes=num_threads)
+        return _pools[num_threads]
+
+
+def hash_file(filename, algorithms=('md5',)):
+    """ Returns {algorithm: hex digest} for the file, reading it once. """
+    hashers = [new_hasher(a) for a in algorithms]
+    with open(filename, 'rb') as f:
+        _update_range(hashers, f, 0, os.fstat(f.fileno()).st_size)
+    return dict((a, h.hexdigest()) for a, h in zip(algorithms, hashers))
+
+
+def hash_files(filenames, algorithms=('md5',), num_threads=NUM_HASH_THREADS):
+    """ Returns {filename: {algorithm: hex digest}}, hashing num_threads files
+    at a time. """
+    filenames = list(filenames)
+    if len(filenames) <= 1 or num_threads <= 1:
+        return dict((f, hash_file(f, algorithms)) for f in filenames)
+    digests = _get_pool(num_threads).map(lambda f: hash_file(f, algorithms),
+                                         filenames)
+    return dict(zip(filenames, digests))
+
+
+def tree_hash(filename, algorithm='sha256', chunk_size=TREE_CHUNK_SIZE,
+              num_threads=NUM_HASH_THREADS):
+    """ Returns a hex fingerprint of the file hashed as independent chunks.
+
+    Each chunk_size chunk is hashed in parallel and the result is the digest
+    of the concatenated chunk digests.  It identifies the content as well as
+    a plain digest but is NOT equal to one, and depends on chunk_size, so
+    only compare it with tree hashes computed with the same parameters.
+    """
+    size = os.path.getsize(filename)
+    offsets = list(range(0, size, chunk_size)) or [0]
+
+    def hash_chunk(offset):
+        hasher = new_hasher(algorithm)
+        with open(filename, 'rb') as f:
+            _update_range([hasher], f, offset, min(chunk_size, size - offset))
+        return hasher.digest()
+
+    if len(offsets) == 1 or num_threads <= 1:
+        chunk_digests = [hash_chunk(o) for o in offsets]
+    else:
+        chunk_digests = _get_pool(num_threads).map(hash_chunk, offsets)
+    root = new_hasher(algorithm)
+    for digest in chunk_digests:
+        root.update(digest)
+    return root.hexdigest()
+
+
+def md5sum(filename, use_index=True):
+    """ Returns the binary md5 digest of the file.  With use_index, a digest
+    stored in common.fingerprint_index is reused if the file is unchanged. """
+    if use_index:
+        from common import fingerprint_index  # imports this module
+        try:
+            index = fingerprint_index.get_index()
+            return binascii.unhexlify(index.digest(filename, 'md5'))
+        except (sqlite3.Error, OSError):
+            pass  # no usable index, e.g. a read-only home dir
+    hasher = hashlib.md5()
+    with open(filename, 'rb') as f:
+        _update_range([hasher], f, 0, os.fstat(f.fileno()).st_size)
+    return hasher.digest()
 
 def md5sum_string(input_string):
     hash_object = hashlib.md5(input_string)
@@ -0,0 +1,92 @@
+""" Throughput benchmark for common.hash.
+
+Compares MB/s of the previous md5sum (64 KB reads through a python file
+object, reproduced below) with hash_file(), hash_files() over several copies
+and tree_hash(), for files from 1 KB up to --max_size.  Files are read once
+before timing so every variant hashes from the page cache.
+
+   python -m common.hash_benchmark --max_size 4G
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from common import hash
+
+_SIZES = [('1K', 1024), ('1M', 1024 ** 2), ('64M', 64 * 1024 ** 2),
+          ('512M', 512 * 1024 ** 2), ('4G', 4 * 1024 ** 3)]
+
+
+def legacy_md5sum(filename):
+    """ md5sum as it was before the mmap/threaded rework. """
+    return hash._hashfile(open(filename, 'rb'), hashlib.md5())
+
+
+def make_file(filename, size):
+    block = os.urandom(min(size, 1024 * 1024))
+    with open(filename, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def mb_per_sec(fn, num_bytes, min_secs=0.5):
+    """ Runs fn until min_secs elapsed and returns its throughput. """
+    num_runs = 0
+    start = time.time()
+    while True:
+        fn()
+        num_runs += 1
+        elapsed = time.time() - start
+        if elapsed >= min_secs:
+            return num_bytes * num_runs / elapsed / 1e6
+
+
+def parse_size(text):
+    for label, size in _SIZES:
+        if label == text.upper():
+            return size
+    return int(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max_size', default='512M')
+    parser.add_argument('--num_files', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=hash.NUM_HASH_THREADS)
+    args = parser.parse_args()
+    max_size = parse_size(args.max_size)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print('%6s %12s %12s %12s %12s' % ('size', 'md5sum', 'hash_file',
+                                           'hash_files', 'tree_hash'))
+        for label, size in _SIZES:
+            if size > max_size:
+                break
+            filenames = [os.path.join(tmp_dir, '%s.%d' % (label, i))
+                         for i in range(args.num_files)]
+            for filename in filenames:
+                make_file(filename, size)
+                legacy_md5sum(filename)  # warm the page cache
+            legacy = mb_per_sec(lambda: legacy_md5sum(filenames[0]), size)
+            single = mb_per_sec(lambda: hash.hash_file(filenames[0]), size)
+            multi = mb_per_sec(lambda: hash.hash_files(
+                filenames, num_threads=args.threads), size * len(filenames))
+            tree = mb_per_sec(lambda: hash.tree_hash(
+                filenames[0], 'md5', chunk_size=max(size // args.threads, 1),
+                num_threads=args.threads), size)
+            print('%6s %12.1f %12.1f %12.1f %12.1f' % (label, legacy, single,
+                                                       multi, tree))
+            for filename in filenames:
+                os.remove(filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+""" Tests for common.hash.
+
+   python -m unittest common.hash_test
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from common import hash
+
+
+class HashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = {}
+        for name, size in (('empty', 0), ('small', 1000),
+                           ('large', hash.MMAP_THRESHOLD * 2 + 12345)):
+            data = os.urandom(size)
+            filename = os.path.join(self.dir, name)
+            with open(filename, 'wb') as f:
+                f.write(data)
+            self.files[filename] = data
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hash_file_computes_all_digests(self):
+        for filename, data in self.files.items():
+            self.assertEqual(hash.hash_file(filename, ('md5', 'sha256')),
+                             {'md5': hashlib.md5(data).hexdigest(),
+                              'sha256': hashlib.sha256(data).hexdigest()})
+            self.assertEqual(hash.md5sum(filename, use_index=False),
+                             hashlib.md5(data).digest())
+
+    def test_hash_files(self):
+        digests = hash.hash_files(self.files, ('sha256',), num_threads=3)
+        for filename, data in self.files.items():
+            self.assertEqual(digests[filename]['sha256'],
+                             hashlib.sha256(data).hexdigest())
+
+    def test_tree_hash_is_independent_of_threads(self):
+        filename = os.path.join(self.dir, 'large')
+        data = self.files[filename]
+        chunk_size = hash.MMAP_THRESHOLD + 1000  # unaligned mmap offsets
+        expected = hashlib.sha256()
+        for offset in range(0, len(data), chunk_size):
+            expected.update(
+                hashlib.sha256(data[offset:offset + chunk_size]).digest())
+        for num_threads in (1, 4):
+            self.assertEqual(hash.tree_hash(filename, chunk_size=chunk_size,
+                                            num_threads=num_threads),
+                             expected.hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
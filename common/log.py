@@ -21,11 +21,22 @@ CHECK_GE(a, b)
 CHECK_LT(a, b)
 CHECK_GT(a, b)
 CHECK_NOTNONE(a)
+
+Logging is cheap: a disabled level returns after a single set lookup, the
+caller's file and line come from a frame lookup rather than a full stack
+extraction, and lines are batched into few writes to stderr.  Call flush() to
+force out buffered output; it is also flushed at exit and before FATAL exits.
+
+Output goes to a list of sinks, by default a single StreamSink on stderr.  Use
+set_sinks() / add_sink() with the sinks in common.log_sinks to log through a
+background thread, to rotating files or as JSON lines.
 """
 
+import atexit
 import datetime
 import os
 import sys
+import threading
 import time
 import traceback
 
@@ -35,40 +46,183 @@ DEBUG = 2  # INFO level -> print message to stderr and stack trace
 INFO = 1  # INFO level -> print message to stderr
 FATAL = -1  # FATAL level -> print message and stack trace to stderr and exit
 
+_START_TIME = time.time()
+
+
+def _elapsed():
+    """ Seconds since this module was loaded. """
+    return time.time() - _START_TIME
+
+
+def _enabled_codes(level):
+    """ Returns the set of codes LOG emits at the given global level. """
+    if level == 0:
+        return frozenset()
+    return frozenset([FATAL, level])
+
+_ENABLED_CODES = _enabled_codes(GLOBAL_LOG_LEVEL)
+
 
 def set_log_level(level):
-    global GLOBAL_LOG_LEVEL
+    global GLOBAL_LOG_LEVEL, _ENABLED_CODES
     GLOBAL_LOG_LEVEL = level
+    _ENABLED_CODES = _enabled_codes(level)
 
 
 def get_log_level():
     return GLOBAL_LOG_LEVEL
 
 
+class LogRecord(object):
+
+    """ A single log message, as handed to the sinks. """
+
+    __slots__ = ("code", "time", "module", "line_number", "message", "pid",
+                 "elapsed", "stack")
+
+    def __init__(self, code, time, module, line_number, message, stack=None):
+        self.code = code
+        self.time = time
+        self.module = module
+        self.line_number = line_number
+        self.message = message
+        self.pid = os.getpid()
+        self.elapsed = _elapsed()
+        self.stack = stack  # traceback.extract_stack() style list or None
+
+
+def format_glog(record):
+    """ Renders a record as glog text, including stack traces if any. """
+    if record.code == FATAL:
+        return "%s\nStack trace:\n%sExited\n" % (
+            format_msg("F", record.time, record.module, record.line_number,
+                       record.message),
+            format_stacktrace(record.stack or []))
+    line = "%s\n" % format_msg("I", record.time, record.module,
+                               record.line_number, record.message)
+    if record.stack:
+        return format_stacktrace(record.stack) + line
+    return line
+
+
+class StreamSink(object):
+
+    """ Writes formatted records to a stream, batching them into few writes.
+
+    The buffer is flushed when it exceeds max_bytes, flush_interval seconds
+    after the first record of a batch, before FATAL exits and at exit.  With
+    stream None, sys.stderr is looked up at flush time so redirection keeps
+    working.
+    """
+
+    def __init__(self, stream=None, formatter=format_glog, max_bytes=8192,
+                 flush_interval=0.2):
+        self.stream = stream
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._num_bytes = 0
+        self._timer = None
+
+    def emit(self, record):
+        text = self.formatter(record)
+        with self._lock:
+            self._chunks.append(text)
+            self._num_bytes += len(text)
+            if self._num_bytes < self.max_bytes:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval,
+                                                  self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        self.flush()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._chunks:
+            return
+        data = "".join(self._chunks)
+        self._chunks = []
+        self._num_bytes = 0
+        stream = self.stream or sys.stderr
+        stream.write(data)
+        stream.flush()
+
+
+_SINKS = (StreamSink(),)
+
+
+def set_sinks(sinks):
+    """ Replaces the sinks LOG writes to, flushing and closing the old ones.
+
+    A sink is any object with emit(record), flush() and close() methods; see
+    common.log_sinks for asynchronous, rotating file and JSON sinks.
+    """
+    global _SINKS
+    old_sinks = _SINKS
+    _SINKS = tuple(sinks)
+    for sink in old_sinks:
+        if sink not in _SINKS:
+            sink.close()
+
+
+def add_sink(sink):
+    set_sinks(_SINKS + (sink,))
+
+
+def get_sinks():
+    return list(_SINKS)
+
+
+def flush():
+    """ Writes out any buffered log output. """
+    for sink in _SINKS:
+        sink.flush()
+
+atexit.register(flush)
+
+
+def _caller(depth):
+    """ Returns (filename, line number) of the frame depth levels up. """
+    try:
+        frame = sys._getframe(depth + 1)
+        return frame.f_code.co_filename, frame.f_lineno
+    except AttributeError:  # no sys._getframe on this interpreter
+        f = traceback.extract_stack()[-(depth + 2)]
+        return f[0], f[1]
+
+
 def LOG(code, message, is_check=False):
-    """ Send message to stderr. Exit if using code FATAL. """
-    if GLOBAL_LOG_LEVEL == 0 or (GLOBAL_LOG_LEVEL > code and code != FATAL):
+    """ Send message to the log sinks (stderr by default). Exit if using code
+    FATAL. """
+    if code not in _ENABLED_CODES:
         return
+    if is_check:
+        module, line_number = _caller(2)
+    else:
+        module, line_number = _caller(1)
+    stack = None
+    if code == FATAL or code == DEBUG:
+        stack = traceback.extract_stack()[:-1]
+    record = LogRecord(code, datetime.datetime.now(), module, line_number,
+                       message, stack)
+    for sink in _SINKS:
+        sink.emit(record)
     if code == FATAL:
-        try:
-            raise LogFatalException(message, is_check)
-        except LogFatalException as e:
-            sys.stderr.write("%s\n" % (e))
-            sys.stderr.write("Stack trace:\n")
-            pretty_print_stacktrace(traceback.extract_stack()[:-1])
-            sys.stderr.write("Exited\n")
-            sys.exit(6)
-    elif GLOBAL_LOG_LEVEL >= code:
-        if code == INFO:
-            try:
-                raise LogInfoException(message)
-            except LogInfoException as e:
-                sys.stderr.write("%s\n" % (e))
-        elif code == DEBUG:
-            try:
-                raise LogDebugException(message)
-            except LogDebugException as e:
-                sys.stderr.write("%s\n" % (e))
+        flush()
+        sys.exit(6)
 
 
 def CHECK(condition, message=None):
@@ -150,12 +304,10 @@ class LogDebugException(Exception):
     """ Print a debug log message in glog format. """
 
     def __init__(self, message):
-        stack = traceback.extract_stack()
-        self.module = stack[-3][0]
-        self.line_number = stack[-3][1]
+        self.module, self.line_number = _caller(2)
         self.message = message
         self.time = datetime.datetime.now()
-        pretty_print_stacktrace(stack)
+        pretty_print_stacktrace(traceback.extract_stack()[:-1])
         return
 
     def __str__(self):
@@ -168,9 +320,7 @@ class LogInfoException(Exception):
     """ Print a info log message in glog format. """
 
     def __init__(self, message):
-        stack = traceback.extract_stack()
-        self.module = stack[-3][0]
-        self.line_number = stack[-3][1]
+        self.module, self.line_number = _caller(2)
         self.message = message
         self.time = datetime.datetime.now()
 
@@ -184,12 +334,10 @@ class LogFatalException(Exception):
     """ Print a fatal log message in glog format. """
 
     def __init__(self, message, isCheck):
-        stack = traceback.extract_stack()
-        stack_depth = -3
+        stack_depth = 2
         if isCheck:
-            stack_depth = -4
-        self.module = stack[stack_depth][0]
-        self.line_number = stack[stack_depth][1]
+            stack_depth = 3
+        self.module, self.line_number = _caller(stack_depth)
         self.message = message
         self.time = datetime.datetime.now()
 
@@ -198,9 +346,16 @@ class LogFatalException(Exception):
                           self.message)
 
 
-def pretty_print_stacktrace(stack):
-    """ Print a stack trace with nice formatting. """
+def format_stacktrace(stack):
+    """ Formats a stack trace with nice formatting. """
+    lines = []
     for i, f in enumerate(stack):
         name = os.path.basename(f[0])
-        line = "\t@\t%s:%d\t%s\n" % (name + "::" + f[2], f[1], f[3])
-        sys.stderr.write(line)
+        lines.append("\t@\t%s:%d\t%s\n" % (name + "::" + f[2], f[1], f[3]))
+    return "".join(lines)
+
+
+def pretty_print_stacktrace(stack):
+    """ Print a stack trace with nice formatting. """
+    flush()
+    sys.stderr.write(format_stacktrace(stack))
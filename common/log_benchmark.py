@@ -0,0 +1,83 @@
+""" Microbenchmark for common.log calls per second.
+
+Compares LOG(INFO, ...) against the previous exception based implementation,
+which is reproduced below, both with INFO enabled and disabled.  Output goes
+to a null stream so only the logging overhead is measured.
+
+   python -m common.log_benchmark
+"""
+
+import datetime
+import sys
+import time
+import traceback
+
+from common import log
+
+
+class _NullStream(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class _LegacyLogInfoException(Exception):
+    def __init__(self, message):
+        stack = traceback.extract_stack()
+        self.module = stack[-3][0]
+        self.line_number = stack[-3][1]
+        self.message = message
+        self.time = datetime.datetime.now()
+
+    def __str__(self):
+        return log.format_msg("I", self.time, self.module, self.line_number,
+                              self.message)
+
+
+def legacy_log(code, message):
+    """ LOG as it was before the frame lookup and buffering rework. """
+    level = log.get_log_level()
+    if level == 0 or (level > code and code != log.FATAL):
+        return
+    if level >= code:
+        try:
+            raise _LegacyLogInfoException(message)
+        except _LegacyLogInfoException as e:
+            sys.stderr.write("%s\n" % (e))
+
+
+def calls_per_second(log_fn, code, num_calls, depth):
+    """ Times num_calls log calls made depth frames deep in the stack. """
+    if depth > 0:
+        return calls_per_second(log_fn, code, num_calls, depth - 1)
+    start = time.time()
+    for i in range(num_calls):
+        log_fn(code, "benchmark message")
+    return num_calls / (time.time() - start)
+
+
+def main():
+    num_calls = 20000
+    depth = 30  # typical depth of a call from inside a django view
+    stderr = sys.stderr
+    sys.stderr = _NullStream()
+    try:
+        results = []
+        for label, level in [("enabled", log.INFO), ("disabled", log.FATAL)]:
+            log.set_log_level(level)
+            before = calls_per_second(legacy_log, log.INFO, num_calls, depth)
+            after = calls_per_second(log.LOG, log.INFO, num_calls, depth)
+            log.flush()
+            results.append((label, before, after))
+    finally:
+        log.set_log_level(log.INFO)
+        sys.stderr = stderr
+    for label, before, after in results:
+        print("INFO %-8s before: %10.0f calls/s  after: %10.0f calls/s  "
+              "(%.1fx)" % (label, before, after, after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+""" Additional sinks for common.log.
+
+By default common.log writes glog formatted text to stderr from the calling
+thread.  Under gunicorn/supervisor that serializes request threads on the
+stderr pipe, so a service can instead install, e.g.:
+
+   from common import log
+   from common import log_sinks
+   log.set_sinks([log_sinks.AsyncSink(
+       log_sinks.RotatingFileSink("/var/log/app.log",
+                                  formatter=log_sinks.format_json))])
+
+AsyncSink hands records to a background thread through a bounded queue and
+drops (and counts) records rather than block the caller when it is full.
+Records the wrapped sink fails to emit are counted separately.
+"""
+
+import json
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from common import log
+
+_SEVERITY_NAMES = {log.FATAL: "FATAL", log.INFO: "INFO", log.DEBUG: "DEBUG"}
+
+
+def format_json(record):
+    """ Renders a record as a single JSON line. """
+    entry = {"severity": _SEVERITY_NAMES.get(record.code, str(record.code)),
+             "time": record.time.isoformat(),
+             "pid": record.pid,
+             "module": os.path.basename(record.module),
+             "line": record.line_number,
+             "elapsed": round(record.elapsed, 6),
+             "message": record.message}
+    if record.stack:
+        entry["stack"] = ["%s:%d %s" % (os.path.basename(f[0]), f[1], f[2])
+                          for f in record.stack]
+    return json.dumps(entry, sort_keys=True) + "\n"
+
+
+class AsyncSink(object):
+
+    """ Emits records to another sink from a background thread.
+
+    At most max_queue_size records wait in the queue; when it is full new
+    records are dropped and counted in num_dropped, except FATAL records
+    which wait up to fatal_timeout seconds for room.  Records the sink
+    raised on are counted in num_failed.
+    """
+
+    def __init__(self, sink, max_queue_size=10000, fatal_timeout=5.0):
+        self.sink = sink
+        self.fatal_timeout = fatal_timeout
+        self.num_dropped = 0
+        self.num_failed = 0
+        self._count_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run,
+                                        name="common.log AsyncSink")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            if record.code == log.FATAL:
+                self._queue.put(record, timeout=self.fatal_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            with self._count_lock:
+                self.num_dropped += 1
+
+    def flush(self, timeout=5.0):
+        """ Waits up to timeout seconds for queued records to be written. """
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.001)
+        self.sink.flush()
+
+    def close(self):
+        self.flush()
+        try:
+            # A full queue means the writer is stuck; it is a daemon thread.
+            self._queue.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+        self._thread.join(1.0)
+        self.sink.close()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                self.sink.emit(record)
+                if self._queue.empty():
+                    self.sink.flush()
+            except Exception:
+                # Never let a broken sink kill the writer thread.
+                with self._count_lock:
+                    self.num_failed += 1
+            finally:
+                self._queue.task_done()
+
+
+class RotatingFileSink(object):
+
+    """ Appends formatted records to a file, rotating it by size and age.
+
+    The file is rotated once it would exceed max_bytes or has been written to
+    for more than max_age seconds (None disables either limit).  Rotated
+    files are renamed to path.1 ... path.<backup_count>, oldest last.
+    Records emitted after close() are dropped.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, max_age=24 * 3600,
+                 backup_count=5, formatter=log.format_glog):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.formatter = formatter
+        self._lock = threading.Lock()
+        self._file = None
+        self._open()
+
+    def emit(self, record):
+        text = self.formatter(record)
+        with self._lock:
+            if not self._file:
+                return
+            if self._should_rotate(len(text)):
+                self._rotate()
+            self._file.write(text)
+            self._size += len(text)
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _open(self):
+        self._file = open(self.path, "a")
+        self._size = self._file.tell()
+        self._opened_at = time.time()
+
+    def _should_rotate(self, num_bytes):
+        if not self._size:
+            return False
+        if self.max_bytes and self._size + num_bytes > self.max_bytes:
+            return True
+        if self.max_age and time.time() - self._opened_at > self.max_age:
+            return True
+        return False
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = "%s.%d" % (self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, "%s.%d" % (self.path, i + 1))
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
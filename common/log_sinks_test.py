@@ -0,0 +1,143 @@
+""" Tests for common.log_sinks.
+
+   python -m unittest common.log_sinks_test
+"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from common import log
+from common import log_sinks
+
+
+def _record(message, code=log.INFO):
+    return log.LogRecord(code, datetime.datetime(2015, 3, 4, 5, 6, 7),
+                         '/src/common/example.py', 42, message)
+
+
+class _ListSink(object):
+
+    """ Collects messages; emit() blocks while the gate is closed. """
+
+    def __init__(self):
+        self.messages = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.closed = False
+
+    def emit(self, record):
+        self.gate.wait()
+        self.messages.append(record.message)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FormatJsonTest(unittest.TestCase):
+
+    def test_one_json_line_per_record(self):
+        text = log_sinks.format_json(_record('hello "world"'))
+        self.assertTrue(text.endswith('\n'))
+        self.assertEqual(text.count('\n'), 1)
+        entry = json.loads(text)
+        self.assertEqual(entry['severity'], 'INFO')
+        self.assertEqual(entry['time'], '2015-03-04T05:06:07')
+        self.assertEqual(entry['module'], 'example.py')
+        self.assertEqual(entry['line'], 42)
+        self.assertEqual(entry['message'], 'hello "world"')
+        self.assertFalse('stack' in entry)
+
+
+class AsyncSinkTest(unittest.TestCase):
+
+    def test_emits_in_order_and_closes_sink(self):
+        target = _ListSink()
+        sink = log_sinks.AsyncSink(target)
+        for i in range(100):
+            sink.emit(_record(str(i)))
+        sink.close()
+        self.assertEqual(target.messages, [str(i) for i in range(100)])
+        self.assertEqual(sink.num_dropped, 0)
+        self.assertTrue(target.closed)
+
+    def test_drops_and_counts_when_full(self):
+        target = _ListSink()
+        target.gate.clear()
+        sink = log_sinks.AsyncSink(target, max_queue_size=2)
+        for i in range(10):
+            sink.emit(_record(str(i)))
+        # The writer holds one record, the queue two more.
+        self.assertTrue(sink.num_dropped >= 7)
+        target.gate.set()
+        sink.close()
+        self.assertEqual(len(target.messages) + sink.num_dropped, 10)
+
+    def test_counts_sink_failures_apart_from_drops(self):
+        target = _ListSink()
+        def emit(record):
+            raise IOError('disk full')
+        target.emit = emit
+        sink = log_sinks.AsyncSink(target)
+        for i in range(3):
+            sink.emit(_record(str(i)))
+        sink.close()
+        self.assertEqual(sink.num_failed, 3)
+        self.assertEqual(sink.num_dropped, 0)
+
+    def test_close_does_not_block_on_full_queue(self):
+        target = _ListSink()
+        target.gate.clear()
+        sink = log_sinks.AsyncSink(target, max_queue_size=1)
+        for i in range(3):
+            sink.emit(_record(str(i)))
+        sink.flush(timeout=0.01)
+        sink.close()
+        self.assertTrue(target.closed)
+        target.gate.set()
+
+
+class RotatingFileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'app.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_rotates_by_size(self):
+        sink = log_sinks.RotatingFileSink(self.path, max_bytes=100,
+                                          backup_count=2,
+                                          formatter=lambda r: r.message)
+        for message in ('a' * 60, 'b' * 60, 'c' * 60, 'd' * 60):
+            sink.emit(_record(message))
+        sink.close()
+        self.assertEqual(self.read(self.path), 'd' * 60)
+        self.assertEqual(self.read(self.path + '.1'), 'c' * 60)
+        self.assertEqual(self.read(self.path + '.2'), 'b' * 60)
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_emit_after_close_is_dropped(self):
+        sink = log_sinks.RotatingFileSink(self.path,
+                                          formatter=lambda r: r.message)
+        sink.emit(_record('kept'))
+        sink.close()
+        sink.emit(_record('dropped'))
+        sink.flush()
+        self.assertEqual(self.read(self.path), 'kept')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,39 +2,398 @@
 
 from common.log import *
 from common import hash
+from multiprocessing import pool as mp_pool
+import json
 import requests
+import shutil
+import tarfile
 import tempfile
+import threading
 
-def download_url(url, filename):
-    handle, tmp_filename = tempfile.mkstemp()
-    exists = False
-    r = requests.get(url, stream=True, timeout=5.0)
+RANGE_CHUNK_SIZE = 8 * 1024 * 1024  # bytes fetched per range request
+NUM_RANGE_THREADS = 8
+NUM_RANGE_RETRIES = 3
+
+
+class DigestMismatchError(RuntimeError):
+    pass
+
+
+def download_url(url, filename, num_threads=NUM_RANGE_THREADS,
+                 chunk_size=RANGE_CHUNK_SIZE, hashers=()):
+    """ Downloads url to filename.
+
+    If the server supports byte ranges and the file spans at least two chunks
+    of chunk_size bytes, the chunks are fetched in parallel on num_threads
+    pooled connections and written in place into a preallocated filename.part
+    file.  Finished chunks are recorded in a filename.part.progress sidecar,
+    so an interrupted download resumes where it left off.  Otherwise the file
+    is streamed with a single GET.
+
+    Each hashlib object in hashers is fed the file's bytes in order while it
+    downloads, so callers need no second pass over the file to verify it.
+    """
     print 'downloading %s -> %s' % (url, filename)
+    session = _new_session(1)
+    size, validator = _probe_ranges(session, url)
+    if size is not None and size >= 2 * chunk_size:
+        _download_ranges(url, filename, size, validator, num_threads,
+                         chunk_size, hashers)
+    else:
+        _download_stream(session, url, filename, hashers)
+    sys.stdout.write('\n')
+    return
+
+
+def _new_session(pool_size):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _probe_ranges(session, url):
+    """ Returns (size, validator) if url supports byte ranges, else (None,
+    None). The validator (ETag or Last-Modified) detects a changed file. """
+    try:
+        r = session.head(url, allow_redirects=True, timeout=5.0)
+    except requests.RequestException:
+        return None, None
+    if not r.ok or r.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None, None
+    try:
+        size = int(r.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None, None
+    validator = r.headers.get('ETag') or r.headers.get('Last-Modified') or ''
+    return size, validator
+
+
+def _download_stream(session, url, filename, hashers):
+    """ Fetches url with a single GET into a temp file renamed to filename. """
+    handle, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(handle)
+    try:
+        r = session.get(url, stream=True, timeout=5.0)
+        if not r.ok:
+            raise RuntimeError('Download url failed: %s' % (r))
+        f = open(tmp_filename, 'wb')
+        try:
+            # The file as served, even with a Content-Encoding (e.g. S3's
+            # gzip for .tar.gz), so its digests are those of the file.
+            for chunk in r.raw.stream(1024000, decode_content=False):
+                if chunk:  # filter out keep-alive new chunks
+                    f.write(chunk)
+                    for hasher in hashers:
+                        hasher.update(chunk)
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+        finally:
+            f.close()
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return
+
+
+class _RangeProgress(object):
+
+    """ Set of finished chunks, persisted in a sidecar file for resuming. """
+
+    def __init__(self, path, url, size, validator, chunk_size):
+        self.path = path
+        self.state = {'url': url, 'size': size, 'validator': validator,
+                      'chunk_size': chunk_size, 'done': []}
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Picks up a previous attempt at the same file, if any. """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return
+        if all(saved.get(k) == self.state[k]
+               for k in ('url', 'size', 'validator', 'chunk_size')):
+            self.done = set(saved['done'])
+
+    def mark_done(self, chunk):
+        with self.lock:
+            self.done.add(chunk)
+            self.state['done'] = sorted(self.done)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.rename(tmp_path, self.path)
+
+
+class _InOrderHasher(object):
+
+    """ Feeds finished chunks of a ranged download to hashers in file order.
+
+    Chunks finish out of order, so each is hashed once all chunks before it
+    are done, reading it back from the file while it is still in the page
+    cache rather than holding chunk data in memory.
+    """
+
+    def __init__(self, fd, size, chunk_size, hashers):
+        self.fd = fd
+        self.size = size
+        self.chunk_size = chunk_size
+        self.hashers = hashers
+        self.next_chunk = 0
+        self.finished = set()
+        self.lock = threading.Lock()
+
+    def chunk_done(self, chunk):
+        if not self.hashers:
+            return
+        with self.lock:
+            self.finished.add(chunk)
+            while self.next_chunk in self.finished:
+                self.finished.discard(self.next_chunk)
+                self._hash_chunk(self.next_chunk)
+                self.next_chunk += 1
 
-    if not r.ok:
-        raise RuntimeError('Download url failed: %s' % (r))
+    def _hash_chunk(self, chunk):
+        offset = chunk * self.chunk_size
+        end = min(offset + self.chunk_size, self.size)
+        while offset < end:
+            data = _pread(self.fd, min(1024 * 1024, end - offset), offset)
+            if not data:
+                raise IOError('Unexpected end of file at %d' % (offset))
+            for hasher in self.hashers:
+                hasher.update(data)
+            offset += len(data)
 
-    f = open(tmp_filename, 'wb')
-    for chunk in r.iter_content(chunk_size=1024000):
-        if chunk:  # filter out keep-alive new chunks
-            f.write(chunk)
+
+def _download_ranges(url, filename, size, validator, num_threads, chunk_size,
+                     hashers):
+    part_filename = filename + '.part'
+    progress = _RangeProgress(part_filename + '.progress', url, size,
+                              validator, chunk_size)
+    if os.path.exists(part_filename) and \
+            os.path.getsize(part_filename) == size:
+        progress.load()
+    fd = os.open(part_filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, size)  # preallocate, no-op when resuming
+        num_chunks = (size + chunk_size - 1) // chunk_size
+        todo = [c for c in range(num_chunks) if c not in progress.done]
+        sessions = threading.local()
+        write_lock = threading.Lock()
+        hasher = _InOrderHasher(os.open(part_filename, os.O_RDONLY), size,
+                                chunk_size, hashers)
+        for chunk in sorted(progress.done):
+            hasher.chunk_done(chunk)
+
+        def fetch_chunk(chunk):
+            if not hasattr(sessions, 'session'):
+                sessions.session = _new_session(1)
+            start = chunk * chunk_size
+            end = min(start + chunk_size, size) - 1
+            for attempt in range(NUM_RANGE_RETRIES):
+                try:
+                    _fetch_range(sessions.session, url, validator, fd, start,
+                                 end, write_lock)
+                    break
+                except (requests.RequestException, IOError):
+                    if attempt == NUM_RANGE_RETRIES - 1:
+                        raise
+            progress.mark_done(chunk)
+            hasher.chunk_done(chunk)
             sys.stdout.write('.')
             sys.stdout.flush()
-    f.close()
-    sys.stdout.write('\n')
-    os.rename(tmp_filename, filename)
+
+        pool = mp_pool.ThreadPool(processes=min(num_threads, len(todo)) or 1)
+        try:
+            pool.map(fetch_chunk, todo)
+        finally:
+            pool.close()
+            pool.join()
+            os.close(hasher.fd)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(part_filename, filename)
+    os.remove(progress.path)
     return
 
 
-def fetch_tarball(url, md5):
-    handle, tmp_filename = tempfile.mkstemp()
-    download_url(url, tmp_filename)
-    computed_md5 = hash.md5sum(tmp_filename)
-    CHECK_EQ(md5, computed_md5)
+def _fetch_range(session, url, validator, fd, start, end, write_lock):
+    """ Fetches bytes [start, end] of url and writes them at offset start. """
+    headers = {'Range': 'bytes=%d-%d' % (start, end)}
+    if validator:
+        headers['If-Range'] = validator
+    r = session.get(url, headers=headers, stream=True, timeout=5.0)
+    if r.status_code != 206:
+        # E.g. the file changed since the probe and If-Range didn't match.
+        raise RuntimeError('Range request for %s failed: %s' % (url, r))
+    offset = start
+    # Ranges are of the file as served, so any Content-Encoding stays on.
+    for chunk in r.raw.stream(256 * 1024, decode_content=False):
+        if chunk:
+            _pwrite(fd, chunk, offset, write_lock)
+            offset += len(chunk)
+    if offset != end + 1:
+        raise IOError('Short read for range %d-%d of %s' % (start, end, url))
+
+
+def _pwrite(fd, data, offset, lock):
+    """ Writes all of data at offset without moving a shared file position. """
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            num_written = os.pwrite(fd, view, offset)
+        else:
+            with lock:  # no os.pwrite before python 3.3
+                os.lseek(fd, offset, os.SEEK_SET)
+                num_written = os.write(fd, view)
+        view = view[num_written:]
+        offset += num_written
+
+
+def _pread(fd, num_bytes, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, num_bytes, offset)
+    os.lseek(fd, offset, os.SEEK_SET)  # fd is private to the reader
+    return os.read(fd, num_bytes)
+
+
+def _expected_digests(md5, sha256, blake2b):
+    expected = {}
+    for algorithm, digest in (('md5', md5), ('sha256', sha256),
+                              ('blake2b', blake2b)):
+        if digest:
+            expected[algorithm] = digest.lower()
+    return expected
+
+
+def _check_digests(url, expected, hashers):
+    for algorithm, digest in sorted(expected.items()):
+        computed = hashers[algorithm].hexdigest()
+        if computed != digest:
+            raise DigestMismatchError('%s of %s is %s, expected %s' % (
+                algorithm, url, computed, digest))
+
+
+def _remove_download(filename):
+    """ Removes filename and what an interrupted download_url() left of it. """
+    for path in (filename, filename + '.part', filename + '.part.progress',
+                 filename + '.part.progress.tmp'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def fetch_tarball(url, md5=None, sha256=None, blake2b=None, dir=None):
+    """ Downloads url to a temp file in dir and returns its name.
+
+    The given hex digests are computed while downloading.  On a mismatch the
+    temp file is removed and DigestMismatchError raised; on any failure no
+    partial download is left behind either.  Without a digest the download
+    is not verified, which is logged.  blake2b needs python 3.6, hashlib
+    raises ValueError for it on python 2.  See common.artifact_cache to reuse
+    downloads across calls.
+    """
+    expected = _expected_digests(md5, sha256, blake2b)
+    if not expected:
+        LOG(INFO, 'No digest given for %s, not verifying it' % (url))
+    hashers = dict((a, hash.new_hasher(a)) for a in expected)
+    handle, tmp_filename = tempfile.mkstemp(dir=dir)
+    os.close(handle)
+    try:
+        download_url(url, tmp_filename, hashers=hashers.values())
+        _check_digests(url, expected, hashers)
+    except:
+        _remove_download(tmp_filename)
+        raise
     return tmp_filename
 
 
-def fetch_and_unarchive(archive_url, md5):
-    tarball_file = fetch_tarball(archive_url, md5)
-    LOG(FATAL, 'Not yet implemented')
-    return
+class _HashingReader(object):
+
+    """ File-like reader over a response body that hashes what it reads. """
+
+    def __init__(self, raw, hashers):
+        self.raw = raw
+        self.hashers = hashers
+
+    def read(self, size=-1):
+        data = self.raw.read(size if size >= 0 else None)
+        for hasher in self.hashers:
+            hasher.update(data)
+        return data
+
+    def drain(self):
+        """ Reads what the consumer left, e.g. the tar end-of-archive padding,
+        so the digests cover the whole body. """
+        while self.read(1024 * 1024):
+            pass
+
+
+def _check_member(member, staging_dir):
+    """ Rejects members that would land outside staging_dir. """
+    root = os.path.realpath(staging_dir)
+    paths = [member.name]
+    if member.issym():
+        paths.append(os.path.join(os.path.dirname(member.name),
+                                  member.linkname))
+    elif member.islnk():
+        paths.append(member.linkname)
+    for path in paths:
+        target = os.path.realpath(os.path.join(root, path))
+        if target != root and not target.startswith(root + os.sep):
+            raise tarfile.TarError('Unsafe path in archive: %s' % (path))
+
+
+def fetch_and_unarchive(archive_url, md5, dest_dir=None, sha256=None,
+                        blake2b=None):
+    """ Downloads a tar archive (gz or bz2 compressed, or xz on python 3) and
+    unpacks it into dest_dir, which must not exist yet.  Returns dest_dir, a
+    new temp dir if None.
+
+    The archive is extracted as it streams in, never stored on disk, and is
+    unpacked into a staging dir beside dest_dir that is renamed into place
+    only once the digests match.  On any failure the staging dir is removed
+    and dest_dir is left untouched.  As with fetch_tarball(), blake2b needs
+    python 3.6 and a missing digest is logged.
+    """
+    expected = _expected_digests(md5, sha256, blake2b)
+    if not expected:
+        LOG(INFO, 'No digest given for %s, not verifying it' % (archive_url))
+    hashers = dict((a, hash.new_hasher(a)) for a in expected)
+    if dest_dir is None:
+        dest_dir = tempfile.mkdtemp()
+        os.rmdir(dest_dir)  # only reserve the name
+    dest_dir = os.path.abspath(dest_dir)
+    staging_dir = tempfile.mkdtemp(dir=os.path.dirname(dest_dir),
+                                   prefix='.unarchive-')
+    print 'unarchiving %s -> %s' % (archive_url, dest_dir)
+    try:
+        r = _new_session(1).get(archive_url, stream=True, timeout=5.0)
+        if not r.ok:
+            raise RuntimeError('Download url failed: %s' % (r))
+        # Hash the file as served; a gzip Content-Encoding (as S3 may send
+        # for .tar.gz) is left to tarfile, like the archive's compression.
+        r.raw.decode_content = False
+        reader = _HashingReader(r.raw, list(hashers.values()))
+        tar = tarfile.open(fileobj=reader, mode='r|*')
+        try:
+            for member in tar:
+                _check_member(member, staging_dir)
+                tar.extract(member, staging_dir)
+        finally:
+            tar.close()
+        reader.drain()
+        _check_digests(archive_url, expected, hashers)
+        os.rename(staging_dir, dest_dir)
+    except:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    return dest_dir
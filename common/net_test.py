@@ -0,0 +1,235 @@
+""" Tests for common.net against a local HTTP server.
+
+   python -m unittest common.net_test
+"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from common import net
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """ Serves server.files, honoring Range headers if server.ranges, with
+    server.content_encoding as their Content-Encoding if set. """
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.server.requests.append((self.command, self.headers.get('Range')))
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if range_header and self.server.fail_ranges:
+            self.send_error(500)
+            return
+        if self.server.ranges and range_header:
+            start, end = [int(x) for x in range_header[6:].split('-')]
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if self.server.content_encoding:
+            self.send_header('Content-Encoding', self.server.content_encoding)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class NetTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.fail_ranges = False
+        self.server.content_encoding = None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+
+    def range_requests(self):
+        return [r for r in self.server.requests if r[0] == 'GET' and r[1]]
+
+
+class DownloadUrlTest(NetTestBase):
+
+    def setUp(self):
+        NetTestBase.setUp(self)
+        self.data = os.urandom(100 * 1024 + 17)
+        self.server.files['/blob'] = self.data
+        self.filename = os.path.join(self.dir, 'blob')
+
+    def test_parallel_ranges(self):
+        net.download_url(self.url('/blob'), self.filename, num_threads=4,
+                         chunk_size=8 * 1024)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        self.assertEqual(len(self.range_requests()), 13)
+        self.assertFalse(os.path.exists(self.filename + '.part.progress'))
+
+    def test_falls_back_without_ranges(self):
+        self.server.ranges = False
+        net.download_url(self.url('/blob'), self.filename, chunk_size=8 * 1024)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        self.assertEqual(self.range_requests(), [])
+
+    def test_resumes_partial_download(self):
+        chunk_size = 8 * 1024
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(self.data[:3 * chunk_size])
+            f.write('\0' * (len(self.data) - 3 * chunk_size))
+        progress = net._RangeProgress(self.filename + '.part.progress',
+                                      self.url('/blob'), len(self.data), '',
+                                      chunk_size)
+        for chunk in range(3):
+            progress.mark_done(chunk)
+        net.download_url(self.url('/blob'), self.filename, num_threads=2,
+                         chunk_size=chunk_size)
+        self.assertEqual(open(self.filename, 'rb').read(), self.data)
+        self.assertEqual(len(self.range_requests()), 10)
+
+    def test_hashes_while_downloading(self):
+        for ranges in (True, False):
+            self.server.ranges = ranges
+            hasher = hashlib.sha256()
+            net.download_url(self.url('/blob'), self.filename, num_threads=4,
+                             chunk_size=8 * 1024, hashers=[hasher])
+            self.assertEqual(hasher.hexdigest(),
+                             hashlib.sha256(self.data).hexdigest())
+
+
+class FetchTarballTest(NetTestBase):
+
+    def setUp(self):
+        NetTestBase.setUp(self)
+        self.data = os.urandom(64 * 1024)
+        self.server.files['/blob.tar'] = self.data
+
+    def test_verifies_digests(self):
+        filename = net.fetch_tarball(
+            self.url('/blob.tar'), md5=hashlib.md5(self.data).hexdigest(),
+            sha256=hashlib.sha256(self.data).hexdigest())
+        try:
+            self.assertEqual(open(filename, 'rb').read(), self.data)
+        finally:
+            os.remove(filename)
+
+    def test_mismatch_removes_temp_file(self):
+        before = set(os.listdir(tempfile.gettempdir()))
+        self.assertRaises(net.DigestMismatchError, net.fetch_tarball,
+                          self.url('/blob.tar'), md5='0' * 32)
+        self.assertEqual(set(os.listdir(tempfile.gettempdir())), before)
+
+    def test_keeps_content_encoding(self):
+        archive = io.BytesIO()
+        tar = tarfile.open(fileobj=archive, mode='w:gz')
+        tar.close()
+        data = archive.getvalue() + os.urandom(2 * net.RANGE_CHUNK_SIZE)
+        self.server.files['/blob.tar.gz'] = data
+        self.server.content_encoding = 'gzip'
+        for ranges in (True, False):
+            self.server.ranges = ranges
+            filename = net.fetch_tarball(
+                self.url('/blob.tar.gz'),
+                sha256=hashlib.sha256(data).hexdigest(), dir=self.dir)
+            self.assertEqual(open(filename, 'rb').read(), data)
+            os.remove(filename)
+
+    def test_failed_download_leaves_no_parts(self):
+        self.server.files['/big.tar'] = '\0' * (2 * net.RANGE_CHUNK_SIZE)
+        self.server.fail_ranges = True
+        self.assertRaises(RuntimeError, net.fetch_tarball,
+                          self.url('/big.tar'), md5='0' * 32, dir=self.dir)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+class FetchAndUnarchiveTest(NetTestBase):
+
+    def make_archive(self, files, mode='w:gz'):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode=mode)
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        tar.close()
+        return buf.getvalue()
+
+    def test_unpacks_verified_archive(self):
+        for mode in ('w:gz', 'w:bz2', 'w'):
+            archive = self.make_archive([('a/b.txt', 'hello'),
+                                         ('c.bin', os.urandom(5000))], mode)
+            self.server.files['/x.tar'] = archive
+            dest = os.path.join(self.dir, mode)
+            self.assertEqual(net.fetch_and_unarchive(
+                self.url('/x.tar'), hashlib.md5(archive).hexdigest(), dest),
+                dest)
+            self.assertEqual(open(os.path.join(dest, 'a/b.txt')).read(),
+                             'hello')
+        self.assertEqual(sorted(os.listdir(self.dir)), ['w', 'w:bz2', 'w:gz'])
+
+    def test_hashes_content_encoded_archive(self):
+        archive = self.make_archive([('a', 'data')])
+        self.server.files['/x.tar.gz'] = archive
+        self.server.content_encoding = 'gzip'
+        dest = os.path.join(self.dir, 'out')
+        net.fetch_and_unarchive(self.url('/x.tar.gz'),
+                                hashlib.md5(archive).hexdigest(), dest)
+        self.assertEqual(open(os.path.join(dest, 'a')).read(), 'data')
+
+    def test_mismatch_leaves_no_trace(self):
+        self.server.files['/x.tar'] = self.make_archive([('a', 'data')])
+        dest = os.path.join(self.dir, 'out')
+        self.assertRaises(net.DigestMismatchError, net.fetch_and_unarchive,
+                          self.url('/x.tar'), '0' * 32, dest)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_rejects_paths_outside_dest(self):
+        archive = self.make_archive([('../evil', 'data')])
+        self.server.files['/x.tar'] = archive
+        dest = os.path.join(self.dir, 'out')
+        self.assertRaises(tarfile.TarError, net.fetch_and_unarchive,
+                          self.url('/x.tar'), hashlib.md5(archive).hexdigest(),
+                          dest)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()